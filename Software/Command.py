@@ -129,6 +129,16 @@ def point_to_column(col,config_mode):
 def load_ldbus(col,hit_or,hit,inject):
     return gen_config_command(get_dac_pattern(empty=True)+get_control_pattern(col,hit_or=str(hit_or),hit=str(hit),inject=str(inject),lden="1"))
 
+def load_latches(col,ldbus,config_mode="00"):
+    """Load the column register into the pixel latches selected by the 8 ldbus bits
+    (hit_or, hit, inject, TDAC0-4), see chipimage.LATCHES"""
+    return gen_config_command(get_dac_pattern(empty=True)+get_control_pattern(col,hit_or=ldbus[0],hit=ldbus[1],inject=ldbus[2],TDAC=ldbus[3:],lden="1",config_mode=config_mode))
+
+def write_latches(col,pattern,ldbus,config_mode="00"):
+    """Point to the column, shift in the 64 bit pattern, load it into the latches selected by ldbus
+    and return the load enable to zero. With config_mode '11' every column is loaded"""
+    return command_Dict_combine(point_to_column(col,config_mode),gen_column_command(pattern),load_latches(col,ldbus,config_mode),point_to_column(col,config_mode))
+
 def Gcfg_Test(index):
     """A bitpattern of a '1' only at the associated index, this is only used to test the shift register, check if everything is working
     Clock into GcfgCK, Data into SRIN_ALL, Readout GcfgCK, DO NOT LOAD PATTERN
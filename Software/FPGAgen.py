@@ -1,7 +1,16 @@
 __author__ = 'Maximilian Golub','Bo Wang'
 import serial
 import Command
+import chipimage
 import argparse
+import tracing
+import profiling
+import recording
+import capture
+import ringcapture
+import serialreader
+import collections
+import time
 #######################################################################################################################
 #Settings for serial communication, predefined FPGA commands and pin mapping
 BAUD = 9600
@@ -19,6 +28,19 @@ WRITE = '01111111'
 TRANSMIT = '01111110'
 TRANSMIT_OFF = '10111111'
 
+"""The framed protocol (--framed, see frame_rx.v in the firmware) sends a command as
+chunks, each one a frame: SYNC, sequence number, length, data, CRC-8 of the three before.
+The FPGA answers each frame with ACK and its number, or NAK and the number it expects,
+and only the rejected chunks are sent again. A frame of length 0 ends the command."""
+FRAMED = False
+SYNC = '11111101'
+ACK = 0xA5
+NAK = 0x5A
+CHUNK = 64 #largest chunk, the frame buffer of frame_rx
+RETRIES = 8 #times a frame or a command is sent again before giving up
+#frames and commands sent again, printed at the end of a --framed run
+retransmitted = collections.Counter()
+
 #a dictionary of the command pin mapping
 pinDict = {0:'SRIN_ALL',
            1:'SRCK_G',
@@ -28,6 +50,8 @@ pinDict = {0:'SRIN_ALL',
            5:'NU',
            6:'NU',
            7:'NU'}
+#the lanes written to the send log
+LOG_LANES = [s for s in pinDict.values() if s != "NU"]
 #######################################################################################################################
 #RawConversionException class
 class RawConversionException(Exception):
@@ -36,6 +60,14 @@ class RawConversionException(Exception):
         def __str__(self):
                 return repr(self.value)
 
+#######################################################################################################################
+#FramingError class
+class FramingError(Exception):
+        def __init__(self, value):
+                self.value = value
+        def __str__(self):
+                return repr(self.value)
+
 #######################################################################################################################
 #Conversion methods for serial communication
 def convertToByte(list):
@@ -67,8 +99,10 @@ def commandRead(commandDict,sendFile):
     stringList = []
     for i in range(8):
         stringList.append(commandDict[pinDict[i]])
-    for s in pinDict.values():
-        if (s != "NU"):
+    if isinstance(sendFile, capture.CaptureWriter):
+        sendFile.write_command([commandDict[s] for s in LOG_LANES])
+    else:
+        for s in LOG_LANES:
             sendFile.write(s+"\n")
             sendFile.write(commandDict[s]+"\n")
     return convertToByte(stringList)
@@ -97,11 +131,117 @@ def FPGA_write(port, commandString, RX_ON = True):
 def readData(port,lenData,readFile,if_read):
     """Reads data from the serial port to a file called shiftData.txt."""
     FPGA_write(port,TRANSMIT,False)
+    if if_read and isinstance(readFile, ringcapture.RingCapture):
+        # Straight from the port into the ring, without holding the data.
+        readFile.stream(port,lenData)
+        return
     data = port.read(lenData)
     if if_read:
+        write_readback(readFile,data)
+
+def write_readback(readFile,data):
+    """Write data read back from the FPGA to a read log (text, capture or ring)"""
+    if isinstance(readFile, capture.CaptureWriter):
+        readFile.write_read(data)
+    elif isinstance(readFile, ringcapture.RingCapture):
+        readFile.write_segment(data)
+    else:
         final = convertFPGAHits(data)
         readFile.write(final+"\n")
 
+def crc8_table():
+    """The CRC-8 (polynomial x^8+x^2+x+1) of every byte, as frame_rx computes it"""
+    table = []
+    for byte in range(256):
+        crc = byte
+        for i in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return table
+CRC8_TABLE = crc8_table()
+
+def crc8(data, crc=0):
+    for c in data:
+        crc = CRC8_TABLE[crc ^ ord(c)]
+    return crc
+
+def make_frame(seq, data):
+    """A chunk of a command as a frame numbered seq (0 to 255)"""
+    body = chr(seq) + chr(len(data)) + data
+    return convertToRaw(SYNC) + body + chr(crc8(body))
+
+def resync(port, wait=0.01):
+    """Leave a gap, so frame_rx gives up on a frame cut short (or one it already rejected),
+    and drop any late answer. The gap starts once what was written has left the port"""
+    if hasattr(port, 'flush'):
+        port.flush()
+    time.sleep(wait)
+    if hasattr(port, 'reset_input_buffer'):
+        port.reset_input_buffer()
+    elif hasattr(port, 'flushInput'):
+        port.flushInput()
+
+def send_frame(port, seq, data, retries=RETRIES):
+    """Send one frame until the FPGA accepts it, at most retries more times.
+    Returns what was read instead of the reply if it was the start of the readback
+    (only 0x00 and 0xFF bytes), otherwise ''. The FPGA only writes a command out and
+    sends it back once it has accepted the end frame, and does not listen for frames
+    until then, so for the end frame that means the ACK was lost: sending it again
+    would get no answer"""
+    frame = make_frame(seq, data)
+    for attempt in range(retries + 1):
+        port.write(frame)
+        reply = port.read(2)
+        if len(reply) == 2:
+            code, number = ord(reply[0]), ord(reply[1])
+            if code == ACK and number == seq:
+                return ''
+            if code == NAK and number == (seq + 1) % 256:
+                return '' #accepted before, but the ACK was lost
+            if not data and not reply.translate(None, '\x00\xff'):
+                return reply
+        retransmitted['frames'] += 1
+        resync(port)
+    raise FramingError("Frame %i was not accepted after %i tries" % (seq, retries + 1))
+
+def FPGA_write_framed(port, commandString, chunk=CHUNK, retries=RETRIES):
+    """Writes a command to the FPGA with the framed protocol instead of RX/RX_OFF.
+    Each chunk is sent again until the FPGA accepts it, so a corrupted or dropped
+    byte only costs that chunk. Returns the start of the readback if it came
+    in place of the ACK of the end frame (see send_frame), otherwise ''."""
+    if not port.isOpen():
+        print("Serial port failure")
+        raise Exception
+    chunks = [commandString[i:i+chunk] for i in range(0, len(commandString), chunk)]
+    for seq, data in enumerate(chunks):
+        send_frame(port, seq % 256, data, retries)
+    return send_frame(port, len(chunks) % 256, '', retries)
+
+def framed_command(port,byteCMDString,retries=RETRIES):
+    """Send a command with the framed protocol, write it out and return the data read back.
+    The readback has no CRC, but it can only hold 0x00 and 0xFF bytes, so a short or
+    corrupted one is caught too: then the whole command, which can be repeated safely,
+    is sent again"""
+    for attempt in range(retries + 1):
+        try:
+            len_Data = len(byteCMDString)
+            data = FPGA_write_framed(port,byteCMDString)
+            if not data:
+                FPGA_write(port,TRANSMIT,False)
+            data += port.read(len_Data - len(data))
+            if len(data) == len_Data and not data.translate(None, '\x00\xff'):
+                return data
+            print("Readback of %i bytes was corrupted (%i received), sending the command again." % (len_Data, len(data)))
+        except FramingError as e:
+            print("%s, sending the command again." % e.value)
+        retransmitted['commands'] += 1
+        #RX_OFF ends the frame state: the FPGA writes out what it accepted and sends it
+        #back, which is dropped after waiting for it
+        resync(port)
+        FPGA_write(port,RX_OFF,False)
+        resync(port, 20.0 * len(byteCMDString) / BAUD)
+    raise FramingError("The command was not sent after %i tries" % (retries + 1))
+
 def commonSetup(port,commandDict,sendFile):
     """Common setup between auto and manual methods"""
     port.close()
@@ -132,10 +272,67 @@ def manual(port,commandDict,sendFile,readFile,if_read=True):
 def auto(port,commandDict,sendFile,readFile,if_read=True):
     """The automatic method to write a stream to control T3MAPS.
 Will not lose data due to built in buffer in computer"""
+    if FRAMED:
+        port.close()
+        port.open()
+        data = framed_command(port,commandRead(commandDict,sendFile))
+        if if_read:
+            write_readback(readFile,data)
+        return
     len_Data=commonSetup(port,commandDict,sendFile)
     readData(port, len_Data,readFile,if_read)
 
 
+def submit(reader,port,commandDict,sendFile):
+    """Send a command and TRANSMIT without waiting for the data to come back.
+    The port stays open, and reader (a serialreader.SerialReader on it) collects
+    the readback: returns its Future"""
+    byteCMDString = commandRead(commandDict,sendFile)
+    len_Data = FPGA_write(port,byteCMDString)
+    future = reader.expect(len_Data)
+    FPGA_write(port,TRANSMIT,False)
+    return future
+
+def run_command(args,commandDict,sendFile,readFile,pending,label=None):
+    """Send a command as auto does. The readback is written to readFile after label
+    (e.g. the test number), or not kept if there is no label.
+    With a background reader (--background), the port stays open and the readback
+    is waited for once more than args.window commands are pending. fsm_control.v
+    has no receive buffer and ignores the port while it is in WRITE or TRANSMIT, so
+    the next command's bytes would be lost or read as opcodes: with this firmware
+    the window has to stay 0, so each command waits for the last readback"""
+    reader = getattr(args,'reader',None)
+    if reader is None:
+        if label is not None:
+            readFile.write(label)
+        auto(args.port,commandDict,sendFile,readFile,if_read=label is not None)
+        if label is not None:
+            readFile.write("\n")
+        return
+    pending.append((label,submit(reader,args.port,commandDict,sendFile)))
+    collect(pending,readFile,args.window)
+
+def collect(pending,readFile,window=0):
+    """Write out the readbacks of the oldest pending commands until at most window are left"""
+    while len(pending) > window:
+        label, future = pending.popleft()
+        data = future.result(TIMEOUT)
+        if label is not None:
+            readFile.write(label)
+            write_readback(readFile,data)
+            readFile.write("\n")
+
+def op_command(op):
+    """Convert a chipimage operation (LatchLoad or ConfigLoad) to a command dictionary"""
+    if isinstance(op,chipimage.LatchLoad):
+        return Command.write_latches(op.col,op.pattern,op.ldbus,op.config_mode)
+    return Command.gen_config_command(op.pattern,load_dacs=True)
+
+def write_ops(port,ops,sendFile,readFile):
+    """Send a list of chipimage operations, e.g. from chipimage.compile_diff, to T3MAPS"""
+    for op in ops:
+        auto(port,op_command(op),sendFile,readFile,if_read=False)
+
 def analog_Test(port,type):
     if type == 'small':
         auto(port,Command.set_config(vth=150, config_mode = '11')) #for small pixel
@@ -144,37 +341,46 @@ def analog_Test(port,type):
     auto(port,Command.hitor_hit_inject(is_hit_or=True,all=True,enable=True))
     auto(port,Command.hitor_hit_inject(is_hit_or=False,all=True,enable=False))
 
+def open_log(fname, args, read=False):
+    """Open a send or read log: a text file, or with --capture a binary capture (see capture.py).
+    With --ring, the read log is a memory-mapped ring file (see ringcapture.py)"""
+    if read and getattr(args, 'ring', False):
+        return ringcapture.RingCapture(fname, args.ring_size << 20)
+    if getattr(args, 'capture', False):
+        return capture.CaptureWriter(fname, LOG_LANES, compress=args.compress)
+    return open(fname,"wb")
+
 def Test_Pattern_Gcfg(args):
     """This is to run the system with test patterns for Gcfg Register, it will
     output a 1 at an index starting from 0, this way we can verify if that specific
     bit is at the right place when we read it back"""
-    sendFile=open(args.sendFile,"wb")
-    readFile=open(args.readFile,"wb")
+    sendFile=open_log(args.sendFile,args)
+    readFile=open_log(args.readFile,args,read=True)
     if(args.num>176):
         raise Exception
+    pending=collections.deque()
     for i in range(0,args.num):
         sendFile.write(str(i)+": \n")
-        auto(args.port,Command.Gcfg_Test(i),sendFile,readFile,if_read=False)
-        readFile.write(str(i)+": \n")
-        auto(args.port,Command.Gcfg_Test(i),sendFile,readFile)
-        readFile.write("\n")
+        run_command(args,Command.Gcfg_Test(i),sendFile,readFile,pending)
+        run_command(args,Command.Gcfg_Test(i),sendFile,readFile,pending,str(i)+": \n")
         sendFile.write("\n")
+    collect(pending,readFile)
     sendFile.close()
     readFile.close()
 
 
 def Test_Pattern_Column(args):
-    sendFile=open(args.sendFile,"wb")
-    readFile=open(args.readFile,"wb")
+    sendFile=open_log(args.sendFile,args)
+    readFile=open_log(args.readFile,args,read=True)
     if(args.num>64):
         raise Exception
+    pending=collections.deque()
     for i in range(0,args.num):
         sendFile.write(str(i)+": \n")
-        auto(args.port,Command.command_Dict_combine(Command.point_to_column(args.col,"00"),Command.Column_Array_Test(i,1)),sendFile,readFile,if_read=False)
-        readFile.write(str(i)+": \n")
-        auto(args.port,Command.Column_Array_Test(i,1),sendFile,readFile)
-        readFile.write("\n")
+        run_command(args,Command.command_Dict_combine(Command.point_to_column(args.col,"00"),Command.Column_Array_Test(i,1)),sendFile,readFile,pending)
+        run_command(args,Command.Column_Array_Test(i,1),sendFile,readFile,pending,str(i)+": \n")
         sendFile.write("\n")
+    collect(pending,readFile)
     sendFile.close()
     readFile.close()
 
@@ -188,16 +394,33 @@ def main_setup(args):
     print "  Connect the specified command number pin on adapter card to the specified pin on T3MAPS"
 
 def set_config(args):
-    sendFile=open(args.sendFile,"wb")
-    readFile=open(args.readFile,"wb")
-    auto(args.port,Command.set_config(),sendFile,readFile)
+    sendFile=open_log(args.sendFile,args)
+    readFile=open_log(args.readFile,args,read=True)
+    reader = getattr(args,'reader',None)
+    if reader is None:
+        auto(args.port,Command.set_config(),sendFile,readFile)
+    else:
+        #auto closes and reopens the port, which the background reader is using
+        write_readback(readFile,submit(reader,args.port,Command.set_config(),sendFile).result(TIMEOUT))
+    sendFile.close()
+    readFile.close()
 
 #Call the main method upon execution.
 if __name__ == "__main__":
-    port = serial.Serial(port=COMPORT,baudrate=BAUD, bytesize=8,stopbits=2, timeout=TIMEOUT)
-
     parser = argparse.ArgumentParser(description="Present a few options from FPGAgen.py to be used from the command line for testing..")
-    parser.set_defaults(port=port)
+    parser.add_argument('--record', dest='record', help='Record every serial write and read to this file, to be replayed with --replay (see recording.py).')
+    parser.add_argument('--replay', dest='replay', help='Do not open the serial port: answer every read from this recording instead. Runs recorded with --background are replayed without it.')
+    parser.add_argument('--full-speed', dest='full_speed', action='store_true', help='With --replay, do not wait for the recorded timings.')
+    parser.add_argument('--capture', dest='capture', action='store_true', help='Write the send and read logs as binary captures (see capture.py) instead of text.')
+    parser.add_argument('--compress', dest='compress', action='store_true', help='With --capture, also compress the captures.')
+    parser.add_argument('--ring', dest='ring', action='store_true', help='Stream the data read back into a memory-mapped ring file (see ringcapture.py) instead of the read log.')
+    parser.add_argument('--ring-size', dest='ring_size', type=int, default=256, help='With --ring, the size of the ring file in MB.')
+    parser.add_argument('--background', dest='background', action='store_true', help='Keep the port open and read it from a background thread (see serialreader.py), so commands do not wait for each other\'s readback.')
+    parser.add_argument('--window', dest='window', type=int, default=0, help='With --background, how many commands may be waiting for their readback before the next one is sent. Leave it at 0 unless the firmware buffers what it receives: fsm_control.v drops or misreads bytes sent while it writes or transmits.')
+    parser.add_argument('--framed', dest='framed', action='store_true', help='Send commands with the framed protocol (CRC per chunk, only failed chunks sent again). Needs the firmware with frame_rx.')
+    parser.add_argument('--profile', dest='profile', action='store_true', help='Print how long the run spent encoding commands, writing to the serial port and reading back.')
+    parser.add_argument('--profile-dump', dest='profile_dump', help='With --profile, also run cProfile and write its statistics to this file.')
+    parser.add_argument('--trace', dest='trace', help='Record every serial write and read, save them to this file as a Chrome trace and print a summary (see tracing.py).')
     subparsers = parser.add_subparsers(title = 'Functions')
 
     setup = subparsers.add_parser('setup', help='Print instructions for the physical setup of the chip.')
@@ -224,4 +447,40 @@ if __name__ == "__main__":
     config.add_argument('--readFile',dest='readFile',type=str, default='shiftData.txt',help='file to store data read back')
 
     args = parser.parse_args()
-    args.func(args)
\ No newline at end of file
+    if args.record and args.replay:
+        parser.error('--record and --replay cannot be used together.')
+    if args.framed and args.background:
+        parser.error('--framed and --background cannot be used together.')
+    if args.replay and args.background:
+        # The reader thread would take replayed reads ahead of the writes they answer.
+        parser.error('--replay and --background cannot be used together.')
+    FRAMED = args.framed
+    if args.replay:
+        args.port = recording.replay(args.replay, full_speed=args.full_speed, instruments=[]).wrap(None, 'serial')
+    else:
+        args.port = serial.Serial(port=COMPORT,baudrate=BAUD, bytesize=8,stopbits=2, timeout=TIMEOUT)
+    if args.record:
+        args.port = recording.record(args.record, instruments=[]).wrap(args.port, 'serial')
+    if args.profile:
+        profiling.enable(phases=[(phase, ['%s.%s' % (__name__, name) for name in names]) for phase, names in profiling.FPGAGEN_PHASES], dump=args.profile_dump)
+    if args.trace:
+        tracing.enable(operations=['%s.%s' % (__name__, name) for name in ('commonSetup', 'FPGA_write', 'readData', 'auto', 'write_ops', 'submit', 'collect')])
+        args.port = tracing.TracedPort(args.port)
+    args.reader = serialreader.SerialReader(args.port) if args.background else None
+    try:
+        args.func(args)
+    finally:
+        if args.reader is not None:
+            args.reader.stop()
+        if args.trace:
+            tracer = tracing.disable()
+            tracer.save(args.trace)
+            tracer.print_summary()
+        if args.profile:
+            profiling.disable().print_report()
+        if args.framed:
+            print "Framed: %i frames and %i commands sent again." % (retransmitted['frames'], retransmitted['commands'])
+        if args.record or args.replay:
+            session = recording.stop()
+        if args.replay:
+            print "Replayed %i events (%i not used, %i mismatches)." % (session.served, session.remaining(), session.errors)
\ No newline at end of file
@@ -0,0 +1,236 @@
+"""
+Bench module: runs representative workflows against the simulated
+instruments (sim.py) and reports what each one cost: wall time, simulated
+bench time, instrument transactions, bytes written and get_count calls,
+per pixel where that makes sense. The numbers can be saved as a baseline
+and later runs compared against it, so a change to sampling, driver
+batching or state caching shows up as a hard number.
+
+The S-curves are fit with scipy.optimize.leastsq if scipy is installed,
+and with pix.simple_leastsq otherwise. The committed baseline was
+recorded without scipy; the fits can differ slightly between the two,
+which moves the pixel searches that start from earlier results, so
+compare runs made with the same one.
+
+Running everything also runs pix.py --dry-run scan as a script, and
+fails if its phase report has no acquisition time, since the phases are
+only found in the running script if pix.py registers itself as pix.
+
+Usage:
+    python bench.py                       # run everything, compare to bench_baseline.json
+    python bench.py pixel column --save   # run two workflows and store them as the baseline
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import chip
+import chipimage
+import pix
+import sim
+
+# Allowed relative increase of each metric over the baseline. Wall time
+# depends on the machine, so it is only reported.
+TOLERANCES = {'sim_time': .05,
+              'transactions': .02,
+              'bytes': .02,
+              'get_count_per_pixel': .05,
+              }
+
+BASELINE = 'bench_baseline.json'
+
+
+def reset(seed=0):
+    """ Forget the chip, the State and the data generator memory, and install fresh simulated instruments. """
+    chip.image = chipimage.ChipImage.unknown()
+    chip.pattern_memory.clear()
+    state = pix.State.from_file()
+    state.grid, state.tuned, state.small_tuned, state.enabled, state.vth, state.hitor = 1, 0, 0, 0, 150, 0
+    state.flush()
+    pix.prior_store = None
+    random.seed(seed)
+    return pix.use_sim(sim.PixelModel(seed=seed))
+
+
+def tuned_library(seed=0):
+    """ A PixelLibrary with random dacs, standing in for pixels_tune_final.csv. """
+    pixels = pix.PixelLibrary()
+    pixels.data['dacs'] = np.random.RandomState(seed).randint(0, 32, pixels.data.shape)
+    return pixels
+
+
+def setup_scan(driver):
+    chip.init_hpgene(chip.hpgene, 255)
+    chip.init_hpcntr(chip.hpcntr)
+    pix.set_config(150)
+    driver.init_blocks()
+    pix.enable_hitor_chip(driver)
+
+
+# Workflows take no arguments and return the number of pixels measured.
+
+def workflow_pixel():
+    driver = chip.DgeneDriver(chip.dgene, config_size=380)
+    setup_scan(driver)
+    pix.measure_thresh(driver, chip.hpcntr, chip.hpgene, 3, 10, '00001')
+    return 1
+
+def workflow_column():
+    driver = chip.DgeneDriver(chip.dgene, config_size=380)
+    setup_scan(driver)
+    pix.write_chip_tuned(tuned_library(), driver)
+    driver.disable_all_columns()
+    pix.scan_column(3, driver, chip.hpcntr, chip.hpgene, pixels=tuned_library(), pixels_name='pixels_bench.csv')
+    return pix.PixelColumn.npix
+
+def workflow_chip():
+    driver = chip.DgeneDriver(chip.dgene, config_size=380)
+    setup_scan(driver)
+    pixels_dac = tuned_library()
+    pix.write_chip_tuned(pixels_dac, driver)
+    pix.scan_chip(driver, chip.hpcntr, chip.hpgene, pixels_name='pixels_bench.csv', pixels_dac=pixels_dac)
+    return 16 * pix.PixelColumn.npix
+
+def workflow_write_tuned():
+    pix.write_chip_tuned(tuned_library())
+    return 16 * pix.PixelColumn.npix
+
+def workflow_minimum_vth():
+    driver = chip.DgeneDriver(chip.dgene, config_size=800)
+    driver.init_blocks()
+    pix.enable_chip(driver)
+    pix.enable_hitor_chip(driver)
+    pix.find_minimum_vth(driver, 2.0, vth=150)
+    return 0
+
+WORKFLOWS = [('pixel', workflow_pixel),
+             ('column', workflow_column),
+             ('chip', workflow_chip),
+             ('write_tuned', workflow_write_tuned),
+             ('minimum_vth', workflow_minimum_vth)]
+
+
+def run_workflow(name, seed=0):
+    """ Run one workflow on fresh simulated instruments and return its metrics. """
+    simulation = reset(seed)
+    calls = [0]
+    get_count = pix.get_count
+    def counted_get_count(*args):
+        calls[0] += 1
+        return get_count(*args)
+    pix.get_count = counted_get_count
+    start = time.time()
+    try:
+        npixels = dict(WORKFLOWS)[name]()
+    finally:
+        pix.get_count = get_count
+    metrics = {'wall': time.time() - start,
+               'sim_time': simulation.clock.time(),
+               'transactions': sum((inst.stats['writes'] + inst.stats['reads'] for inst in simulation.instruments.itervalues())),
+               'bytes': sum((inst.stats['bytes'] for inst in simulation.instruments.itervalues())),
+               'get_count': calls[0],
+               'pixels': npixels}
+    if npixels:
+        metrics['get_count_per_pixel'] = float(calls[0]) / npixels
+        metrics['transactions_per_pixel'] = float(metrics['transactions']) / npixels
+    return metrics
+
+
+def dry_run_acquisition(command='scan'):
+    """ Run pix.py --dry-run command as a script, and return the time (s) its phase report puts in acquisition. """
+    script = os.path.splitext(os.path.abspath(pix.__file__))[0] + '.py'
+    output = subprocess.check_output([sys.executable, script, '--dry-run', command])
+    for line in output.splitlines():
+        fields = line.split()
+        if fields[:1] == ['acquisition']:
+            return float(fields[2])
+    return 0.0
+
+
+def compare(results, baseline, tolerances=TOLERANCES):
+    """ Return a list of (workflow, metric, value, baseline) for metrics worse than baseline by more than the tolerance. """
+    failures = []
+    for name, metrics in sorted(results.iteritems()):
+        for metric, tolerance in sorted(tolerances.iteritems()):
+            if metric not in metrics or metric not in baseline.get(name, {}):
+                continue
+            base = baseline[name][metric]
+            if metrics[metric] > base * (1 + tolerance) + 1e-9:
+                failures.append((name, metric, metrics[metric], base))
+    return failures
+
+
+def print_results(results, baseline=None):
+    columns = ['wall', 'sim_time', 'transactions', 'bytes', 'get_count', 'get_count_per_pixel', 'transactions_per_pixel']
+    print '%-12s' % 'workflow' + ''.join(('%24s' % column for column in columns))
+    for name, metrics in sorted(results.iteritems()):
+        print '%-12s' % name + ''.join(('%24.6g' % metrics[column] if column in metrics else '%24s' % '-' for column in columns))
+        if baseline and name in baseline:
+            print '%-12s' % '  baseline' + ''.join(('%24.6g' % baseline[name][column] if column in baseline[name] else '%24s' % '-' for column in columns))
+
+
+def main_command_line():
+    parser = argparse.ArgumentParser(description="Run pix.py workflows against simulated instruments and compare them to a baseline.")
+    parser.add_argument('workflows', nargs='*', help='The workflows to run: %s (default all).' % ', '.join((name for name, func in WORKFLOWS)))
+    parser.add_argument('--baseline', dest='baseline', default=BASELINE, help='The baseline file (default %s).' % BASELINE)
+    parser.add_argument('--save', dest='save', action='store_true', help='Store the results in the baseline file instead of comparing.')
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help='The seed of the simulated chip.')
+    args = parser.parse_args()
+    names = args.workflows or [name for name, func in WORKFLOWS]
+    for name in names:
+        if name not in dict(WORKFLOWS):
+            parser.error('Unknown workflow: %s' % name)
+    baseline_name = os.path.abspath(args.baseline)
+
+    # The workflows write state.dat and pixel libraries, so run them out of the way.
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='bench')
+    os.chdir(workdir)
+    try:
+        open(pix.State.fname, 'w').write('1 0 0 0 150 0\n')
+        results = {}
+        for name in names:
+            print "Running %s..." % name
+            results[name] = run_workflow(name, args.seed)
+        pix.State.from_file().flush()
+        acquisition = None
+        if not args.workflows:
+            print "Running pix.py --dry-run scan..."
+            acquisition = dry_run_acquisition('scan')
+    finally:
+        pix.State.from_file().flush()
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    baseline = {}
+    if os.path.isfile(baseline_name):
+        baseline = json.load(open(baseline_name))
+    print_results(results, None if args.save else baseline)
+    if args.save:
+        baseline.update(results)
+        json.dump(baseline, open(baseline_name, 'w'), indent=1, sort_keys=True)
+        print "Saved the baseline to %s." % baseline_name
+        return
+    failures = compare(results, baseline)
+    for name, metric, value, base in failures:
+        print "REGRESSION %s %s: %g (baseline %g)" % (name, metric, value, base)
+    if acquisition is not None:
+        print "Dry run scan acquisition: %.1f s" % acquisition
+        if acquisition <= 0:
+            print "REGRESSION the dry run of scan has no acquisition phase."
+            failures.append(('dry_run', 'acquisition', acquisition, None))
+    if failures:
+        raise SystemExit(1)
+    print "No regressions."
+
+if __name__ == "__main__":
+    main_command_line()
@@ -0,0 +1,278 @@
+"""
+Capture module: a compact binary log of the commands FPGAgen sends to
+T3MAPS and the data it reads back, in place of the '0'/'1' text files.
+Each lane of a command is packed 8 bits to a byte, readbacks (0x00/0xFF
+bytes from the FPGA) 8 to a byte, and records can be zlib compressed, so
+a capture is 8 to several hundred times smaller than the text log. The
+records are packed and written by a background thread, so logging costs
+the sender little more than putting them on a queue.
+
+File format (all numbers little endian):
+    header   'T3CAP01\\n', uint32 n, n bytes of json metadata (lanes, ...)
+    records  uint8 kind, uint8 flags, uint16 nlanes, uint32 nbits,
+             uint32 nbytes, nbytes of payload
+    index    uint64 offset of each record, then uint8 kind of each record
+    footer   uint64 offset of the index, uint64 number of records, 'T3CIDX01'
+kind is COMMAND (nlanes packed lanes of nbits, in the order of the lanes
+in the metadata), READ (one packed lane of nbits) or NOTE (text, e.g. the
+test numbers written by FPGAgen.Test_Pattern_Gcfg). flags has COMPRESSED
+if the payload is zlib compressed, and RAW if a readback had bytes other
+than 0x00 and 0xFF and is stored as it was read. A capture which was not
+closed is still read, by scanning the records.
+
+Usage:
+    python capture.py shiftData.cap                  # summary
+    python capture.py shiftData.cap --command 120    # print command 120
+    python capture.py shiftData.cap --text shiftData.txt
+"""
+
+import atexit
+import json
+import os
+import Queue
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+MAGIC = 'T3CAP01\n'
+INDEX_MAGIC = 'T3CIDX01'
+RECORD = struct.Struct('<BBHII')
+FOOTER = struct.Struct('<QQ8s')
+
+COMMAND, READ, NOTE = 0, 1, 2
+COMPRESSED, RAW = 1, 2
+
+
+def pack_bits(bits):
+    """ Pack a string of '0' and '1' characters (or a list of equally long ones) 8 bits to a byte. """
+    if isinstance(bits, basestring):
+        bits = [bits]
+    array = np.frombuffer(''.join(bits), np.uint8).reshape(len(bits), -1) - ord('0')
+    return np.packbits(array, axis=1).tostring()
+
+def unpack_bits(data, nbits, nlanes=1):
+    """ The list of nlanes strings of nbits '0' and '1' characters packed in data. """
+    array = np.unpackbits(np.frombuffer(data, np.uint8).reshape(nlanes, -1), axis=1)[:, :nbits] + ord('0')
+    return [row.tostring() for row in array]
+
+
+class CaptureWriter:
+    """ Writes a capture file from a background thread.
+
+    Notes:
+    write_command takes the lanes of a command as strings of '0' and '1',
+    in the order of lanes. write_read takes the bytes read from the FPGA,
+    and write any text, so the writer can stand in for the text files
+    (e.g. as the outfile of chip.DgeneDriver.write_blocks). At most
+    queue_size records wait to be written, so a writer which falls behind
+    slows the sender down instead of filling the memory. close writes the
+    index; it is also called at exit.
+    """
+    def __init__(self, fname, lanes=(), compress=False, metadata=None, queue_size=4096):
+        self.fname = fname
+        self.lanes = list(lanes)
+        self.compress = compress
+        self.metadata = dict(metadata or {})
+        self.metadata.update({'lanes': self.lanes, 'compress': compress})
+        self.outfile = open(fname, 'wb', 1 << 20)
+        header = json.dumps(self.metadata)
+        self.outfile.write(MAGIC + struct.pack('<I', len(header)) + header)
+        self.offsets = []
+        self.kinds = []
+        self.errors = 0
+        self.queue = Queue.Queue(queue_size)
+        self.thread = threading.Thread(target=self._run, name='capture %s' % fname)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write_command(self, lanes):
+        self.queue.put((COMMAND, lanes))
+
+    def write_read(self, data):
+        self.queue.put((READ, data))
+
+    def write(self, text):
+        self.queue.put((NOTE, text))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if item[0] is None:
+                item[1].set()
+                continue
+            try:
+                self._write_record(*item)
+            except Exception as e:
+                self.errors += 1
+                print "Capture %s: could not write a record: %s" % (self.fname, e)
+
+    def _write_record(self, kind, value):
+        flags, nlanes, nbits = 0, 1, 0
+        if kind == COMMAND:
+            nlanes, nbits = len(value), len(value[0])
+            payload = pack_bits(value)
+        elif kind == READ:
+            array = np.frombuffer(value, np.uint8)
+            nbits = len(array)
+            if ((array == 0) | (array == 255)).all():
+                payload = np.packbits(array == 255).tostring()
+            else:
+                print "Capture %s: readback has bytes other than 0x00 and 0xFF, stored raw." % self.fname
+                flags, payload = RAW, value
+        else:
+            payload = value
+        if self.compress and len(payload) > 64:
+            packed = zlib.compress(payload)
+            if len(packed) < len(payload):
+                flags, payload = flags | COMPRESSED, packed
+        self.offsets.append(self.outfile.tell())
+        self.kinds.append(kind)
+        self.outfile.write(RECORD.pack(kind, flags, nlanes, nbits, len(payload)))
+        self.outfile.write(payload)
+
+    def flush(self):
+        """ Wait until everything written so far is in the file. """
+        done = threading.Event()
+        self.queue.put((None, done))
+        done.wait()
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        index = self.outfile.tell()
+        self.outfile.write(np.array(self.offsets, '<u8').tostring())
+        self.outfile.write(np.array(self.kinds, np.uint8).tostring())
+        self.outfile.write(FOOTER.pack(index, len(self.offsets), INDEX_MAGIC))
+        self.outfile.close()
+
+
+class CaptureFile:
+    """ A capture opened for reading.
+
+    Notes:
+    command(n) and readback(n) seek straight to the nth command or
+    readback through the index, so a long capture is not read in full.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.infile = open(fname, 'rb')
+        if self.infile.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a capture' % fname)
+        size, = struct.unpack('<I', self.infile.read(4))
+        self.metadata = json.loads(self.infile.read(size))
+        self.lanes = self.metadata.get('lanes', [])
+        if not self._read_index():
+            self._scan(len(MAGIC) + 4 + size)
+
+    def _read_index(self):
+        self.infile.seek(0, os.SEEK_END)
+        end = self.infile.tell()
+        if end < FOOTER.size:
+            return False
+        self.infile.seek(end - FOOTER.size)
+        index, count, magic = FOOTER.unpack(self.infile.read(FOOTER.size))
+        if magic != INDEX_MAGIC or index + 9 * count + FOOTER.size != end:
+            return False
+        self.infile.seek(index)
+        self.offsets = np.frombuffer(self.infile.read(8 * count), '<u8')
+        self.kinds = np.frombuffer(self.infile.read(count), np.uint8)
+        return True
+
+    def _scan(self, offset):
+        # No index: walk the records, stopping at the first incomplete one.
+        self.infile.seek(0, os.SEEK_END)
+        end = self.infile.tell()
+        offsets, kinds = [], []
+        while offset + RECORD.size <= end:
+            self.infile.seek(offset)
+            kind, flags, nlanes, nbits, nbytes = RECORD.unpack(self.infile.read(RECORD.size))
+            if offset + RECORD.size + nbytes > end:
+                break
+            offsets.append(offset)
+            kinds.append(kind)
+            offset += RECORD.size + nbytes
+        self.offsets = np.array(offsets, '<u8')
+        self.kinds = np.array(kinds, np.uint8)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def count(self, kind):
+        return int((self.kinds == kind).sum())
+
+    def record(self, n):
+        """ Return (kind, value) of the nth record: a list of lanes, a readback string of '0' and '1' (or the raw bytes), or text. """
+        self.infile.seek(int(self.offsets[n]))
+        kind, flags, nlanes, nbits, nbytes = RECORD.unpack(self.infile.read(RECORD.size))
+        payload = self.infile.read(nbytes)
+        if flags & COMPRESSED:
+            payload = zlib.decompress(payload)
+        if kind == COMMAND:
+            return kind, unpack_bits(payload, nbits, nlanes)
+        if kind == READ and not flags & RAW:
+            return kind, unpack_bits(payload, nbits)[0]
+        return kind, payload
+
+    def _nth(self, kind, n):
+        return self.record(np.flatnonzero(self.kinds == kind)[n])[1]
+
+    def command(self, n):
+        """ The lanes of the nth command, as a dictionary of lane name to '0'/'1' string. """
+        return dict(zip(self.lanes, self._nth(COMMAND, n)))
+
+    def readback(self, n):
+        return self._nth(READ, n)
+
+    def to_text(self, outfile):
+        """ Write the capture out as the text file FPGAgen would have written. """
+        for n in xrange(len(self)):
+            kind, value = self.record(n)
+            if kind == COMMAND:
+                for name, bits in zip(self.lanes, value):
+                    outfile.write(name + "\n")
+                    outfile.write(bits + "\n")
+            elif kind == READ:
+                outfile.write(value + "\n")
+            else:
+                outfile.write(value)
+
+    def print_summary(self):
+        print "%s: %i commands, %i readbacks, %i notes, %i bytes" % (self.fname, self.count(COMMAND), self.count(READ), self.count(NOTE), os.path.getsize(self.fname))
+
+    def close(self):
+        self.infile.close()
+
+
+def main_command_line():
+    import argparse
+    parser = argparse.ArgumentParser(description="Read a capture written by FPGAgen.py --capture.")
+    parser.add_argument('fname', help='The capture file.')
+    parser.add_argument('--command', dest='command', type=int, help='Print the lanes of this command (counting from 0).')
+    parser.add_argument('--read', dest='read', type=int, help='Print this readback (counting from 0).')
+    parser.add_argument('--text', dest='text', help='Convert the capture to the text format, in this file.')
+    args = parser.parse_args()
+    capture = CaptureFile(args.fname)
+    if args.command is not None:
+        lanes = capture.command(args.command)
+        for name in capture.lanes:
+            print name
+            print lanes[name]
+    elif args.read is not None:
+        print capture.readback(args.read)
+    elif args.text:
+        outfile = open(args.text, 'w')
+        capture.to_text(outfile)
+        outfile.close()
+    else:
+        capture.print_summary()
+
+if __name__ == "__main__":
+    main_command_line()
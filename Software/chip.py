@@ -6,8 +6,11 @@ functions to generate the binary sequences of common control patterns.
 """
 
 #import visa
+import atexit
 from copy import deepcopy
 
+import chipimage
+
 
 ###############################################################################
 # ChipCnfg Constants
@@ -191,12 +194,27 @@ def get_control_pattern(global_readout_enable='0', count_hits_not='0', count_ena
     return global_readout_enable + SRDO_load + NCout2 + count_hits_not + count_enable + count_clear_not + S0 + S1 + config_mode + LD_IN0_7 + LDENABLE_SEL + SRCLR_SEL + HITLD_IN + NCout21_25 + column_address
 
 class Writer:
-    def __init__(self, filename):
+    """ Appends to filename, e.g. as the outfile of DgeneDriver.write_blocks.
+
+    Notes:
+    The file is opened once and buffered, and closed at exit; call flush
+    to see what was written so far. A capture.CaptureWriter can be used
+    instead, to log from a background thread.
+    """
+    def __init__(self, filename, buffering=1 << 16):
         self.filename = filename
+        self.file = open(filename, 'a', buffering)
+        atexit.register(self.close)
 
     def write(self, s):
-        with open(self.filename, 'a') as f:
-            f.write(s)
+        self.file.write(s)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
 
 
 class DgeneDriver:
@@ -236,6 +254,7 @@ class DgeneDriver:
         sorted_keys.append('ENDBLK')
         self.all_block_size = sum(self.blocks.values())
         # Create the blocks
+        pattern_memory.clear()
         self.dgene.write(":DATA:BLOC:DEL:ALL")
         self.dgene.write(":DATA:BLOC:RENAME \"UNNAMED\",\"STRTBLK\"")
         self.dgene.write(":DATA:BLOC:SIZE \"STRTBLK\",%i" % self.all_block_size)
@@ -264,6 +283,7 @@ class DgeneDriver:
         long as they are all done using the pix.py/chip.py framework.
         """
         self.n = 1
+        pattern_memory.clear()
         CreateBlocs(self.dgene)
         initSeqs(self.dgene)
         self.dgene.write(":MODE:UPDate MAN")
@@ -273,6 +293,7 @@ class DgeneDriver:
         self.dgene.write(':DATA:PATT:BIT %i,0,%i,#%i%i%s\n' % (InputSignalsPodsDict['SlAltBus'][2], self.all_block_size, len(str(self.all_block_size)), self.all_block_size, '1'*self.all_block_size))
         self.dgene.write(':DATA:UPDate')
         self._n_enabled = 1;
+        image.forget()
 
     def write_blocks(self, commands, outfile=None):
         """ Write the commands contained in commands.
@@ -281,6 +302,9 @@ class DgeneDriver:
         separate command. Each dictionary key is the channel to write to and
         each value is a list of blocks to write. The list of blocks are written
         in as few commands as possible given the current setup.
+        A channel whose pattern is already in the data generator memory (see
+        pattern_memory) is not sent again, so repeating a command only costs
+        the trigger.
         """
         for command in commands:
             instructions = []
@@ -297,9 +321,13 @@ class DgeneDriver:
                     if len(instructions) < i + 1:
                         instructions.append([])
                     output = ':DATA:PATT:BIT %i,0,%i,#%i%i%s\n' % (InputSignalsPodsDict[key][2], self.all_block_size, len(str(self.all_block_size)), self.all_block_size, subcommand)
-                    instructions[i].append(output)
-            for instruction in instructions:
-                instruction.insert(0,'MODE:UPDate MAN')
+                    instructions[i].append((key, subcommand, output))
+            for patterns in instructions:
+                instruction = ['MODE:UPDate MAN']
+                for key, subcommand, output in patterns:
+                    if pattern_memory.get(key) != subcommand:
+                        instruction.append(output)
+                        pattern_memory[key] = subcommand
                 instruction.append('DATA:UPDate')
                 instruction.append('*TRG')
                 if outfile is not None:
@@ -348,7 +376,12 @@ class DgeneDriver:
             print "Invalid pattern length for program_column (should be %i). Appending zeroes." % MAXROWS
             pattern += '0'*(MAXROWS - len(pattern))
 
-        colSreg=pattern[::-1]
+        return self._gen_shift_command(pattern[::-1], clone)
+
+    def _gen_shift_command(self, bits, clone=True):
+        # Generate a command which shifts bits (in the order given) into the column sr.
+        # The first entry is the actual command and second entry is a zeroing command.
+        colSreg=bits
         SregData=repeat_each(colSreg,ClkUnitDuration)
         SregPat='0'*(CNFGSIZE0*ClkUnitDuration)+SregData+'0'*(self.config_size-(CNFGSIZE0*ClkUnitDuration)-len(SregData))
         SregPat=shift_right(SregPat)
@@ -387,6 +420,11 @@ class DgeneDriver:
         else:
             commands = [command]
         self.write_blocks(commands)
+        if load_control and load_config and len(pattern) == chipimage.NGLOBAL:
+            image.global_register = pattern
+        else:
+            image.global_register = None
+        image.pointer = None
         return
 
     def program_column(self, pattern, clone=True):
@@ -394,29 +432,134 @@ class DgeneDriver:
         commands = self._gen_column_command(pattern, clone)
         # don't write the zero command
         self.write_blocks(commands[:-1])
+        image.column_register = pattern
         return
 
     def readout_single_pixel(self, row, clone=True):
         """ Set the column SR to readout the specified pixel. """
         self.program_column(''.join(['0' if i != row else '1' for i in xrange(MAXROWS)]))
 
-    def enable_single_pixel(self, col, row, dacbits='00000', zero=False, **kwargs):
-        """ Enable a single pixel to inject charge and output on hitOr. """
-        ldbus = '011' + dacbits # enable hit, inject, and dacbit pattern
+    def write_latches(self, col, pattern, ldbus, config_mode='00', zero=False, **kwargs):
+        """ Load a 64 bit column pattern into the pixel latches selected by ldbus.
+
+        Notes:
+        This is the sequence behind every pixel command: point the config
+        register at col, shift pattern into the column register, load it
+        into the latches selected by the 8 ldbus bits (hit_or_not, hit,
+        inject, tdac0-4) and return the load enable to zero. With
+        config_mode '11' the load goes to every column. Extra keyword
+        arguments are control settings kept in the config register.
+        The load is recorded in chip.image.
+        """
+        command, zero_command = self._gen_latch_command(col, pattern, ldbus, config_mode, **kwargs)
+        if zero:
+            commands = [command, zero_command]
+        else:
+            commands = [command]
+        self.write_blocks(commands)
+        image.load_latches(col, pattern, ldbus, config_mode)
+        image.pointer = (col, config_mode, tuple(sorted(kwargs.iteritems())))
+        return
+
+    def step_single_pixel(self, col, row, zero=False, **kwargs):
+        """ Enable a single pixel, as enable_single_pixel does, reusing the column register.
+
+        Notes:
+        If the config register still points at col (with the same kwargs)
+        and the column register holds a pattern which becomes the single
+        pixel at row when shifted down by k rows, only k zeros are shifted
+        in before hit/inject are loaded. The same load disables the
+        previous pixel and enables the new one. Stepping down a column one
+        row at a time (as scan_column does) sends the same command every
+        time, so after the first step write_blocks only has to retrigger.
+        Otherwise this is enable_single_pixel.
+        """
+        ldbus = '01100000'
         pix_pattern = ''.join(['0' if i != row else '1' for i in xrange(MAXROWS)])
+        current = image.column_register
+        shift = None
+        if image.pointer == (col, '00', tuple(sorted(kwargs.iteritems()))) and current is not None:
+            for k in xrange(MAXROWS):
+                if '0'*k + current[:MAXROWS-k] == pix_pattern:
+                    shift = k
+                    break
+        if shift is None:
+            self.enable_single_pixel(col, row, zero=zero, **kwargs)
+            return
         load_pattern = get_control_pattern_pixel(col,config_bits=ldbus,lden='1')[::-1] 
         def_pattern = get_control_pattern_pixel(col, **kwargs)[::-1]
-    
-        instr1, zero_config = self._gen_config_command(def_pattern, False, True) # point sr to correct column 
-        instr2, zero_column = self._gen_column_command(pix_pattern, col)         # program the column sr      
-        instr3 = self._gen_config_command(load_pattern, False, True)[0]          # load the ldbus pattern     
-        instr4 = self._gen_config_command(def_pattern, False, True)[0]           # return load to zero        
-        
+        instrs = []
+        zeros = []
+        if shift:
+            instr, zero_column = self._gen_shift_command('0'*shift, col) # shift the column sr down 
+            instrs.append(instr)
+            zeros.append(zero_column)
+        instr, zero_config = self._gen_config_command(load_pattern, False, True)  # load the ldbus pattern     
+        instrs += [instr, self._gen_config_command(def_pattern, False, True)[0]] # return load to zero        
+        zeros.append(zero_config)
         if zero:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4), self._combine_commands(zero_config,zero_column)]
+            commands = [self._combine_commands(*instrs), self._combine_commands(*zeros)]
         else:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4)]
+            commands = [self._combine_commands(*instrs)]
         self.write_blocks(commands)
+        image.load_latches(col, pix_pattern, ldbus)
+        image.pointer = (col, '00', tuple(sorted(kwargs.iteritems())))
+        return
+
+    def _gen_latch_command(self, col, pattern, ldbus, config_mode='00', **kwargs):
+        # Generate the four instructions of write_latches as a single command.
+        # First entry is the actual command and second entry is a zeroing command.
+        load_pattern = get_control_pattern_pixel(col,config_bits=ldbus,lden='1',config_mode=config_mode)[::-1] 
+        def_pattern = get_control_pattern_pixel(col, config_mode=config_mode, **kwargs)[::-1]
+        instr1, zero_config = self._gen_config_command(def_pattern, False, True) # point sr to correct column 
+        instr2, zero_column = self._gen_column_command(pattern, col)             # program the column sr      
+        instr3 = self._gen_config_command(load_pattern, False, True)[0]          # load the ldbus pattern     
+        instr4 = self._gen_config_command(def_pattern, False, True)[0]           # return load to zero        
+        return self._combine_commands(instr1,instr2,instr3,instr4), self._combine_commands(zero_config,zero_column)
+
+    def write_latch_batch(self, loads):
+        """ Send a list of chipimage.LatchLoads as one command.
+
+        Notes:
+        The instructions of all of the loads are sent back to back, so they
+        fill every config block of a trigger rather than one trigger per
+        load. A driver set up with a larger number_instructions (e.g. 16)
+        needs correspondingly fewer triggers.
+        """
+        if not loads:
+            return
+        commands = [self._gen_latch_command(load.col, load.pattern, load.ldbus, load.config_mode)[0] for load in loads]
+        self.write_blocks([self._combine_commands(*commands)])
+        for load in loads:
+            image.apply(load)
+        image.pointer = (loads[-1].col, loads[-1].config_mode, ())
+        return
+
+    def apply_ops(self, ops):
+        """ Send a list of chipimage operations, e.g. from chipimage.compile_diff. 
+
+        Notes:
+        Consecutive latch loads are batched with write_latch_batch.
+        """
+        loads = []
+        for op in ops:
+            if isinstance(op, chipimage.LatchLoad):
+                loads.append(op)
+                continue
+            self.write_latch_batch(loads)
+            loads = []
+            if self.config_size < 800:
+                print "The configuration size for the driver is too small to program the config."
+                raise ValueError
+            self.program_config(op.pattern, zero=False)
+        self.write_latch_batch(loads)
+        return
+
+    def enable_single_pixel(self, col, row, dacbits='00000', zero=False, **kwargs):
+        """ Enable a single pixel to inject charge and output on hitOr. """
+        ldbus = '011' + dacbits # enable hit, inject, and dacbit pattern
+        pix_pattern = ''.join(['0' if i != row else '1' for i in xrange(MAXROWS)])
+        self.write_latches(col, pix_pattern, ldbus, zero=zero, **kwargs)
         return
 
 
@@ -425,180 +568,70 @@ class DgeneDriver:
         dacbits = ''.join(('1' if x == dacindex else '0' for x in xrange(5)))
         ldbus = '000' + dacbits 
         pix_pattern = pattern
-        load_pattern = get_control_pattern_pixel(col,config_bits=ldbus,lden='1')[::-1] 
-        def_pattern = get_control_pattern_pixel(col)[::-1]
-        instr1, zero_config = self._gen_config_command(def_pattern, False, True) # point sr to correct column 
-        instr2, zero_column = self._gen_column_command(pix_pattern, col)         # program the column sr      
-        instr3 = self._gen_config_command(load_pattern, False, True)[0]          # load the ldbus pattern     
-        instr4 = self._gen_config_command(def_pattern, False, True)[0]           # return load to zero        
-        
-        if zero:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4), self._combine_commands(zero_config,zero_column)]
-        else:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4)]
-        self.write_blocks(commands)
+        self.write_latches(col, pix_pattern, ldbus, zero=zero)
         return
 
     def clear_single_column(self, col, zero=False):
         """ Set all bits to zero for every pixel on column. """
         ldbus = '11111111' # load all to write zero to all
         pix_pattern = ''.join(['0' for i in xrange(MAXROWS)])
-        load_pattern = get_control_pattern_pixel(col,config_bits=ldbus,lden='1')[::-1] 
-        def_pattern = get_control_pattern_pixel(col)[::-1]
-        instr1, zero_config = self._gen_config_command(def_pattern, False, True) # point sr to correct column 
-        instr2, zero_column = self._gen_column_command(pix_pattern, col)         # program the column sr      
-        instr3 = self._gen_config_command(load_pattern, False, True)[0]          # load the ldbus pattern     
-        instr4 = self._gen_config_command(def_pattern, False, True)[0]           # return load to zero        
-        
-        if zero:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4), self._combine_commands(zero_config,zero_column)]
-        else:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4)]
-        self.write_blocks(commands)
+        self.write_latches(col, pix_pattern, ldbus, zero=zero)
         return
 
     def clear_all_columns(self, zero=False):
         """ Set all bits to zero for every pixel. """
         ldbus = '11111111' # load all to write zero to all
         pix_pattern = ''.join(['0' for i in xrange(MAXROWS)])
-        load_pattern = get_control_pattern_pixel(0,config_bits=ldbus,lden='1',config_mode='11')[::-1] 
-        def_pattern = get_control_pattern_pixel(0, config_mode='11')[::-1]
-        instr1, zero_config = self._gen_config_command(def_pattern, False, True) # point sr to correct column 
-        instr2, zero_column = self._gen_column_command(pix_pattern, 0)         # program the column sr      
-        instr3 = self._gen_config_command(load_pattern, False, True)[0]          # load the ldbus pattern     
-        instr4 = self._gen_config_command(def_pattern, False, True)[0]           # return load to zero        
-        
-        if zero:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4), self._combine_commands(zero_config,zero_column)]
-        else:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4)]
-        self.write_blocks(commands)
+        self.write_latches(0, pix_pattern, ldbus, config_mode='11', zero=zero)
         return
 
     def disable_single_column(self, col, zero=False):
         """ Disable hit/inject on every pixel on the column. """
         ldbus = '01100000' # write zeroes to hit, inject
         pix_pattern = ''.join(['0' for i in xrange(MAXROWS)])
-        load_pattern = get_control_pattern_pixel(col,config_bits=ldbus,lden='1')[::-1] 
-        def_pattern = get_control_pattern_pixel(col)[::-1]
-        instr1, zero_config = self._gen_config_command(def_pattern, False, True) # point sr to correct column 
-        instr2, zero_column = self._gen_column_command(pix_pattern, col)         # program the column sr      
-        instr3 = self._gen_config_command(load_pattern, False, True)[0]          # load the ldbus pattern     
-        instr4 = self._gen_config_command(def_pattern, False, True)[0]           # return load to zero        
-        
-        if zero:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4), self._combine_commands(zero_config,zero_column)]
-        else:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4)]
-        self.write_blocks(commands)
+        self.write_latches(col, pix_pattern, ldbus, zero=zero)
         return
 
     def disable_all_columns(self, zero=False):
         """ Disable hit/inject on every pixel. """
         ldbus = '01100000' # write zeroes to hit, inject
         pix_pattern = ''.join(['0' for i in xrange(MAXROWS)])
-        load_pattern = get_control_pattern_pixel(0,config_bits=ldbus,lden='1',config_mode='11')[::-1] 
-        def_pattern = get_control_pattern_pixel(0, config_mode='11')[::-1]
-        instr1, zero_config = self._gen_config_command(def_pattern, False, True) # point sr to correct column 
-        instr2, zero_column = self._gen_column_command(pix_pattern, 0)         # program the column sr      
-        instr3 = self._gen_config_command(load_pattern, False, True)[0]          # load the ldbus pattern     
-        instr4 = self._gen_config_command(def_pattern, False, True)[0]           # return load to zero        
-        
-        if zero:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4), self._combine_commands(zero_config,zero_column)]
-        else:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4)]
-        self.write_blocks(commands)
+        self.write_latches(0, pix_pattern, ldbus, config_mode='11', zero=zero)
         return
 
     def disable_hitor_all_columns(self, zero=False):
         """ Disable hit/inject on every pixel. """
         ldbus = '10000000' # write 1 to hit_or_not
         pix_pattern = ''.join(['1' for i in xrange(MAXROWS)])
-        load_pattern = get_control_pattern_pixel(0,config_bits=ldbus,lden='1',config_mode='11')[::-1] 
-        def_pattern = get_control_pattern_pixel(0, config_mode='11')[::-1]
-        instr1, zero_config = self._gen_config_command(def_pattern, False, True) # point sr to correct column 
-        instr2, zero_column = self._gen_column_command(pix_pattern, 0)         # program the column sr
-        instr3 = self._gen_config_command(load_pattern, False, True)[0]          # load the ldbus pattern     
-        instr4 = self._gen_config_command(def_pattern, False, True)[0]           # return load to zero        
-        
-        if zero:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4), self._combine_commands(zero_config,zero_column)]
-        else:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4)]
-        self.write_blocks(commands)
+        self.write_latches(0, pix_pattern, ldbus, config_mode='11', zero=zero)
         return
 
     def enable_hitor_all_columns(self, zero=False):
         """ Disable hit/inject on every pixel. """
         ldbus = '10000000' # write 0 to hit_or_not
         pix_pattern = ''.join(['0' for i in xrange(MAXROWS)])
-        load_pattern = get_control_pattern_pixel(0,config_bits=ldbus,lden='1',config_mode='11')[::-1] 
-        def_pattern = get_control_pattern_pixel(0, config_mode='11')[::-1]
-        instr1, zero_config = self._gen_config_command(def_pattern, False, True) # point sr to correct column 
-        instr2, zero_column = self._gen_column_command(pix_pattern, 0)         # program the column sr      
-        instr3 = self._gen_config_command(load_pattern, False, True)[0]          # load the ldbus pattern     
-        instr4 = self._gen_config_command(def_pattern, False, True)[0]           # return load to zero        
-        
-        if zero:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4), self._combine_commands(zero_config,zero_column)]
-        else:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4)]
-        self.write_blocks(commands)
+        self.write_latches(0, pix_pattern, ldbus, config_mode='11', zero=zero)
         return
 
     def enable_single_column(self, col, dacbits='00000', zero=False):
         """ Enable a single column to inject charge and output on hitOr. """
         ldbus = '011' + dacbits # enable hit, inject
         pix_pattern = ''.join(['1' for i in xrange(MAXROWS)]) # enable all pixels
-        load_pattern = get_control_pattern_pixel(col,config_bits=ldbus,lden='1')[::-1] 
-        def_pattern = get_control_pattern_pixel(col)[::-1]
-        instr1, zero_config = self._gen_config_command(def_pattern, False, True) # point sr to correct column 
-        instr2, zero_column = self._gen_column_command(pix_pattern, col)         # program the column sr      
-        instr3 = self._gen_config_command(load_pattern, False, True)[0]          # load the ldbus pattern     
-        instr4 = self._gen_config_command(def_pattern, False, True)[0]           # return load to zero        
-        
-        if zero:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4), self._combine_commands(zero_config,zero_column)]
-        else:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4)]
-        self.write_blocks(commands)
+        self.write_latches(col, pix_pattern, ldbus, zero=zero)
         return
 
     def enable_hitor_single_column(self, col, zero=False):
         """ Enable a single column to inject charge and output on hitOr. """
         ldbus = '10000000'# enable hit, inject
         pix_pattern = ''.join(['0' for i in xrange(MAXROWS)]) # enable hitor pixels
-        load_pattern = get_control_pattern_pixel(col,config_bits=ldbus,lden='1')[::-1] 
-        def_pattern = get_control_pattern_pixel(col)[::-1]
-        instr1, zero_config = self._gen_config_command(def_pattern, False, True) # point sr to correct column 
-        instr2, zero_column = self._gen_column_command(pix_pattern, col)         # program the column sr      
-        instr3 = self._gen_config_command(load_pattern, False, True)[0]          # load the ldbus pattern     
-        instr4 = self._gen_config_command(def_pattern, False, True)[0]           # return load to zero        
-        
-        if zero:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4), self._combine_commands(zero_config,zero_column)]
-        else:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4)]
-        self.write_blocks(commands)
+        self.write_latches(col, pix_pattern, ldbus, zero=zero)
         return
 
     def enable_hitor_single_pixel(self, col, row, zero=False):
         """ Enable a single column to inject charge and output on hitOr. """
         ldbus = '10000000'# enable hit, inject
         pix_pattern = ''.join(['1' if i != row else '0' for i in xrange(MAXROWS)])
-        load_pattern = get_control_pattern_pixel(col,config_bits=ldbus,lden='1')[::-1] 
-        def_pattern = get_control_pattern_pixel(col)[::-1]
-        instr1, zero_config = self._gen_config_command(def_pattern, False, True) # point sr to correct column 
-        instr2, zero_column = self._gen_column_command(pix_pattern, col)         # program the column sr      
-        instr3 = self._gen_config_command(load_pattern, False, True)[0]          # load the ldbus pattern     
-        instr4 = self._gen_config_command(def_pattern, False, True)[0]           # return load to zero        
-        
-        if zero:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4), self._combine_commands(zero_config,zero_column)]
-        else:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4)]
-        self.write_blocks(commands)
+        self.write_latches(col, pix_pattern, ldbus, zero=zero)
         return
 
     def enable_all_columns(self, dacbits='00000', zero=False):
@@ -609,18 +642,7 @@ class DgeneDriver:
         """
         ldbus = '011' + dacbits # enable hit, inject
         pix_pattern = ''.join(['1' for i in xrange(MAXROWS)]) # enable all pixels
-        load_pattern = get_control_pattern_pixel(0,config_bits=ldbus,lden='1',config_mode='11')[::-1] 
-        def_pattern = get_control_pattern_pixel(0, config_mode='11')[::-1]
-        instr1, zero_config = self._gen_config_command(def_pattern, False, True) # point sr to correct column 
-        instr2, zero_column = self._gen_column_command(pix_pattern, 0)         # program the column sr      
-        instr3 = self._gen_config_command(load_pattern, False, True)[0]          # load the ldbus pattern     
-        instr4 = self._gen_config_command(def_pattern, False, True)[0]           # return load to zero        
-        
-        if zero:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4), self._combine_commands(zero_config,zero_column)]
-        else:
-            commands = [self._combine_commands(instr1,instr2,instr3,instr4)]
-        self.write_blocks(commands)
+        self.write_latches(0, pix_pattern, ldbus, config_mode='11', zero=zero)
         return
 
     def enable_count_clock(self, freq=50):
@@ -650,17 +672,28 @@ class DgeneDriver:
         if freq < 1:
             self.dgene.write(':SOURCE:OSCILLATOR:INTERNAL:FREQUENCY %iKHZ' % (4*1000*freq))
         self.dgene.write(':DATA:PATT:BIT %i,0,%i,#%i%i%s\n' % (InputSignalsPodsDict['CntCK'][2], self.all_block_size, len(str(self.all_block_size)), self.all_block_size, clock_pattern))        
+        pattern_memory['CntCK'] = clock_pattern
         return
 
     def disable_count_clock(self):
         """ Disable the external counting clock."""
         clock_pattern_disable = '0' * self.all_block_size
         self.dgene.write(':DATA:PATT:BIT %i,0,%i,#%i%i%s\n' % (InputSignalsPodsDict['CntCK'][2], self.all_block_size, len(str(self.all_block_size)), self.all_block_size, clock_pattern_disable))        
+        pattern_memory['CntCK'] = clock_pattern_disable
         self.dgene.write(':SOURCE:OSCILLATOR:INTERNAL:FREQUENCY 200MHZ' )
         return
 
 # End of class Driver
 
+# What is currently programmed on the chip, as far as this process knows.
+# Every DgeneDriver write updates it; see chipimage.compile_diff.
+image = chipimage.ChipImage.unknown()
+
+# The pattern of each channel as it is in the data generator memory, as
+# last written by a DgeneDriver. It is cleared whenever the blocks are
+# set up again, since the memory is then rewritten.
+pattern_memory = {}
+
 
 ###############################################################################
 # GPIB Class and Initializations
@@ -680,55 +713,145 @@ GpibInstDict={"TDS754":"1","DG2020":"3","HPPSUPLY":"6","HPLA":"7","HPGENE":"5","
        #     return False
 
         
+class ShadowInstrument:
+    """ Wraps a GPIB instrument and remembers the last value written to each setting.
+
+    Notes:
+    settings is the list of command headers (e.g. 'VOLT', 'BM:NCYC') which
+    set a value that stays until it is changed. Writing one of them with
+    the value it already has is skipped. Everything else (triggers,
+    queries, gates) is always sent. The state is unknown until *RST is
+    written, and again after forget (e.g. if the instrument was touched by
+    hand), and while it is unknown every setting is sent.
+    read, finished and anything else go straight to the instrument.
+    """
+    def __init__(self, inst, settings):
+        self.inst = inst
+        self.settings = set(_setting_key(header) for header in settings)
+        self.values = None
+
+    def __getattr__(self, name):
+        return getattr(self.inst, name)
+
+    def known(self):
+        return self.values is not None
+
+    def forget(self):
+        self.values = None
+
+    def changed(self, command):
+        """ False if command sets a setting to the value it already has. """
+        key, value = _split_command(command)
+        return self.values is None or key not in self.settings or self.values.get(key) != value
+
+    def write(self, command):
+        key, value = _split_command(command)
+        if key in self.settings and not self.changed(command):
+            return
+        self.inst.write(command)
+        if key == '*RST':
+            self.values = {}
+        elif key in self.settings and self.values is not None:
+            self.values[key] = value
+
+
+def _setting_key(header):
+    return header.strip().lstrip(':').upper()
+
+def _split_command(command):
+    # 'VOLT 0.200000' -> ('VOLT', 0.2), ':INP1:COUP DC' -> ('INP1:COUP', 'DC')
+    parts = command.strip().split(None, 1)
+    value = parts[1].strip() if len(parts) > 1 else ''
+    try:
+        value = float(value)
+    except ValueError:
+        value = value.upper()
+    return _setting_key(parts[0]), value
+
+
+HPGENE_SETTINGS = ['FUNC:USER', 'FUNC:SHAP', 'VOLT', 'VOLT:OFFSET', 'OUTPUT:LOAD', 'TRIGGER:SOURCE', 'BM:SOURCE', 'BM:NCYC', 'FREQ', 'BM:STATE']
+HPCNTR_SETTINGS = ['CONF:TOT:CONT', 'INP1:COUP', 'INP1:IMP', 'INP:LEV:AUTO', 'INP:LEV', 'INP1:SLOP', 'INP1:ATT', 'SENS:ACQ:HOFF:STAT', 'SENS:ACQ:HOFF:TIME']
+
+
+def needs_reset(inst):
+    """ True unless inst is a ShadowInstrument which knows its state. """
+    return not (isinstance(inst, ShadowInstrument) and inst.known())
+
+def write_setting(inst, command, wait=False):
+    """ Write a setting, unless a ShadowInstrument knows it is already set. Waits for the instrument only if it was sent. """
+    if isinstance(inst, ShadowInstrument) and not inst.changed(command):
+        return
+    inst.write(command)
+    if wait:
+        while not inst.finished(): pass
+
+        
 def init_hpgene(hpgene, ninjects=255):
-    hpgene.write("*RST")
-    hpgene.write("*CLS")
-    hpgene.write("*ESE 1")
-    hpgene.write("*SRE 16")
-    hpgene.write("*OPC")
-    while hpgene.finished() is False: pass
+    """ Set up the pulse generator to send bursts of ninjects pulses on *TRG.
+
+    Notes:
+    If hpgene is a ShadowInstrument which knows its state, it is not reset
+    and only the settings which differ are sent.
+    """
+    if needs_reset(hpgene):
+        hpgene.write("*RST")
+        hpgene.write("*CLS")
+        hpgene.write("*ESE 1")
+        hpgene.write("*SRE 16")
+        hpgene.write("*OPC")
+        while hpgene.finished() is False: pass
 
-    hpgene.write("FUNC:USER NRAMP")
-    while not hpgene.finished() : pass
+    write_setting(hpgene, "FUNC:USER NRAMP", wait=True)
 
-    hpgene.write("FUNC:SHAP USER")
-    while not hpgene.finished() : pass
+    write_setting(hpgene, "FUNC:SHAP USER", wait=True)
 
-    hpgene.write("VOLT 0.2")
-    hpgene.write("VOLT:OFFSet 0.0")
+    write_setting(hpgene, "VOLT 0.2")
+    write_setting(hpgene, "VOLT:OFFSet 0.0")
 
-    hpgene.write("OUTPut:LOAD 50")
+    write_setting(hpgene, "OUTPut:LOAD 50")
 
-    hpgene.write("TRIGger:SOURce BUS")
+    write_setting(hpgene, "TRIGger:SOURce BUS")
 
-    hpgene.write("BM:SOURce INT")
+    write_setting(hpgene, "BM:SOURce INT")
 
-    hpgene.write("BM:NCYC %i" % ninjects)
-    hpgene.write("FREQ 10000")
-    hpgene.write("BM:STATe ON")
+    write_setting(hpgene, "BM:NCYC %i" % ninjects)
+    write_setting(hpgene, "FREQ 10000")
+    write_setting(hpgene, "BM:STATe ON")
+    return
+
+def set_hpgene_injects(hpgene, ninjects):
+    """ Change the number of injections per trigger, leaving the rest of init_hpgene. """
+    write_setting(hpgene, "BM:NCYC %i" % ninjects)
     return
 
 def init_hpcntr(hpcntr):
-    hpcntr.write("*RST");
-    hpcntr.write("*CLS");
-    hpcntr.write("*OPC");
+    """ Set up the counter to totalize on channel 1.
+
+    Notes:
+    As in init_hpgene, a ShadowInstrument which knows its state is not
+    reset and only the settings which differ are sent.
+    """
+    if needs_reset(hpcntr):
+        hpcntr.write("*RST");
+        hpcntr.write("*CLS");
+        hpcntr.write("*OPC");
     
-    hpcntr.write(":CONF:TOT:CONT (@1),(@1)")
+    write_setting(hpcntr, ":CONF:TOT:CONT (@1),(@1)")
     hpcntr.write(":INIT:CONT OFF")
 
-    hpcntr.write(":INP1:COUP DC")
-    hpcntr.write(":INP1:IMP MAX")
+    write_setting(hpcntr, ":INP1:COUP DC")
+    write_setting(hpcntr, ":INP1:IMP MAX")
 
-    hpcntr.write(":INP:LEV:AUTO 0")
-    hpcntr.write(":INP:LEV 0.5")
+    write_setting(hpcntr, ":INP:LEV:AUTO 0")
+    write_setting(hpcntr, ":INP:LEV 0.5")
 
-    hpcntr.write(":INP1:SLOP NEG")
-    hpcntr.write(":INP1:ATT 1")
+    write_setting(hpcntr, ":INP1:SLOP NEG")
+    write_setting(hpcntr, ":INP1:ATT 1")
 
-    hpcntr.write(":SENS:ACQ:HOFF:STAT ON")
-    hpcntr.write(":SENS:ACQ:HOFF:TIME 10e-6")
+    write_setting(hpcntr, ":SENS:ACQ:HOFF:STAT ON")
+    write_setting(hpcntr, ":SENS:ACQ:HOFF:TIME 10e-6")
     return
 
 #dgene=GpibInst("DG2020")
-#hpgene=GpibInst("HPGENE")
-#hpcntr=GpibInst("HPCNTR")
+#hpgene=ShadowInstrument(GpibInst("HPGENE"), HPGENE_SETTINGS)
+#hpcntr=ShadowInstrument(GpibInst("HPCNTR"), HPCNTR_SETTINGS)
@@ -0,0 +1,246 @@
+"""
+Chip image module: a complete record of what is programmed on the chip
+(every latch of every pixel, plus the 176 bit global configuration
+register), and a compiler which turns the difference between two images
+into a short list of latch loads. Both chip.DgeneDriver and FPGAgen can
+send that list, so a change of setup only writes what actually changed.
+"""
+
+NCOLS = 18
+MAXROWS = 64
+NGLOBAL = 176
+
+# The pixel latches, in the order of the 8 ldbus bits (LD_IN0_7).
+# Note hit_or_not is inverted: a 0 enables the hitOr of the pixel.
+LATCHES = ['hit_or_not', 'hit', 'inject', 'tdac0', 'tdac1', 'tdac2', 'tdac3', 'tdac4']
+
+
+def ldbus_string(latches):
+    """ Return the 8 bit ldbus pattern which loads the named latches. """
+    return ''.join(('1' if name in latches else '0' for name in LATCHES))
+
+
+def ldbus_latches(ldbus):
+    """ Return the names of the latches loaded by an 8 bit ldbus pattern. """
+    return [name for name, bit in zip(LATCHES, ldbus) if bit == '1']
+
+
+class LatchLoad:
+    """ Load a 64 bit column pattern into the latches selected by ldbus.
+
+    If broadcast is True, the load goes to every column (config_mode '11'),
+    otherwise only to col.
+    """
+    def __init__(self, col, pattern, ldbus, broadcast=False):
+        self.col = col
+        self.pattern = pattern
+        self.ldbus = ldbus
+        self.broadcast = broadcast
+
+    @property
+    def config_mode(self):
+        return '11' if self.broadcast else '00'
+
+    def __repr__(self):
+        target = 'all' if self.broadcast else 'col %i' % self.col
+        return '<LatchLoad %s %s %s>' % (target, ','.join(ldbus_latches(self.ldbus)), self.pattern)
+
+
+class ConfigLoad:
+    """ Shift the 176 bit pattern into the global register and load all of it. """
+    def __init__(self, pattern):
+        self.pattern = pattern
+
+    def __repr__(self):
+        return '<ConfigLoad %s>' % self.pattern
+
+
+class ChipImage:
+    """ The value of every latch on the chip.
+
+    Notes:
+    planes[latch][col] is a 64 character '0'/'1' string, indexed by row,
+    or None if that bit-plane of the column is not known. global_register
+    is the 176 bit pattern as it is shifted into the configuration register
+    (the same string given to DgeneDriver.program_config), or None if not
+    known. In a desired image, None means "don't care".
+    The image also follows the shift registers which the latches are
+    loaded from: column_register is the 64 bit pattern in the column
+    register (indexed by row), and pointer is (col, config_mode, settings)
+    for the control part of the config register as left by a latch load,
+    where settings are the extra control settings. Either is None if not
+    known.
+    """
+    def __init__(self, ncols=NCOLS):
+        self.ncols = ncols
+        self.planes = dict((latch, [None]*ncols) for latch in LATCHES)
+        self.global_register = None
+        self.column_register = None
+        self.pointer = None
+
+    @classmethod
+    def unknown(cls, ncols=NCOLS):
+        return cls(ncols)
+
+    @classmethod
+    def cleared(cls, ncols=NCOLS):
+        """ The image after clear_all_columns: every latch is zero. """
+        image = cls(ncols)
+        for latch in LATCHES:
+            image.planes[latch] = ['0'*MAXROWS]*ncols
+        return image
+
+    def copy(self):
+        image = ChipImage(self.ncols)
+        image.planes = dict((latch, list(plane)) for latch, plane in self.planes.iteritems())
+        image.global_register = self.global_register
+        image.column_register = self.column_register
+        image.pointer = self.pointer
+        return image
+
+    def forget(self):
+        """ Mark everything as unknown (e.g. after the chip was reset). """
+        for latch in LATCHES:
+            self.planes[latch] = [None]*self.ncols
+        self.global_register = None
+        self.column_register = None
+        self.pointer = None
+
+    # Building images
+
+    def set_plane(self, latch, col, pattern):
+        self.planes[latch][col] = ''.join(pattern)
+
+    def set_pixel(self, col, row, **latches):
+        """ Set latches of a single pixel, e.g. set_pixel(3, 10, hit='1', inject='1'). """
+        for latch, value in latches.iteritems():
+            plane = self.planes[latch][col]
+            if plane is None:
+                raise ValueError('Cannot set %s of pixel (%i,%i) when the rest of the column is unknown.' % (latch, col, row))
+            self.planes[latch][col] = plane[:row] + str(value) + plane[row+1:]
+
+    def set_tdacs(self, col, values):
+        """ Set the tdac planes of col from a list of 64 integer dac values. """
+        for i in xrange(5):
+            self.planes['tdac%i' % i][col] = ''.join((str((int(value) >> i) & 1) for value in values))
+
+    def get_tdacs(self, col):
+        """ Return the 64 integer dac values of col, or None if not known. """
+        planes = [self.planes['tdac%i' % i][col] for i in xrange(5)]
+        if None in planes:
+            return None
+        return [sum((int(planes[i][row]) << i for i in xrange(5))) for row in xrange(MAXROWS)]
+
+    def summary(self, latch, cols):
+        """ 1 if latch is set on every pixel of cols, 0 if on none, -1 otherwise (or unknown). """
+        planes = [self.planes[latch][col] for col in cols]
+        if None in planes:
+            return -1
+        if all((plane == '1'*MAXROWS for plane in planes)):
+            return 1
+        if all((plane == '0'*MAXROWS for plane in planes)):
+            return 0
+        return -1
+
+    # Tracking the chip
+
+    def load_latches(self, col, pattern, ldbus, config_mode='00'):
+        """ Record a latch load, as done by the chip. """
+        pattern = ''.join(pattern)
+        cols = xrange(self.ncols) if config_mode == '11' else [col]
+        for latch in ldbus_latches(ldbus):
+            for c in cols:
+                self.planes[latch][c] = pattern
+        # The load goes through the control part of the global register.
+        self.global_register = None
+        self.column_register = pattern
+        self.pointer = (col, config_mode, ())
+
+    def apply(self, op):
+        """ Record the effect of a LatchLoad or ConfigLoad. """
+        if isinstance(op, LatchLoad):
+            self.load_latches(op.col, op.pattern, op.ldbus, op.config_mode)
+        else:
+            self.global_register = op.pattern
+            self.pointer = None
+
+    # Persistence
+
+    def save(self, fname):
+        outfile = open(fname, 'w')
+        for latch in LATCHES:
+            for col, plane in enumerate(self.planes[latch]):
+                outfile.write('%s %i %s\n' % (latch, col, plane if plane is not None else '-'))
+        outfile.write('global %s\n' % (self.global_register if self.global_register is not None else '-'))
+        outfile.close()
+
+    @classmethod
+    def from_file(cls, fname, ncols=NCOLS):
+        image = cls(ncols)
+        infile = open(fname, 'r')
+        for line in infile:
+            values = line.split()
+            if not values:
+                continue
+            if values[0] == 'global':
+                image.global_register = values[1] if values[1] != '-' else None
+            else:
+                image.planes[values[0]][int(values[1])] = values[2] if values[2] != '-' else None
+        infile.close()
+        return image
+
+
+def compile_diff(current, desired):
+    """ Return the list of operations which turn the chip from current into desired.
+
+    Notes:
+    Only bit-planes where desired is known and differs from current (or
+    current is unknown) are written. For each latch, a broadcast load of
+    the most common desired pattern is used if that, plus rewriting the
+    columns which want something else, takes fewer loads than writing
+    the dirty columns one at a time. A broadcast also writes the columns
+    where desired is None, so it is only used when desired knows the latch
+    on every column. The remaining writes are grouped by
+    column, and latches of a column which want the same pattern share one
+    load. Broadcasts of the same pattern to several latches are merged.
+    If desired has a global register, it is loaded last, because every
+    latch load also rewrites the control part of the register.
+    """
+    working = current.copy()
+    ops = []
+
+    # Broadcasts
+    broadcasts = {}
+    for latch in LATCHES:
+        wanted = desired.planes[latch]
+        dirty = [col for col in xrange(desired.ncols) if wanted[col] is not None and wanted[col] != working.planes[latch][col]]
+        if len(dirty) < 2 or None in wanted:
+            continue
+        counts = {}
+        for pattern in wanted:
+            if pattern is not None:
+                counts[pattern] = counts.get(pattern, 0) + 1
+        pattern = max(counts, key=lambda p: counts[p])
+        others = len([col for col in xrange(desired.ncols) if wanted[col] is not None and wanted[col] != pattern])
+        if 1 + others < len(dirty):
+            broadcasts.setdefault(pattern, []).append(latch)
+    for pattern, latches in sorted(broadcasts.iteritems()):
+        op = LatchLoad(0, pattern, ldbus_string(latches), broadcast=True)
+        working.apply(op)
+        ops.append(op)
+
+    # Column loads
+    for col in xrange(desired.ncols):
+        by_pattern = {}
+        for latch in LATCHES:
+            pattern = desired.planes[latch][col]
+            if pattern is not None and pattern != working.planes[latch][col]:
+                by_pattern.setdefault(pattern, []).append(latch)
+        for pattern, latches in sorted(by_pattern.iteritems()):
+            op = LatchLoad(col, pattern, ldbus_string(latches))
+            working.apply(op)
+            ops.append(op)
+
+    if desired.global_register is not None and (ops or desired.global_register != working.global_register):
+        ops.append(ConfigLoad(desired.global_register))
+    return ops
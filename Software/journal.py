@@ -0,0 +1,169 @@
+"""
+Journal module: an append-only record of per-pixel results. Long scans
+and tunes write each measured pixel to the journal as soon as it is done,
+so a crash or keyboard interrupt costs at most the pixel being measured.
+The journal is replayed into a PixelLibrary on restart and periodically
+compacted into the normal library file.
+"""
+
+import os
+import time
+
+
+def replace_file(src, dst):
+    """ Rename src to dst, replacing dst if it exists (os.rename fails on Windows). """
+    try:
+        os.rename(src, dst)
+    except OSError:
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+class PixelJournal:
+    """Append-only journal of per-pixel measurements.
+
+    Notes:
+    Each record is a single line:
+        time col row dac thresh noise xs counts precision measured
+    where dac is -1 if the dac was not changed, xs, counts are comma
+    separated (or '-' if the raw samples were not kept), precision is '-'
+    if it was not estimated and measured is 2 for a coarse estimate.
+    Older records without the last two fields are full measurements. Every record is
+    flushed when written, so it survives the process dying. Records are
+    fsynced in batches of sync_every, or after sync_interval seconds, so
+    that only a power failure can cost more than one pixel.
+    After compact_every records, the journal is folded into the library
+    file and truncated.
+    """
+    def __init__(self, fname, sync_every=16, sync_interval=5.0, compact_every=256):
+        self.fname = fname
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_every = compact_every
+        self._unsynced = 0
+        self._uncompacted = 0
+        self._last_sync = time.time()
+        self._drop_partial_record()
+        self._file = open(fname, 'a')
+
+    def _drop_partial_record(self):
+        # A crash in the middle of a write leaves a line without a newline.
+        # Cut it off so that new records do not get appended onto it.
+        if not os.path.isfile(self.fname):
+            return
+        infile = open(self.fname, 'rb+')
+        data = infile.read()
+        if data and not data.endswith('\n'):
+            infile.seek(data.rfind('\n') + 1)
+            infile.truncate()
+        infile.close()
+
+    @staticmethod
+    def name_for(libname):
+        """ The name of the journal which belongs to the library file libname. """
+        return libname + '.journal'
+
+    @classmethod
+    def for_library(cls, libname, **kwargs):
+        """ Return the journal which belongs to the library file libname. """
+        return cls(cls.name_for(libname), **kwargs)
+
+    def record(self, col, row, thresh, noise, dac=-1, xs=None, counts=None, precision=None, coarse=False):
+        """ Append the result for one pixel. """
+        if xs is None or counts is None:
+            raw = '- -'
+        else:
+            raw = '%s %s' % (','.join(('%r' % float(x) for x in xs)), ','.join(('%i' % count for count in counts)))
+        precision = '%r' % float(precision) if precision is not None else '-'
+        self._file.write('%.3f %i %i %i %r %r %s %s %i\n' % (time.time(), col, row, dac, float(thresh), float(noise), raw, precision, 2 if coarse else 1))
+        self._file.flush()
+        self._unsynced += 1
+        self._uncompacted += 1
+        if self._unsynced >= self.sync_every or time.time() - self._last_sync > self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        """ Force all records written so far to disk. """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def records(self):
+        """ Yield (col, row, dac, thresh, noise, xs, counts, precision, coarse) for every complete record.
+
+        Notes:
+        A partially written last line (from a crash during a write) is ignored.
+        """
+        self._file.flush()
+        if not os.path.isfile(self.fname):
+            return
+        infile = open(self.fname, 'r')
+        lines = infile.readlines()
+        infile.close()
+        for line in lines:
+            if not line.endswith('\n'):
+                break
+            values = line.split()
+            try:
+                col, row, dac = int(values[1]), int(values[2]), int(values[3])
+                thresh, noise = float(values[4]), float(values[5])
+                if values[6] == '-':
+                    xs, counts = None, None
+                else:
+                    xs = [float(x) for x in values[6].split(',')]
+                    counts = [int(count) for count in values[7].split(',')]
+                precision, coarse = None, False
+                if len(values) > 9:
+                    precision = float(values[8]) if values[8] != '-' else None
+                    coarse = values[9] == '2'
+            except (IndexError, ValueError):
+                print "Skipping corrupt journal line: %s" % line.strip()
+                continue
+            yield col, row, dac, thresh, noise, xs, counts, precision, coarse
+
+    def replay(self, pixels):
+        """ Apply every record in the journal to the PixelLibrary pixels. Returns the number applied. """
+        n = 0
+        for col, row, dac, thresh, noise, xs, counts, precision, coarse in self.records():
+            if dac >= 0:
+                pixels[col][row] = dac
+            pixels.set_thresh(col, row, thresh, noise, precision, coarse)
+            n += 1
+        self._uncompacted = n
+        return n
+
+    def compact(self, pixels, libname):
+        """ Save pixels to libname and truncate the journal.
+
+        Notes:
+        The library is written to a temporary file and renamed into place
+        before the journal is truncated, so a crash at any point leaves
+        either the old library plus the full journal or the new library.
+        Replaying records which are already in the library is harmless.
+        A binary (.npy) library memory mapped from libname is updated in
+        place instead, since only the changed pages need to be written.
+        """
+        self.sync()
+        if pixels.is_mapped(libname):
+            pixels.save(libname)
+        else:
+            root, ext = os.path.splitext(libname)
+            tmpname = root + '.tmp' + (ext or '.csv')
+            pixels.save(tmpname)
+            replace_file(tmpname, libname)
+        self._file.close()
+        self._file = open(self.fname, 'w')
+        self._uncompacted = 0
+
+    def maybe_compact(self, pixels, libname):
+        """ Compact if enough records have accumulated since the last compaction. """
+        if self._uncompacted >= self.compact_every:
+            self.compact(pixels, libname)
+
+    def close(self, remove=False):
+        """ Close the journal, optionally deleting it (after a final compaction). """
+        self.sync()
+        self._file.close()
+        if remove:
+            os.remove(self.fname)
@@ -6,17 +6,37 @@ the state of the chip on completion, to help skip unnecessary
 steps. (e.g. whether or not the dacs of the pixels are set.)
 """
 
+import math
 import random
 import sys
 import time
 import os
+import errno
+import shutil
+import tempfile
+import json
 import argparse
+import atexit
+import threading
 
 import chip
+import chipimage
+import schedule
+import poisson
+import priors
+import tracing
+import profiling
+import recording
+from journal import PixelJournal, replace_file
 #import dscope
-#import numpy as np
-#from scipy.optimize import leastsq
-#from scipy.special import erf
+import numpy as np
+try:
+    from scipy.optimize import leastsq
+    from scipy.special import erf
+except ImportError:
+    # Without scipy (e.g. running bench.py or --sim away from the bench),
+    # the S-curves are fit with simple_leastsq below.
+    leastsq = erf = None
 
 
 
@@ -57,10 +77,10 @@ def interpret_dac_value(value):
                 return interpret_dac_value(sum(2**i * val for i,val in enumerate(value)))
             else:
                 return interpret_dac_value([int(i) for i in value])
-        elif type(value) == int:
+        elif isinstance(value, (int, long, np.integer)):
             if value > 31 or value < 0:
                 raise ValueError
-            return value
+            return int(value)
         else:
             raise ValueError
     except ValueError:
@@ -93,35 +113,207 @@ class State:
     hitor:   0  if hit_or is disabled on all
              1  if hit_or is enabled on all
              -1 if only some have hit_or enabled 
+    There is one State per process. from_file only reads state.dat
+    the first time it is called and returns the same object after
+    that, so the helpers can call it as often as they like. save()
+    only marks the state as changed; the file is written in the
+    background write_delay seconds later (and at exit, or by flush),
+    by writing a temporary file and renaming it over state.dat.
+    _write_lock guards the values, _dirty and the timer, so a change
+    made while the file is being written is kept for the next write.
+    If two processes share the bench, wrap the work in a StateLock (the
+    pix.py command line does).
     """
+    fname = 'state.dat'
+    fields = ('grid', 'tuned', 'small_tuned', 'enabled', 'vth', 'hitor')
+    write_delay = 1.0
+    _instance = None
+    _write_lock = threading.Lock()
+    _file_lock = threading.Lock()
+
     def __init__(self):
+        self._dirty = set()
+        self._timer = None
         self.grid = 0 
         self.tuned = 0 
         self.small_tuned = 0
         self.enabled = 0 
         self.vth = 0
         self.hitor = 0
+
+    def __setattr__(self, name, value):
+        if name not in self.fields:
+            self.__dict__[name] = value
+            return
+        with self._write_lock:
+            if self.__dict__.get(name) != value:
+                self._dirty.add(name)
+            self.__dict__[name] = value
         
     @classmethod
-    def from_file(cls):
-        """ Return a state instance with the values recorded in state.dat"""
-        infile = open('state.dat','r')
+    def from_file(cls, reload=False):
+        """ Return the process-wide state, reading state.dat on first use (or if reload)."""
+        if cls._instance is None:
+            cls._instance = cls()
+            atexit.register(cls._instance.flush)
+            reload = True
+        if reload:
+            cls._instance.load()
+        return cls._instance
+
+    def load(self):
+        """ Replace the values with those recorded in state.dat, discarding unsaved changes."""
+        infile = open(self.fname,'r')
         line = infile.readlines()[0]
         infile.close()
         values = line.strip().split(' ')
-        state = cls()
-        state.grid = int(values[0])
-        state.tuned = int(values[1])
-        state.small_tuned = int(values[2])
-        state.enabled = int(values[3])
-        state.vth = int(values[4])
-        state.hitor = int(values[5])
-        return state
+        for field, value in zip(self.fields, values):
+            setattr(self, field, int(value))
+        with self._write_lock:
+            self._dirty.clear()
 
     def save(self):
-        """ Save the current values to state.dat"""
-        outfile = open('state.dat','w')
-        outfile.write('%i %i %i %i %i %i\n' % (self.grid, self.tuned, self.small_tuned, self.enabled, self.vth, self.hitor))
+        """ Schedule the current values to be written to state.dat"""
+        with self._write_lock:
+            if self._dirty and self._timer is None:
+                self._timer = threading.Timer(self.write_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """ Write the current values to state.dat now, if anything changed."""
+        with self._write_lock:
+            timer, self._timer = self._timer, None
+        if timer is not None and timer is not threading.current_thread():
+            # Wait for a write the timer may have started, outside the lock it needs.
+            timer.cancel()
+            timer.join()
+        with self._file_lock:
+            with self._write_lock:
+                if not self._dirty:
+                    return
+                values = tuple(getattr(self, field) for field in self.fields)
+                self._dirty.clear()
+            tmpname = self.fname + '.tmp'
+            outfile = open(tmpname,'w')
+            outfile.write('%i %i %i %i %i %i\n' % values)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+            outfile.close()
+            replace_file(tmpname, self.fname)
+
+
+class StateLock:
+    """ Cross-process lock on the chip state, for two tools sharing a bench.
+
+    Notes:
+    The lock is a file (state.dat.lock) created exclusively, which
+    holds the pid of the owner. Entering the lock re-reads state.dat,
+    since the other process may have changed the chip, and leaving it
+    writes the state out before releasing. A lock whose owner is no
+    longer running (killed, or the machine went down) is broken. After
+    timeout seconds (None waits forever) acquire raises RuntimeError.
+    Usage:
+        with StateLock():
+            enable_chip(driver)
+    """
+    def __init__(self, timeout=None, poll=0.1):
+        self.fname = State.fname + '.lock'
+        self.timeout = timeout
+        self.poll = poll
+
+    def acquire(self):
+        start = time.time()
+        waiting = False
+        while True:
+            try:
+                fd = os.open(self.fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError:
+                if self.owner_gone():
+                    print "Breaking the lock %s, its owner is no longer running." % self.fname
+                    try:
+                        os.remove(self.fname)
+                    except OSError:
+                        pass
+                    continue
+                if self.timeout is not None and time.time() - start > self.timeout:
+                    raise RuntimeError('Could not lock the chip state, %s is held by another process.' % self.fname)
+                if not waiting:
+                    print "Waiting for another process to release the chip (%s)." % self.fname
+                    waiting = True
+                time.sleep(self.poll)
+                continue
+            os.write(fd, '%i\n' % os.getpid())
+            os.close(fd)
+            return State.from_file(reload=True)
+
+    def owner_gone(self):
+        """ Return whether the lock file names a process that no longer exists. """
+        try:
+            pid = int(open(self.fname).read())
+        except (IOError, ValueError):
+            # Gone already, or the owner has not written its pid yet.
+            return False
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno == errno.ESRCH
+        return False
+
+    def release(self):
+        State.from_file().flush()
+        os.remove(self.fname)
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+class NoiseMask:
+    """ The noisy pixels, which enable_chip and enable_hitor_chip leave disabled.
+
+    Notes:
+    Stored in noise_mask.dat with one 'col row' line per pixel. It is
+    written by find_noisy_pixels, and can be edited by hand (delete the
+    file to unmask every pixel).
+    """
+    fname = 'noise_mask.dat'
+
+    def __init__(self, pixels=()):
+        self.pixels = set(pixels)
+
+    @classmethod
+    def from_file(cls, fname=None):
+        fname = cls.fname if fname is None else fname
+        if not os.path.isfile(fname):
+            return cls()
+        infile = open(fname, 'r')
+        pixels = [tuple(int(x) for x in line.split()) for line in infile if line.strip()]
+        infile.close()
+        return cls(pixels)
+
+    def save(self, fname=None):
+        fname = self.fname if fname is None else fname
+        tmpname = fname + '.tmp'
+        outfile = open(tmpname, 'w')
+        for col, row in sorted(self.pixels):
+            outfile.write('%i %i\n' % (col, row))
+        outfile.close()
+        replace_file(tmpname, fname)
+
+    def pattern(self, col, value='1', masked='0'):
+        """ The 64 bit column pattern with value on every pixel of col except the masked ones. """
+        return ''.join((masked if (col, row) in self.pixels else value for row in xrange(chipimage.MAXROWS)))
+
+
+# Fixed per-pixel record layout. PixelLibrary keeps all of its data in one
+# (ncols, 64) array of these records, which is also the binary file format.
+# measured is 1 for a full scurve fit and 2 for a coarse estimate, and
+# precision is the estimated error on thresh (0 if it was not estimated).
+PIXEL_DTYPE = np.dtype([('fixed', np.int8), ('dacs', np.int8), ('measured', np.int8), ('thresh', np.float64), ('noise', np.float64), ('precision', np.float64)])
 
 
 class PixelColumn:
@@ -132,12 +324,18 @@ class PixelColumn:
     By default, values are returned as binary strings, where
     the first position is the least significant bit. It is 
     assumed that any list or string will follow this convention.
+    The data is a length 64 array of PIXEL_DTYPE records, so
+    data[key] is an array for each key. When the column belongs
+    to a PixelLibrary, data is a view into the library's array.
     '''
     npix = 64
-    data_forms = {'fixed':int, 'dacs':int, 'measured':int, 'thresh':float, 'noise':float}
+    data_forms = {'fixed':int, 'dacs':int, 'measured':int, 'thresh':float, 'noise':float, 'precision':float}
 
-    def __init__(self):
-        self.data = {'fixed':np.zeros(self.npix), 'dacs':np.ones(self.npix) * 16, 'measured':np.zeros(self.npix), 'thresh':np.zeros(self.npix), 'noise':np.zeros(self.npix)}
+    def __init__(self, data=None):
+        if data is None:
+            data = np.zeros(self.npix, dtype=PIXEL_DTYPE)
+            data['dacs'] = 16
+        self.data = data
 
     @classmethod
     def from_string(cls, string):
@@ -148,8 +346,11 @@ class PixelColumn:
             if key not in cls.data_forms:
                 print "Unrecognized key: %s in input string." % key
                 continue
-            vals = [ cls.data_forms[key](float(val)) for val in vals.split(',')]
-            col.data[key] = vals
+            vals = vals.split(',')
+            if len(vals) != cls.npix:
+                print "Skipping %s: %i values instead of %i (truncated line?)." % (key, len(vals), cls.npix)
+                continue
+            col.data[key] = np.array(vals, dtype=float)
         return col
 
     def set(self, row, value):
@@ -181,7 +382,7 @@ class PixelColumn:
         return bool(self.data['measured'][row])
 
     def all_measured(self):
-        return all( (self.is_measured(row) for row in xrange(self.npix)) )
+        return bool(self.data['measured'].all())
 
     def get_int(self,row):
         return int(self.data['dacs'][row])
@@ -205,88 +406,141 @@ class PixelColumn:
         self.set(row,value)
 
     def __str__(self):
-        return '\n'.join(('%s: %s' % (key,','.join((str(val) for val in vals))) for key, vals in self.data.iteritems()))
+        return '\n'.join(('%s: %s' % (key,','.join((str(val) for val in self.data[key]))) for key in PIXEL_DTYPE.names))
 
 
 class PixelLibrary:
     """ Storage container for data from a grid of pixels.
     
-    Is actually just an interface for a list of PixelColumns.
     Notes:
-    Provides methods to save to/load from a human readable csv. 
+    All of the data is held in a single (ncols, 64) array of
+    PIXEL_DTYPE records (self.data), and the PixelColumns in
+    self.cols are views into it. The whole-chip accessors work
+    on the array directly, using the measured field as a mask.
+    Provides methods to save to/load from a human readable csv,
+    or a binary file if the name ends with .npy. The binary file
+    is the array itself. It is memory mapped when loaded, so
+    pixels are only read when they are used, and changes are
+    written back in place by save. Files from before a field was
+    added are read into the current layout (and not mapped).
     """
     
-    def __init__(self, ncols=18):
-        self.cols = [PixelColumn() for i in xrange(ncols)]
+    def __init__(self, ncols=18, data=None):
+        if data is None:
+            data = np.zeros((ncols, PixelColumn.npix), dtype=PIXEL_DTYPE)
+            data['dacs'] = 16
+        self.data = data
+        self.cols = [PixelColumn(self.data[i]) for i in xrange(self.data.shape[0])]
+        self._mapped_name = None
 
     @classmethod
     def from_file(cls, fname):
         if not os.path.isfile(fname):
             return cls()
+        if fname.endswith('.npy'):
+            return cls.from_binary(fname)
         infile = open(fname,'r')
         lines = infile.readlines()
         infile.close()
-        inst = cls(0)
         blocks = []
         for line in lines:
             if 'column' in line:
                 blocks.append([])
             elif line.strip() != '':
                 blocks[-1].append(line)
-        inst.cols.extend((PixelColumn.from_string(''.join(block)) for block in blocks))
+        inst = cls(len(blocks))
+        for i,block in enumerate(blocks):
+            inst.data[i] = PixelColumn.from_string(''.join(block)).data
         return inst
 
+    @classmethod
+    def from_binary(cls, fname):
+        """ Memory map a binary library. """
+        mapped = np.load(fname, mmap_mode='r+')
+        names = mapped.dtype.names or ()
+        if mapped.dtype != PIXEL_DTYPE and names and set(names) < set(PIXEL_DTYPE.names) and mapped.ndim == 2:
+            data = np.zeros(mapped.shape, dtype=PIXEL_DTYPE)
+            for name in names:
+                data[name] = mapped[name]
+            return cls(data=data)
+        if mapped.dtype != PIXEL_DTYPE or mapped.ndim != 2 or mapped.shape[1] != PixelColumn.npix:
+            raise ValueError('%s is not a pixel library (dtype %s, shape %s).' % (fname, mapped.dtype, mapped.shape))
+        inst = cls(data=mapped)
+        inst._mapped_name = os.path.abspath(fname)
+        return inst
+
+    def to_array(self):
+        """ Return the (ncols, 64) array of PIXEL_DTYPE records behind the library. """
+        return self.data
+
+    def measured_mask(self):
+        """ Boolean (ncols, 64) array, True where the pixel has been measured. """
+        return self.data['measured'].astype(bool)
+
+    def measured_cols(self):
+        """ Index array of the columns which are completely measured. """
+        return np.flatnonzero(self.data['measured'].all(axis=1))
+
+    def column_view(self, key, col):
+        """ Zero-copy view of key for every pixel in col. """
+        return self.data[key][col]
+
+    def grid_view(self, key):
+        """ Zero-copy (ncols, 64) view of key for every pixel. """
+        return self.data[key]
+
     def set(self, col, row, value):
         self.cols[col].set(row, value)
 
     def set_data(self, key, col, row, value):
-        self.cols[col].data[key][row] = value
+        self.data[key][col,row] = value
 
     def get_data(self, key, col, row):
-        return self.cols[col].data[key][row]
+        return self.data[key][col,row]
 
     def get_data_all(self, key):
-        output = []
-        for col in self.cols:
-            output.extend((col.data[key][row] for row in xrange(col.npix) if col.is_measured(row) ))
-        return output
+        return self.data[key][self.measured_mask()]
 
     def get_thresh_all(self):
-        output = []
-        for col in self.cols:
-            output.extend((vth_to_electrons(col.data['thresh'][row]) for row in xrange(col.npix) if col.is_measured(row) ))
-        return output
+        return vth_to_electrons(self.get_data_all('thresh'))
 
     def get_data_grid(self, key):
-        output = []
-        for col in self.cols:
-            if col.all_measured():
-                output.append([col.data[key][row] for row in xrange(col.npix) ])
-        return output
+        """ Return key for the fully measured columns as a (ncols, 64) array.
+
+        Notes:
+        If the measured columns are contiguous (the usual case) the
+        result is a view rather than a copy.
+        """
+        cols = self.measured_cols()
+        if len(cols) and cols[-1] - cols[0] + 1 == len(cols):
+            return self.data[key][cols[0]:cols[-1]+1]
+        return self.data[key][cols]
 
     def get_thresh_grid(self):
         """ This function handles converting to electron equivalent."""
-        output = []
-        for col in self.cols:
-            if col.all_measured():
-                output.append([vth_to_electrons(col.data['thresh'][row]) for row in xrange(col.npix) ])
-        return output
+        return vth_to_electrons(self.get_data_grid('thresh'))
 
     def get_data_col(self, key, col):
-        output = []
-        output.extend((self.cols[col].data[key][row] for row in xrange(self.cols[col].npix) if self.cols[col].is_measured(row) ))
-        return output
+        mask = self.data['measured'][col].astype(bool)
+        if mask.all():
+            return self.data[key][col]
+        return self.data[key][col][mask]
 
     def get_thresh_col(self, col):
-        output = []
-        output.extend((vth_to_electrons(self.cols[col].data['thresh'][row]) for row in xrange(self.cols[col].npix) if self.cols[col].is_measured(row) ))
-        return output
+        return vth_to_electrons(self.get_data_col('thresh', col))
 
-    def set_thresh(self, col, row, value, error):
-        self.cols[col].set_thresh(row, value, error)
+    def set_thresh(self, col, row, value, error, precision=None, coarse=False):
+        self.data['thresh'][col,row] = value
+        self.data['noise'][col,row] = error
+        self.data['measured'][col,row] = 2 if coarse else 1
+        if precision is not None:
+            self.data['precision'][col,row] = precision
+
+    def is_coarse(self, col, row):
+        return self.data['measured'][col,row] == 2
 
     def is_measured(self, col, row):
-        return self.cols[col].is_measured(row)
+        return bool(self.data['measured'][col,row])
 
     def get_thresh(self, col, row):
         return self.get_data('thresh', col, row)
@@ -295,7 +549,7 @@ class PixelLibrary:
         return self.get_data('noise', col, row)
 
     def get_int(self,col,row):
-        return self.cols[col].get_int(row)
+        return int(self.data['dacs'][col,row])
 
     def get_bstring(self,col,row):
         return binary_string(self.get_int(col,row))
@@ -308,14 +562,17 @@ class PixelLibrary:
     
     def is_set(self,col,row=None):
         if row is None:
-            return self.cols[col].fixed.all()
+            return bool(self.data['fixed'][col].all())
         else:
-            return self.cols[col].is_set(row)
+            return bool(self.data['fixed'][col,row])
 
     def __getitem__(self,col):
         return self.cols[col]
 
     def save(self, outname):
+        if outname.endswith('.npy'):
+            self.save_binary(outname)
+            return
         if '.' not in outname:
             outfile = open(outname+'.csv','w')
         else:
@@ -325,7 +582,117 @@ class PixelLibrary:
             outfile.write(str(col))
             outfile.write('\n')
         outfile.close()
-    
+
+    def is_mapped(self, fname):
+        """ Return whether the library is memory mapped from the binary file fname. """
+        return self._mapped_name == os.path.abspath(fname)
+
+    def save_binary(self, outname):
+        """ Save to a binary library file.
+
+        Notes:
+        If the library was loaded from outname, only the pages which
+        were changed are written back. Otherwise a new file is written.
+        """
+        if self.is_mapped(outname):
+            self.data.flush()
+            return
+        output = np.lib.format.open_memmap(outname, mode='w+', dtype=PIXEL_DTYPE, shape=self.data.shape)
+        output[:] = self.data
+        output.flush()
+        del output
+
+
+def convert_library(inname, outname):
+    """ Convert a pixel library between the csv and binary formats (chosen by file extension). """
+    pixels = PixelLibrary.from_file(inname)
+    pixels.save(outname)
+    return pixels
+
+
+# Thresholds measured before, used to start the searches of sample_counts
+# near the answer. None unless use_priors has been called.
+prior_store = None
+
+def use_priors(fname='priors.dat', chip_name='default', libraries=()):
+    """ Warm start threshold measurements from the priors in fname.
+
+    Notes:
+    libraries is a list of (file name, vth) of PixelLibraries to add to the
+    store, e.g. [('pixels_tune_final.csv', 150)]. Every threshold measured
+    afterwards by measure_thresh or measure_thresh_fast is added to the
+    store (and appended to fname), so later scans start from it. fname
+    is compacted first, so it does not keep growing with remeasurements.
+    """
+    global prior_store
+    prior_store = priors.PriorStore.from_file(fname, chip_name)
+    prior_store.compact()
+    for libname, vth in libraries:
+        if os.path.isfile(libname):
+            prior_store.add_library(PixelLibrary.from_file(libname).to_array(), vth)
+    return prior_store
+
+
+def count_config():
+    """ The name of the counter configuration in chip.image, for the prior store.
+
+    Notes:
+    'none' with the counter bits all off, or else the bits
+    global_readout_enable, count_hits_not, count_enable and
+    count_clear_not, e.g. '0101' for the 'clock' configurations of the
+    main_ functions. They are read from the global register, or after a
+    pixel command from the settings of chip.image.pointer. The count
+    clock itself is not recorded anywhere, so it is not part of the
+    name. None if neither is known.
+    """
+    names = ('global_readout_enable', 'count_hits_not', 'count_enable', 'count_clear_not')
+    if chip.image.global_register is not None:
+        # The control pattern is loaded reversed, at the end of the register.
+        control = chip.image.global_register[-32:][::-1]
+        bits = control[0] + control[3:6]
+    elif chip.image.pointer is not None:
+        settings = dict(chip.image.pointer[2])
+        bits = ''.join((settings.get(name, '0') for name in names))
+    else:
+        return None
+    return 'none' if bits == '0000' else bits
+
+
+def pixel_prior(col, row, dac=None, config=None):
+    """ The expected (thresh, noise) of the pixel at the current vth, or None.
+
+    Notes:
+    dac defaults to the tdac of the pixel in chip.image, and config to
+    count_config().
+    """
+    if prior_store is None:
+        return None
+    if dac is None:
+        dacs = chip.image.get_tdacs(col)
+        if dacs is None:
+            return None
+        dac = dacs[row]
+    if config is None:
+        config = count_config()
+        if config is None:
+            return None
+    return prior_store.lookup(col, row, State.from_file().vth, dac, config)
+
+
+def remember_thresh(col, row, thresh, noise, dac=None, config=None):
+    """ Add a measured threshold to the prior store, if one is in use. """
+    if prior_store is None:
+        return
+    if dac is None:
+        dacs = chip.image.get_tdacs(col)
+        if dacs is None:
+            return
+        dac = dacs[row]
+    if config is None:
+        config = count_config()
+        if config is None:
+            return
+    prior_store.add(col, row, State.from_file().vth, dac, thresh, noise, config)
 
 # This kind of binary search can be problematic. It will turn into a linear search if actual > midpoint + 2*width
 def interval_search(target_low, target_high, midpoint, width, minwidth, upper_lim, lower_lim, func, args=[]):
@@ -427,7 +794,7 @@ def time_until_hit(hpcntr, max_time):
     return output
 
 
-def sample_counts(hpcntr, hpgene, npoints=4, ninjects=255):
+def sample_counts(hpcntr, hpgene, npoints=4, ninjects=255, prior=None):
     """ Returns an array of voltages, counts from measuring a pixel.
 
     Notes:
@@ -437,15 +804,26 @@ def sample_counts(hpcntr, hpgene, npoints=4, ninjects=255):
     used here to find the shoulders of the scurve.
     The internal values for the initial guess and intial width of the 
     binary search might need to be tuned, if the searches seem slow.
+    If prior is the expected (thresh, noise) of the pixel (see
+    pixel_prior), the searches start at the shoulders it predicts, with a
+    width of one noise (at least .015), so they usually end in one or two
+    steps.
     """
     noise = .015
     bottom_low = 2
     bottom_high = (ninjects * 2) // 10
     top_low = (ninjects * 8) // 10
     top_high = ninjects - 2
-    #ledge = interval_search(bottom_low, bottom_high,            .225, .08, noise/5.0, 1.0, 0.03, get_count, [hpcntr,hpgene]);
-    ledge = interval_search(bottom_low, bottom_high,            .8, .4, noise/5.0, 1.3, 0.027, get_count, [hpcntr,hpgene]);
-    hedge = interval_search(   top_low,    top_high, ledge+2*noise, .02, noise/5.0, 1.4, 0.027, get_count, [hpcntr,hpgene]);
+    if prior is not None:
+        thresh, sigma = prior
+        # The 20% and 80% points of the scurve are at thresh -+ .84 sigma.
+        sigma = max(sigma, noise)
+        ledge = interval_search(bottom_low, bottom_high, thresh-1.4*sigma, sigma, noise/5.0, 1.3, 0.027, get_count, [hpcntr,hpgene]);
+        hedge = interval_search(   top_low,    top_high, max(ledge, thresh)+1.4*sigma, sigma, noise/5.0, 1.4, 0.027, get_count, [hpcntr,hpgene]);
+    else:
+        #ledge = interval_search(bottom_low, bottom_high,            .225, .08, noise/5.0, 1.0, 0.03, get_count, [hpcntr,hpgene]);
+        ledge = interval_search(bottom_low, bottom_high,            .8, .4, noise/5.0, 1.3, 0.027, get_count, [hpcntr,hpgene]);
+        hedge = interval_search(   top_low,    top_high, ledge+2*noise, .02, noise/5.0, 1.4, 0.027, get_count, [hpcntr,hpgene]);
 
     xs = np.linspace(ledge,hedge,npoints)
     xs = np.insert(xs,[0]*2,np.arange(-2,0)*noise + xs[0])
@@ -455,22 +833,88 @@ def sample_counts(hpcntr, hpgene, npoints=4, ninjects=255):
     return xs, counts
 
 
+def simple_leastsq(func, x0, args=(), full_output=False, ftol=1.49012e-8, maxiter=200):
+    """ A Levenberg-Marquardt fit with a numerical jacobian, standing in for scipy.optimize.leastsq.
+
+    Notes:
+    Returns what leastsq returns: (x, ier), or with full_output
+    (x, cov_x, infodict, mesg, ier), where cov_x is inv(J^T J) (None if
+    it is singular) and infodict only has fvec and nfev.
+    """
+    x = np.array(x0, dtype=float)
+    f = np.asarray(func(x, *args), dtype=float)
+    cost = (f**2).sum()
+    nfev, lam, ier = 1, 1e-3, 5
+    def jacobian(x, f):
+        columns = []
+        for j in xrange(len(x)):
+            step = 1.49012e-8 * max(abs(x[j]), 1.0)
+            shifted = x.copy()
+            shifted[j] += step
+            columns.append((np.asarray(func(shifted, *args), dtype=float) - f) / step)
+        return np.array(columns).T
+    for i in xrange(maxiter):
+        J = jacobian(x, f)
+        nfev += len(x)
+        A, g = J.T.dot(J), J.T.dot(f)
+        while lam < 1e12:
+            try:
+                dx = np.linalg.solve(A + lam * np.diag(np.diag(A) + 1e-12), -g)
+            except np.linalg.LinAlgError:
+                lam *= 10
+                continue
+            f_new = np.asarray(func(x + dx, *args), dtype=float)
+            nfev += 1
+            cost_new = (f_new**2).sum()
+            if cost_new <= cost:
+                break
+            lam *= 10
+        else:
+            ier = 2
+            break
+        x, f, lam = x + dx, f_new, lam / 10
+        converged = cost - cost_new <= ftol * cost
+        cost = cost_new
+        if converged:
+            ier = 1
+            break
+    if not full_output:
+        return x, ier
+    try:
+        cov = np.linalg.inv(J.T.dot(J))
+    except np.linalg.LinAlgError:
+        cov = None
+    return x, cov, {'fvec': f, 'nfev': nfev}, 'simple_leastsq finished (ier %i)' % ier, ier
+
+if leastsq is None:
+    leastsq = simple_leastsq
+    erf = np.vectorize(math.erf, otypes=[float])
+
+
 def scurve(v,x):
     """ Functional form of an scurve using standard gaussian variables."""
     # v = [mu,sigma,N]
     return .5*v[2]*(1 + erf((x - v[0])/(1.4142*v[1])))
 
 
-def fit_scurve(xs, counts):
+def fit_scurve(xs, counts, errors=False):
     """ Calculates the parameters of an scurve given voltages, counts.
     
     Notes: The fit has three parameters (mu, sigma, N), but only
     mu, sigma are returned because N is usually uninteresting.
+    If errors is True, the standard error of mu is returned as well
+    (from the covariance of the fit, scaled by the residuals).
     """
     err = lambda v, x, y: (scurve(v,x) - y)
     v0 = [(xs[0] + xs[1])/2, .01, 255]
-    v, success = leastsq(err, v0, args=(xs,counts))    
-    return v[0], v[1]
+    if not errors:
+        v, success = leastsq(err, v0, args=(xs,counts))    
+        return v[0], v[1]
+    v, cov, info, msg, success = leastsq(err, v0, args=(xs,counts), full_output=True)
+    if cov is None or len(xs) <= len(v0):
+        return v[0], v[1], float('inf')
+    variance = (info['fvec']**2).sum() / (len(xs) - len(v0))
+    return v[0], v[1], np.sqrt(cov[0][0] * variance)
 
 """
 def plot_scurve(v, x, y, color='#7A973A'):
@@ -530,27 +974,57 @@ def enable_chip(driver):
     Notes:
     This is used rather than driver.enable_all_columns because
     this function selectively enables only the grid/small columns.
+    Pixels in the NoiseMask are left disabled.
     """
     state = State.from_file()
     if state.enabled == 1:
         return
     state.enabled = -1
     state.save()
-    if state.grid != 0:
-        for col in xrange(1,17):
-            driver.enable_single_column(col)
-    else: 
-        for col in [0,17]:
-            driver.enable_single_column(col)        
+    mask = NoiseMask.from_file()
+    desired = chip.image.copy()
+    desired.global_register = None
+    for col in (xrange(1,17) if state.grid != 0 else [0,17]):
+        desired.set_plane('hit', col, mask.pattern(col))
+        desired.set_plane('inject', col, mask.pattern(col))
+    driver.apply_ops(chipimage.compile_diff(chip.image, desired))
     state.enabled = 1
     state.save()
 
+def write_tdacs(pix, driver, cols):
+    """ Write the tdacs of cols from PixelLibrary pix onto cleared columns.
+
+    Notes:
+    The columns are cleared first (every latch zero), so bit-planes that
+    are all zero do not need to be written at all. The rest are compiled
+    with chipimage.compile_diff, which broadcasts a plane shared by most
+    columns and loads planes of a column which are equal (e.g. tdac1 and
+    tdac3) together, then sent as a batch by driver.apply_ops.
+    Returns the operations that were sent.
+    """
+    if list(cols) == range(1,17):
+        driver.clear_all_columns()
+    else:
+        for col in cols:
+            driver.clear_single_column(col)
+    desired = chip.image.copy()
+    desired.global_register = None
+    for col in cols:
+        desired.set_tdacs(col, [pix.get_int(col, row) for row in xrange(PixelColumn.npix)])
+    ops = chipimage.compile_diff(chip.image, desired)
+    driver.apply_ops(ops)
+    return ops
+
 def write_chip_tuned(pix, driver=None):
     """ Write DAC patterns to every pixel from PixelLibrary pix. 
 
     Notes:
     In the process, hit/inject are disabled on all pixels, and
     not re-enabled (this is intentional).
+    The patterns are written with write_tdacs, which clears the columns
+    first, so only the bit-planes which are not all zero are loaded,
+    identical ones are shared, and the loads are batched into as few
+    triggers as the driver allows.
     If driver is None, this function will create its own driver and
     initalize the blocks. This is to save time, but note that this
     means that any other drivers need to be initialized after calling
@@ -560,17 +1034,13 @@ def write_chip_tuned(pix, driver=None):
     if state.tuned == 1:
         return
     if driver is None:
-        driver = chip.DgeneDriver(chip.dgene, config_size=380)
+        driver = chip.DgeneDriver(chip.dgene, number_instructions=16, config_size=380)
         driver.init_blocks()
-    driver.clear_all_columns()
     state.tuned = -1
     state.enabled = 0
     state.save()
-    for col in xrange(1,17):
-        for index in xrange(5):
-            print "Writing column %i, index %i" % (col, index)
-            pix_pattern = [pix[col][row][index] for row in xrange(64)]
-            driver.write_pixel_pattern(col, pix_pattern, index)
+    ops = write_tdacs(pix, driver, range(1,17))
+    print "Wrote the tdacs with %i loads." % len(ops)
     state.tuned = 1
     state.save()
 
@@ -580,6 +1050,10 @@ def write_small_tuned(pix, driver=None):
     Notes:
     In the process, hit/inject are disabled on all pixels, and
     not re-enabled (this is intentional).
+    The patterns are written with write_tdacs, which clears the columns
+    first, so only the bit-planes which are not all zero are loaded,
+    identical ones are shared, and the loads are batched into as few
+    triggers as the driver allows.
     If driver is None, this function will create its own driver and
     initalize the blocks. This is to save time, but note that this
     means that any other drivers need to be initialized after calling
@@ -589,18 +1063,13 @@ def write_small_tuned(pix, driver=None):
     if state.small_tuned == 1:
         return
     if driver is None:
-        driver = chip.DgeneDriver(chip.dgene, config_size=380)
+        driver = chip.DgeneDriver(chip.dgene, number_instructions=16, config_size=380)
         driver.init_blocks()
-    driver.clear_single_column(0)
-    driver.clear_single_column(17)
     state.small_tuned = -1
     state.enabled = 0
     state.save()
-    for col in [0,17]:
-        for index in xrange(5):
-            print "Writing column %i, index %i" % (col, index)
-            pix_pattern = [pix[col][row][index] for row in xrange(64)]
-            driver.write_pixel_pattern(col, pix_pattern, index)
+    ops = write_tdacs(pix, driver, [0,17])
+    print "Wrote the tdacs with %i loads." % len(ops)
     state.small_tuned = 1
     state.save()
 
@@ -613,6 +1082,7 @@ def enable_hitor_chip(driver=None):
     initalize the blocks. This is to save time, but note that this
     means that any other drivers need to be initialized after calling
     this function.
+    Pixels in the NoiseMask are left disabled.
     """
     state = State.from_file()
     if state.hitor == 1:
@@ -620,7 +1090,12 @@ def enable_hitor_chip(driver=None):
     if driver is None:
         driver = chip.DgeneDriver(chip.dgene, config_size=380)
         driver.init_blocks()
-    driver.enable_hitor_all_columns()
+    mask = NoiseMask.from_file()
+    desired = chip.image.copy()
+    desired.global_register = None
+    for col in xrange(desired.ncols):
+        desired.set_plane('hit_or_not', col, mask.pattern(col, value='0', masked='1'))
+    driver.apply_ops(chipimage.compile_diff(chip.image, desired))
     state.hitor = 1
     state.save()
 
@@ -664,6 +1139,97 @@ def set_config(vth, driver=None, PrmpVbp=142, PrmpVbf=11, **kwargs):
     state.save()
     driver.program_config(chip.get_dac_pattern(vth, PrmpVbp=PrmpVbp, PrmpVbf=PrmpVbf)[::-1]+chip.get_control_pattern(**kwargs)[::-1],zero=False) 
 
+def setup_image(pix=None, enabled=None, hitor=True, cols=range(1,17)):
+    """ Return a chipimage.ChipImage for a common setup, starting from chip.image.
+
+    Notes:
+    pix:     if given, the tdacs of cols are set from this PixelLibrary
+    enabled: None to disable hit/inject on every pixel, 'all' to enable
+             them on every pixel of cols, or (col, row) for one pixel
+    hitor:   True to enable hitOr on every pixel, False to disable it,
+             None to leave it as it is
+    Anything not set is left as "don't care" if it is not known, and
+    the global register is always left alone.
+    """
+    image = chip.image.copy()
+    image.global_register = None
+    if pix is not None:
+        for col in cols:
+            image.set_tdacs(col, [pix.get_int(col, row) for row in xrange(PixelColumn.npix)])
+    for col in xrange(image.ncols):
+        if enabled == 'all' and col in cols:
+            pattern = '1'*PixelColumn.npix
+        elif enabled is not None and enabled != 'all' and col == enabled[0]:
+            pattern = ''.join(('1' if row == enabled[1] else '0' for row in xrange(PixelColumn.npix)))
+        else:
+            pattern = '0'*PixelColumn.npix
+        image.set_plane('hit', col, pattern)
+        image.set_plane('inject', col, pattern)
+        if hitor is not None:
+            image.set_plane('hit_or_not', col, ('0' if hitor else '1')*PixelColumn.npix)
+    return image
+
+
+def apply_image(desired, driver):
+    """ Reprogram the chip to the ChipImage desired, writing only what differs from chip.image. 
+
+    Notes:
+    Returns the operations that were sent. The coarse flags in the
+    State are updated from the resulting image.
+    """
+    ops = chipimage.compile_diff(chip.image, desired)
+    driver.apply_ops(ops)
+    state = State.from_file()
+    state.enabled = chip.image.summary('hit', range(1,17) if state.grid != 0 else [0,17])
+    hitor = chip.image.summary('hit_or_not', range(chip.image.ncols))
+    state.hitor = 1 - hitor if hitor != -1 else -1
+    state.save()
+    return ops
+
+
+def count_clock_setter(driver, freq=None):
+    """ Return a schedule setter which turns the count clock of driver on (True) or off (False). """
+    def set_clock(on):
+        if not on:
+            driver.disable_count_clock()
+        elif freq is None:
+            driver.enable_count_clock()
+        else:
+            driver.enable_count_clock(freq)
+    return set_clock
+
+
+def run_experiment(experiment, points, measure, outnames, write, start=None):
+    """ Run experiment on points and write the results to the files outnames, in the order of points.
+
+    Notes:
+    write(outfiles, point, result) writes the records of one point, with
+    outfiles open in the same order as outnames. As each point is
+    measured, its records are also written to name.partial (in the order
+    they were measured), so a crash keeps what was done so far. Once all
+    the points are measured the files are written in the order of points
+    and the partial files are removed. Returns the results.
+    """
+    partials = [open(name + '.partial', 'w') for name in outnames]
+    def save(point, result):
+        write(partials, point, result)
+        for partial in partials:
+            partial.flush()
+    try:
+        results = experiment.run(points, measure, start, done=save)
+    finally:
+        for partial in partials:
+            partial.close()
+    outfiles = [open(name, 'w') for name in outnames]
+    for point, result in zip(points, results):
+        write(outfiles, point, result)
+    for outfile in outfiles:
+        outfile.close()
+    for name in outnames:
+        os.remove(name + '.partial')
+    return results
+
+
 # Measurement functions
 def test_thresh(npoints, ninjects, driver, hpcntr, hpgene, col, row, dacbits):
     """Measure a threshold using variable setting for the fitting and injecting.
@@ -683,89 +1249,318 @@ def test_thresh(npoints, ninjects, driver, hpcntr, hpgene, col, row, dacbits):
     return fit_scurve(xs, counts)
 
 
-def measure_thresh(driver, hpcntr, hpgene, col, row, dacbits):
+def measure_thresh(driver, hpcntr, hpgene, col, row, dacbits, raw=False):
     """Measure the threshold of the pixel at col, row with dac set to dacbits.
     
     Notes:
     This version guaruntees that the dac bits are correct by zeroing them out
     first. This costs an extra write step, and makes it take about 1.5* as long.
+    If raw is True, the sampled voltages and counts are returned after the
+    threshold and noise.
     """
     state = State.from_file()
     state.tuned = -1
     state.save()
     driver.clear_single_column(col)
     driver.enable_single_pixel(col, row, dacbits=dacbits, zero=False)
-    xs, counts = sample_counts(hpcntr, hpgene)
-    return fit_scurve(xs, counts)
+    dac = interpret_dac_value(dacbits)
+    xs, counts = sample_counts(hpcntr, hpgene, prior=pixel_prior(col, row, dac))
+    thresh, noise = fit_scurve(xs, counts)
+    remember_thresh(col, row, thresh, noise, dac)
+    if raw:
+        return thresh, noise, xs, counts
+    return thresh, noise
 
 
-def measure_thresh_fast(driver, hpcntr, hpgene, col, row):
+def measure_thresh_fast(driver, hpcntr, hpgene, col, row, raw=False, dac=None):
     """Measure the threshold of the pixel at col, row.
     
     Notes:
     This version assumes that the dacbits are already set on the pixel being
-    measured, so that it can be done as fast as possible.
+    measured, so that it can be done as fast as possible. The pixel is
+    enabled with driver.step_single_pixel, so measuring the rows of a
+    column in increasing order only shifts the column register.
+    If raw is True, the sampled voltages and counts are returned after the
+    threshold and noise.
+    dac is the tdac the pixel is set to, used to look up its prior (see
+    use_priors) when chip.image does not know it.
     """
-    driver.enable_single_pixel(col, row, dacbits='00000', zero=False)
-    xs, counts = sample_counts(hpcntr, hpgene)
-    return fit_scurve(xs, counts)
+    driver.step_single_pixel(col, row, zero=False)
+    xs, counts = sample_counts(hpcntr, hpgene, prior=pixel_prior(col, row, dac))
+    thresh, noise = fit_scurve(xs, counts)
+    remember_thresh(col, row, thresh, noise, dac)
+    if raw:
+        return thresh, noise, xs, counts
+    return thresh, noise
 
 # Aggregate measurement functions.
-def measure_counts(driver, hpcntr, vth=100, **kwargs):
-    """Measure the count rate at various VbpTh settings."""
-    counts = 0
-    rates = []
+def measure_rate(hpcntr, precision=0.2, rate_floor=0.5, max_time=8.0, min_gate=.25, confidence=0.95):
+    """ Measure the dark count rate at the current settings, with gates sized as needed.
+
+    Notes:
+    Gates are taken until the rate is known to precision (relative half
+    width of the confidence interval), or is known to be below rate_floor
+    (Hz), or max_time seconds have been counted. With no counts, the
+    upper limit only drops below rate_floor after about
+    3.689/rate_floor seconds, so quiet settings take the longest.
+    Returns a poisson.RateEstimate.
+    """
+    estimate = poisson.RateEstimate(precision, confidence, rate_floor)
+    while not estimate.done() and estimate.exposure < max_time:
+        delay = min(estimate.next_gate(min_gate, max_time), max_time - estimate.exposure)
+        estimate.add(timed_count(delay, hpcntr), delay)
+    return estimate
+
+
+def measure_counts(driver, hpcntr, vth=100, intervals=False, precision=0.2, rate_floor=0.5, max_rate=1000, max_step=8, **kwargs):
+    """Measure the count rate at various VbpTh settings.
+
+    Notes:
+    vth is stepped down from vth until the rate reaches max_rate (Hz) or
+    vth reaches 20. Each rate is measured with measure_rate, so noisy
+    thresholds take short gates, while quiet ones are the long ones:
+    proving a threshold with no counts below rate_floor takes about
+    3.689/rate_floor seconds (7.4 s at 0.5 Hz), and a low but nonzero
+    rate runs to the full 8 s. Where the rate is known to be below
+    rate_floor, the step doubles up to max_step, which is where the time
+    is saved on quiet thresholds. If a long step lands on
+    a noisy threshold, the skipped thresholds are measured one at a time,
+    so the turn on of the noise is not missed.
+    Returns vths, rates, and also the lower and upper ends of the 95%
+    confidence intervals of the rates if intervals is True.
+    """
+    points = {}
     current = vth
-    vths = []
-    delay = 8
-    while (counts < 1000):
+    step = 1
+    last_quiet = None
+    while current >= 20:
         set_config(current, driver, **kwargs)
-        counts = float(timed_count(delay, hpcntr))
-        rates.append(counts/delay)
-        vths.append(current)
-        print current
-        if counts > 10 and delay > 1:
-            delay = delay // 2
-        if delay == 8:
-            current -= 2
+        estimate = measure_rate(hpcntr, precision, rate_floor)
+        points[current] = estimate
+        print current, estimate.rate
+        if estimate.rate >= max_rate:
+            break
+        if estimate.quiet():
+            last_quiet = current
+            step = min(2 * step, max_step)
+        elif step > 1 and last_quiet is not None and last_quiet - current > 1:
+            # Stepped over the turn on, go back and fill it in.
+            step = 1
+            current = last_quiet
+            last_quiet = None
         else:
+            step = 1
+        current -= step
+        while current in points:
             current -= 1
-        if current < 20:
-            return vths,rates
+    vths = sorted(points, reverse=True)
+    rates = [points[v].rate for v in vths]
+    if intervals:
+        bounds = [points[v].interval() for v in vths]
+        return vths, rates, [low for low, high in bounds], [high for low, high in bounds]
     return vths, rates
     
 
-def scan_column(col, driver, hpcntr, hpgene, pixels=None, overwrite=False):
-    """Measure and record the voltage threshold and noise for col."""
+def scan_column(col, driver, hpcntr, hpgene, pixels=None, overwrite=False, journal=None, pixels_name='pixels.csv', progress=None):
+    """Measure and record the voltage threshold and noise for col.
+
+    Notes:
+    If journal is given, every pixel is recorded to it as soon as it is
+    measured, and the journal is compacted into pixels_name from time to
+    time. Otherwise the whole library is saved after the column.
+    progress (a profiling.Progress) is stepped after every pixel.
+    """
     if pixels is None:
-        pixels = PixelLibrary.from_file('pixels.csv')
+        pixels = PixelLibrary.from_file(pixels_name)
     for row in xrange(64):
         if pixels.is_measured(col, row): continue
         print col, row
         if not overwrite:
-            v = measure_thresh_fast(driver, hpcntr, hpgene, col, row)
+            v = measure_thresh_fast(driver, hpcntr, hpgene, col, row, raw=True, dac=pixels.get_int(col, row))
         else:
-            v = measure_thresh(driver, hpcntr, hpgene, col, row, '00001')
-        print v
+            v = measure_thresh(driver, hpcntr, hpgene, col, row, '00001', raw=True)
+        print v[:2]
         pixels.set_thresh(col, row, v[0], v[1])
-    pixels.save('pixels.csv')
+        if journal is not None:
+            journal.record(col, row, v[0], v[1], xs=v[2], counts=v[3])
+            journal.maybe_compact(pixels, pixels_name)
+        if progress is not None:
+            progress.step()
+    if journal is None:
+        pixels.save(pixels_name)
 
 
 def scan_chip(driver, hpcntr, hpgene, pixels_name='pixels_scan.csv', pixels_dac=None, overwrite=False):
-    """Measure and record the voltage threshold and noise for the large pixels on the chip."""
+    """Measure and record the voltage threshold and noise for the large pixels on the chip.
+
+    Notes:
+    Results are journaled to pixels_name.journal while scanning. If a
+    previous scan was interrupted, its journal is replayed and the scan
+    picks up at the first pixel that was not finished.
+    """
     pixels = PixelLibrary.from_file(pixels_name)
     if pixels_dac is not None:
         for col in xrange(1,17):
             for row in xrange(64):
                 pixels[col][row] = pixels_dac[col][row]
+    journal = PixelJournal.for_library(pixels_name)
+    resumed = journal.replay(pixels)
+    if resumed:
+        print "Resuming %s with %i pixels from the journal." % (pixels_name, resumed)
     state = State.from_file()
     state.enabled = -1
     state.grid = 1
     state.save()
     driver.disable_all_columns()
+    progress = profiling.Progress(int((~pixels.measured_mask()[1:17]).sum()), 'scan', time)
     for col in xrange(1,17):
-        scan_column(col, driver, hpcntr, hpgene, pixels, overwrite)
-    pixels.save(pixels_name) 
+        scan_column(col, driver, hpcntr, hpgene, pixels, overwrite, journal, pixels_name, progress)
+    journal.compact(pixels, pixels_name)
+    journal.close(remove=True)
+
+def measure_thresh_coarse(driver, hpcntr, hpgene, col, row, guess=None, width=.1, resolution=.01, ninjects=32):
+    """ Estimate the threshold of the pixel at col, row by bisecting for its 50% point.
+
+    Notes:
+    Assumes the dacbits are already set, like measure_thresh_fast, and that
+    the generator sends ninjects injections per trigger. The search starts
+    from guess +- width (or the whole range of sample_counts), widening it if
+    the 50% point is outside, and stops at resolution. The threshold is
+    interpolated between the last two amplitudes, and the noise estimated
+    from their counts if neither is saturated (otherwise it is 0).
+    Returns thresh, noise, precision, where precision is half the final
+    interval (infinite if the 50% point could not be bracketed).
+    """
+    lower_lim, upper_lim = .027, 1.3
+    driver.step_single_pixel(col, row, zero=False)
+    half = ninjects / 2.0
+    if guess is None:
+        low, high = lower_lim, upper_lim
+    else:
+        low, high = max(guess - width, lower_lim), min(guess + width, upper_lim)
+    low_count = get_count(low, hpcntr, hpgene)
+    high_count = None
+    while low_count > half and low > lower_lim:
+        low, high, high_count = max(low - 2*width, lower_lim), low, low_count
+        low_count = get_count(low, hpcntr, hpgene)
+    if high_count is None:
+        high_count = get_count(high, hpcntr, hpgene)
+    while high_count <= half and high < upper_lim:
+        low, low_count, high = high, high_count, min(high + 2*width, upper_lim)
+        high_count = get_count(high, hpcntr, hpgene)
+    if low_count > half or high_count <= half:
+        return (low + high) / 2, 0.0, float('inf')
+    while high - low > resolution:
+        mid = (low + high) / 2
+        count = get_count(mid, hpcntr, hpgene)
+        if count > half:
+            high, high_count = mid, count
+        else:
+            low, low_count = mid, count
+    thresh = low + (half - low_count) * (high - low) / (high_count - low_count)
+    noise = 0.0
+    low_frac, high_frac = float(low_count) / ninjects, float(high_count) / ninjects
+    if 0 < low_frac < high_frac < 1:
+        noise = (high - low) / (poisson.normal_quantile(1 - high_frac) - poisson.normal_quantile(1 - low_frac))
+    return thresh, noise, (high - low) / 2
+
+
+def select_fine(pixels, cols, max_precision=.005, boundaries=(), nsigma=3.0, margin=2.0):
+    """ Return the coarse pixels of cols which need a full scurve.
+
+    Notes:
+    A pixel is picked if its precision is worse than max_precision
+    (ambiguous), its threshold is more than nsigma from the median
+    (outlying, with sigma from the median absolute deviation), or it is
+    within margin precisions of one of boundaries (e.g. the edges of the
+    window a tune accepts), where the coarse value could fall either side.
+    """
+    thresh = pixels.grid_view('thresh')
+    precision = pixels.grid_view('precision')
+    coarse = pixels.grid_view('measured') == 2
+    measured = pixels.measured_mask()[cols]
+    values = thresh[cols][measured]
+    median = np.median(values) if len(values) else 0
+    sigma = 1.4826 * np.median(np.abs(values - median)) if len(values) else 0
+    fine = []
+    for col in cols:
+        for row in xrange(PixelColumn.npix):
+            if not coarse[col,row]:
+                continue
+            ambiguous = precision[col,row] > max_precision
+            outlying = sigma > 0 and abs(thresh[col,row] - median) > nsigma * sigma
+            near = any((abs(thresh[col,row] - b) < margin * precision[col,row] for b in boundaries))
+            if ambiguous or outlying or near:
+                fine.append((col, row))
+    return fine
+
+
+def scan_chip_coarse(driver, hpcntr, hpgene, pixels_name='pixels_scan.csv', pixels_dac=None, ninjects=32, resolution=.01, boundaries=()):
+    """Measure the large pixels in two passes: a coarse estimate of each, then full scurves where needed.
+
+    Notes:
+    The coarse pass runs measure_thresh_coarse on every pixel with
+    ninjects injections, starting from the prior of the pixel if there is
+    one (see use_priors), or else the median of the pixels done so far. Those pixels are marked with measured = 2 and their precision.
+    The fine pass measures a full scurve, as scan_chip does, only for the
+    pixels chosen by select_fine (boundaries are passed on to it), and
+    records the fit error as precision.
+    Results are journaled as in scan_chip, so an interrupted scan resumes
+    in whichever pass it was in.
+    """
+    pixels = PixelLibrary.from_file(pixels_name)
+    if pixels_dac is not None:
+        for col in xrange(1,17):
+            for row in xrange(64):
+                pixels[col][row] = pixels_dac[col][row]
+    journal = PixelJournal.for_library(pixels_name)
+    resumed = journal.replay(pixels)
+    if resumed:
+        print "Resuming %s with %i pixels from the journal." % (pixels_name, resumed)
+    state = State.from_file()
+    state.enabled = -1
+    state.grid = 1
+    state.save()
+    driver.disable_all_columns()
+    cols = range(1,17)
+
+    chip.set_hpgene_injects(hpgene, ninjects)
+    try:
+        progress = profiling.Progress(int((~pixels.measured_mask()[cols]).sum()), 'coarse scan', time)
+        for col in cols:
+            for row in xrange(64):
+                if pixels.is_measured(col, row): continue
+                done = pixels.measured_mask()[cols]
+                guess = np.median(pixels.grid_view('thresh')[cols][done]) if done.any() else None
+                prior = pixel_prior(col, row, pixels.get_int(col, row))
+                if prior is not None:
+                    guess = prior[0]
+                thresh, noise, precision = measure_thresh_coarse(driver, hpcntr, hpgene, col, row, guess, resolution=resolution, ninjects=ninjects)
+                print col, row, thresh, precision
+                pixels.set_thresh(col, row, thresh, noise, precision, coarse=True)
+                journal.record(col, row, thresh, noise, precision=precision, coarse=True)
+                journal.maybe_compact(pixels, pixels_name)
+                progress.step()
+    finally:
+        # Everything else expects the full number of injections.
+        chip.set_hpgene_injects(hpgene, 255)
+
+    fine = select_fine(pixels, cols, resolution / 2, boundaries)
+    print "Measuring %i of %i pixels in full." % (len(fine), len(cols) * PixelColumn.npix)
+    progress = profiling.Progress(len(fine), 'fine scan', time)
+    for col, row in fine:
+        print col, row
+        driver.step_single_pixel(col, row, zero=False)
+        xs, counts = sample_counts(hpcntr, hpgene, prior=(pixels.get_thresh(col, row), pixels.get_noise(col, row)))
+        thresh, noise, precision = fit_scurve(xs, counts, errors=True)
+        print thresh, noise
+        pixels.set_thresh(col, row, thresh, noise, precision)
+        journal.record(col, row, thresh, noise, xs=xs, counts=counts, precision=precision)
+        journal.maybe_compact(pixels, pixels_name)
+        progress.step()
+    journal.compact(pixels, pixels_name)
+    journal.close(remove=True)
+    return pixels
 
 def scan_small(driver, hpcntr, hpgene, pixels_name='pixels_scan_small.csv', pixels_dac=None):
     """Measure and record the voltage threshold and noise for the large pixels on the chip."""
@@ -774,14 +1569,19 @@ def scan_small(driver, hpcntr, hpgene, pixels_name='pixels_scan_small.csv', pixe
         for col in [0,17]:
             for row in xrange(64):
                 pixels[col][row] = pixels_dac[col][row]
+    journal = PixelJournal.for_library(pixels_name)
+    resumed = journal.replay(pixels)
+    if resumed:
+        print "Resuming %s with %i pixels from the journal." % (pixels_name, resumed)
     state = State.from_file()
     state.grid = -1
     state.enabled = -1
     state.save()
     driver.disable_all_columns()
     for col in [0,17]:
-        scan_column(col, driver, hpcntr, hpgene, pixels=pixels)
-    pixels.save(pixels_name) 
+        scan_column(col, driver, hpcntr, hpgene, pixels, journal=journal, pixels_name=pixels_name)
+    journal.compact(pixels, pixels_name)
+    journal.close(remove=True)
 
 
 def tune_pixel(driver, hpcntr, hpgene, col, row, target, orig, noise, perbit, orig_index=16):
@@ -845,10 +1645,38 @@ def tune_pixel_careful(driver, hpcntr, hpgene, col, row, target, orig_bits, orig
     return best_index, best_thresh, noise
 
 
+def open_tune_journal(new_pix, cols, outname):
+    """ Open the journal of a tune of cols into outname, and return it.
+
+    Notes:
+    If the journal is there, the last tune was interrupted: it is
+    replayed into new_pix, and the pixels it finished are skipped.
+    Otherwise this is a new tune, so cols are marked as not measured and
+    saved to outname first; pixels left in the file by an earlier tune
+    (e.g. to another target) are tuned again rather than kept.
+    """
+    resuming = os.path.isfile(PixelJournal.name_for(outname))
+    journal = PixelJournal.for_library(outname)
+    if resuming:
+        journal.replay(new_pix)
+    else:
+        new_pix.data['measured'][cols] = 0
+        journal.compact(new_pix, outname)
+    return journal
+
+
 def tune_columns(driver, hpcntr, hpgene, cols, target, perbit, orig_pix, new_pix=None, outname='pixels_tune1.csv'):
-    """ Tune all of the columns in cols using the fast algorithm, and save. """
+    """ Tune all of the columns in cols using the fast algorithm, and save. 
+
+    Notes:
+    Each tuned pixel is journaled to outname.journal, so an interrupted
+    tune resumes where it stopped. A new tune redoes every pixel of cols
+    (see open_tune_journal).
+    """
     if new_pix is None:
-        new_pix = PixelLibrary.from_file('pixels_tune1.csv')
+        new_pix = PixelLibrary.from_file(outname)
+    journal = open_tune_journal(new_pix, cols, outname)
+    progress = profiling.Progress(int((~new_pix.measured_mask()[cols]).sum()), 'tune', time)
     for col in cols:
         for row in xrange(PixelColumn.npix):
             if new_pix.is_measured(col, row): continue
@@ -857,34 +1685,220 @@ def tune_columns(driver, hpcntr, hpgene, cols, target, perbit, orig_pix, new_pix
             print dacbits, thresh, error
             new_pix[col][row] = dacbits
             new_pix.set_thresh(col, row, thresh, error)
-        new_pix.save(outname)
-    new_pix.save(outname)
+            journal.record(col, row, thresh, error, dac=dacbits)
+            journal.maybe_compact(new_pix, outname)
+            progress.step()
+    journal.compact(new_pix, outname)
+    journal.close(remove=True)
 
 
-def tune_columns_careful(driver, hpcntr, hpgene, cols, target, perbit, orig_pix, new_pix=None):
+def tune_columns_careful(driver, hpcntr, hpgene, cols, target, perbit, orig_pix, new_pix=None, outname='pixels_tune2.csv'):
     """ Tune all of the columns in cols using the careful algorithm, and save. 
 
     Notes:
     If a given pixels is already with 1.5*perbit from the target, it is skipped.
+    Each tuned pixel is journaled to outname.journal, so an interrupted
+    tune resumes where it stopped. A new tune redoes every pixel of cols
+    (see open_tune_journal).
     """
     if new_pix is None:
-        new_pix = PixelLibrary.from_file('pixels_tune2.csv')
+        new_pix = PixelLibrary.from_file(outname)
+    journal = open_tune_journal(new_pix, cols, outname)
+    progress = profiling.Progress(int((~new_pix.measured_mask()[cols]).sum()), 'careful tune', time)
     for col in cols:
         for row in xrange(PixelColumn.npix):
+            if new_pix.is_measured(col, row): continue
             if abs(target - orig_pix.get_thresh(col, row)) < 1.0 * perbit: 
                 dacbits = orig_pix[col][row]
                 thresh = orig_pix.get_thresh(col,row)
                 error = orig_pix.get_noise(col,row)
                 new_pix[col][row] = dacbits
                 new_pix.set_thresh(col, row, thresh, error)
+                progress.step()
                 continue
             print col, row
             dacbits, thresh, error = tune_pixel_careful(driver, hpcntr, hpgene, col, row, target, orig_pix[col][row], orig_pix.get_thresh(col,row), perbit)
             print dacbits, thresh, error
             new_pix[col][row] = dacbits
             new_pix.set_thresh(col, row, thresh, error)
-        new_pix.save('pixels_tune2.csv')
-    new_pix.save('pixels_tune2.csv')
+            journal.record(col, row, thresh, error, dac=dacbits)
+            journal.maybe_compact(new_pix, outname)
+            progress.step()
+    journal.compact(new_pix, outname)
+    journal.close(remove=True)
+
+
+# Fixed per-pixel record layout of a DacModel.
+MODEL_DTYPE = np.dtype([('offset', np.float64), ('slope', np.float64), ('resid', np.float64), ('valid', np.int8)])
+
+
+class DacModel:
+    """ Per-pixel linear model of the threshold against the tdac code.
+
+    Notes:
+    For every pixel thresh = offset + slope * code, fitted to a few codes
+    which are each measured for the whole chip at once. resid is the rms
+    residual of the fit (zero if only two codes were measured), and valid
+    is 1 where the fit could be made. The model is an (ncols, 64) array
+    of MODEL_DTYPE records and is saved with numpy (.npy), so that it can
+    be reused by the next tune.
+    """
+    def __init__(self, ncols=18, data=None):
+        if data is None:
+            data = np.zeros((ncols, PixelColumn.npix), dtype=MODEL_DTYPE)
+        self.data = data
+
+    @classmethod
+    def from_file(cls, fname):
+        return cls(data=np.load(fname))
+
+    def save(self, fname):
+        np.save(fname, self.data)
+
+    def fit(self, codes, libraries, cols=range(1,17)):
+        """ Fit the pixels of cols, given a PixelLibrary of measured thresholds for each code. """
+        codes = np.array(codes, dtype=float)
+        thresh = np.array([lib.grid_view('thresh')[cols] for lib in libraries])
+        measured = np.array([lib.measured_mask()[cols] for lib in libraries]).all(axis=0)
+        dc = codes - codes.mean()
+        mean = thresh.mean(axis=0)
+        slope = np.tensordot(dc, thresh - mean, axes=1) / (dc**2).sum()
+        offset = mean - slope * codes.mean()
+        predicted = offset + slope * codes[:,np.newaxis,np.newaxis]
+        self.data['offset'][cols] = offset
+        self.data['slope'][cols] = slope
+        self.data['resid'][cols] = np.sqrt(((thresh - predicted)**2).mean(axis=0))
+        self.data['valid'][cols] = measured & (slope != 0)
+
+    def valid_mask(self):
+        return self.data['valid'].astype(bool)
+
+    def predict(self, codes):
+        """ Predicted threshold of every pixel at codes (a number or an (ncols, 64) array). """
+        return self.data['offset'] + self.data['slope'] * codes
+
+    def solve(self, target):
+        """ Return the best code for every pixel and the expected error of the threshold at that code. 
+
+        Notes:
+        The expected error is the distance of the prediction from target
+        plus the rms residual of the fit. It is infinite for invalid pixels.
+        """
+        valid = self.valid_mask()
+        slope = np.where(valid, self.data['slope'], 1.0)
+        codes = np.clip(np.rint((target - self.data['offset']) / slope), 0, 31).astype(int)
+        error = np.abs(self.predict(codes) - target) + self.data['resid']
+        error[~valid] = np.inf
+        return codes, error
+
+
+def acquire_dac_model(driver, hpcntr, hpgene, cols=range(1,17), codes=(4,16,28)):
+    """ Measure every pixel at each of codes and fit a DacModel.
+
+    Notes:
+    For each code the whole chip is set to that code, then scanned with
+    scan_chip into pixels_dac_<code>.csv, so an interrupted acquisition
+    resumes from those files. They are removed once the fit is done.
+    """
+    libraries = []
+    names = []
+    for code in codes:
+        pixels_dac = PixelLibrary()
+        pixels_dac.data['dacs'] = code
+        pixels_dac.data['fixed'] = 1
+        apply_image(setup_image(pixels_dac, cols=cols), driver)
+        name = 'pixels_dac_%i.csv' % code
+        scan_chip(driver, hpcntr, hpgene, pixels_name=name, pixels_dac=pixels_dac)
+        libraries.append(PixelLibrary.from_file(name))
+        names.append(name)
+    model = DacModel()
+    model.fit(codes, libraries, cols)
+    for name in names:
+        os.remove(name)
+    return model
+
+
+def tune_chip_model(driver, hpcntr, hpgene, cols=range(1,17), codes=(4,16,28), target=None, tol=None, model_name='dac_model.npy', outname='pixels_tune_model.csv', nsample=32):
+    """ Tune every pixel in cols at once using a per-pixel DacModel, and save.
+
+    Notes:
+    The model is read from model_name if it exists, otherwise it is
+    acquired and saved there. The best code of every pixel is solved
+    from the model and written to the chip, then only the pixels whose
+    expected error exceeds tol are measured; those which really are off
+    by more than tol are tuned with tune_pixel_careful. When an old model
+    is reused, nsample other pixels are also checked, and the model is
+    acquired again if they show it has drifted.
+    target defaults to the median predicted threshold at code 16 (as the
+    average at dac 16 in main_tune), tol to .75 of the median slope.
+    Thresholds of pixels that were not measured are model predictions,
+    marked with measured = 2 and the model's expected error as precision.
+    The columns of the pixels tuned carefully are written again at the
+    end, since tune_pixel_careful clears them.
+    """
+    # Kept for a model acquired again, whose target and tol are derived anew.
+    target_arg, tol_arg = target, tol
+    reused = os.path.isfile(model_name)
+    if reused:
+        model = DacModel.from_file(model_name)
+    else:
+        model = acquire_dac_model(driver, hpcntr, hpgene, cols, codes)
+        model.save(model_name)
+    valid = model.valid_mask()[cols]
+    perbit = np.median(np.abs(model.data['slope'][cols][valid]))
+    if target is None:
+        target = np.median(model.predict(16)[cols][valid])
+    if tol is None:
+        tol = .75 * perbit
+    print "Target: %f Perbit: %f Tolerance: %f" % (target, perbit, tol)
+
+    dacs, error = model.solve(target)
+    pixels = PixelLibrary()
+    for col in cols:
+        pixels.data['dacs'][col] = dacs[col]
+        pixels.data['fixed'][col] = 1
+        pixels.data['thresh'][col] = model.predict(dacs)[col]
+        pixels.data['measured'][col] = 2
+        pixels.data['precision'][col] = error[col]
+    apply_image(setup_image(pixels, cols=cols), driver)
+
+    verify = [(col, row) for col in cols for row in xrange(PixelColumn.npix) if error[col,row] > tol]
+    if reused:
+        others = [(col, row) for col in cols for row in xrange(PixelColumn.npix) if error[col,row] <= tol]
+        sample = sorted(random.sample(others, min(nsample, len(others))))
+        drift = []
+        for col, row in sample:
+            thresh, noise = measure_thresh_fast(driver, hpcntr, hpgene, col, row)
+            pixels.set_thresh(col, row, thresh, noise, 0)
+            drift.append(abs(thresh - model.predict(dacs[col,row])[col,row]))
+        if drift and np.median(drift) > tol:
+            print "The model in %s has drifted (median error %f), measuring it again." % (model_name, np.median(drift))
+            os.remove(model_name)
+            return tune_chip_model(driver, hpcntr, hpgene, cols, codes, target_arg, tol_arg, model_name, outname, nsample)
+    print "Verifying %i pixels." % len(verify)
+
+    failures = []
+    progress = profiling.Progress(len(verify), 'verify', time)
+    for col, row in verify:
+        thresh, noise = measure_thresh_fast(driver, hpcntr, hpgene, col, row)
+        pixels.set_thresh(col, row, thresh, noise, 0)
+        if abs(thresh - target) > tol:
+            failures.append((col, row, thresh))
+        progress.step()
+    # tune_pixel_careful clears columns, so it has to come after all of the verification.
+    print "Tuning %i pixels carefully." % len(failures)
+    progress = profiling.Progress(len(failures), 'careful tune', time)
+    for col, row, thresh in failures:
+        dacbits, thresh, noise = tune_pixel_careful(driver, hpcntr, hpgene, col, row, target, int(dacs[col,row]), thresh, perbit)
+        pixels[col][row] = dacbits
+        pixels.set_thresh(col, row, thresh, noise, 0)
+        progress.step()
+    # ...which wiped the tdacs of the rest of those columns: write them back.
+    cleared = sorted(set(col for col, row, thresh in failures))
+    if cleared:
+        apply_image(setup_image(pixels, cols=cleared), driver)
+    pixels.save(outname)
+    return pixels
 
 
 def test_dac():
@@ -903,33 +1917,139 @@ def test_dac():
 
 
 
-def find_minimum_vth(driver, min_time, vth=150, **kwargs):
+def find_minimum_vth(driver, min_time, vth=150, window=1.0, resolution=1, full_output=False, **kwargs):
     """ Find the minimum vth which does not produce any hits in min_time. 
 
     Notes:
     This does not change the enabled/disabled state of any pixels, so it
     can be used for a single pixel up to the whole chip, depending on the
     hit enable bit of the pixels.
+    Noise hits are a Poisson process whose rate falls with vth, so a hit
+    proves a threshold is noisy while a quiet window only makes it likely
+    to be quiet. The search steps vth down by 10 until it sees hits, then
+    bisects down to resolution, each probe waiting at most window seconds
+    for a hit. Only the final threshold waits out the whole min_time
+    (counting the time it was already watched). If a hit comes during
+    that confirmation, the search continues above it.
+    With full_output, returns (vth, rate_limit), where rate_limit is the
+    upper end (Hz) of the 95% confidence interval on the noise rate at
+    vth, from the total time it was watched without a hit.
     """
+    watched = {}
+    current = [None]
+    def quiet(v, max_time):
+        # Wait up to max_time for a hit at v. True if there was none.
+        if current[0] != v:
+            set_config(v, driver, **kwargs)
+            current[0] = v
+        waited = time_until_hit(chip.hpcntr, max_time)
+        watched[v] = watched.get(v, 0.0) + min(waited, max_time)
+        return waited >= max_time
+
     set_config(vth, driver, **kwargs)
-    delay = 1
+    current[0] = vth
     time.sleep(1) #let noise clear
-    # decrement until I start getting noise hits in 1 second.
-    while (timed_count(delay, chip.hpcntr) == 0 ):
+    # decrement until I start getting noise hits in window.
+    candidates = [vth]
+    while quiet(vth, window):
         print vth
+        candidates.append(vth)
         vth -= 10
         if vth <= 0:
             raise ValueError("Reached VbpTh <= 0, which really shouldn't have happened.")
-        set_config(vth, driver, **kwargs)
-    
-    # increment until I just stop getting any noise hits in 60 seconds.
-    while (time_until_hit(chip.hpcntr, min_time) < min_time ):
-        vth += 2
-        if vth >= 150:
-            raise ValueError("Reached VbpTh >= 150, which really shouldn't have happened.")
-        set_config(vth, driver, **kwargs)
-        print vth
-    return vth
+    noisy = vth
+    while True:
+        candidates = sorted((v for v in candidates if v > noisy))
+        if not candidates:
+            # Everything above has been noisy, so continue upwards.
+            candidates = [noisy + 10]
+            if candidates[0] >= 150:
+                raise ValueError("Reached VbpTh >= 150, which really shouldn't have happened.")
+        high = candidates[0]
+        # bisect between the last noisy and the first quiet threshold with short windows.
+        while high - noisy > resolution:
+            mid = (noisy + high) // 2
+            print mid
+            if quiet(mid, window):
+                high = mid
+                candidates.append(mid)
+            else:
+                noisy = mid
+        # confirm the full quiet window.
+        remaining = min_time - watched.get(high, 0.0)
+        if remaining <= 0 or quiet(high, remaining):
+            break
+        print "Hit while confirming %i." % high
+        noisy = high
+    rate_limit = poisson.rate_interval(0, watched[high])[1]
+    print "Minimum vth: %i (noise rate below %.3g Hz at 95%%)" % (high, rate_limit)
+    if full_output:
+        return high, rate_limit
+    return high
+
+
+def find_noisy_pixels(driver, hpcntr, vth, gate=1.0, max_gate=4.0, cols=range(1,17)):
+    """ Find the pixels of cols which give noise hits at vth, and save them to the NoiseMask.
+
+    Notes:
+    Hit is enabled on every pixel of cols, and hitOr on one group of them
+    at a time: first all of them, then the halves of any group which gave
+    hits in a gate of gate seconds, and so on down to single pixels. The
+    groups are in column order, so they split by columns before rows. k
+    noisy pixels take about k*log2(npixels) gates instead of one each.
+    A pixel that fired in a group may be quiet in the next gate, so if
+    neither half of a noisy group gives hits, both are tried again with
+    the gate doubled, up to max_gate, before the group is given up on.
+    The mask entries for cols are replaced by the pixels found.
+    Returns the noisy pixels.
+    """
+    set_config(vth, driver)
+    base = chip.image.copy()
+    base.global_register = None
+    for col in cols:
+        base.set_plane('hit', col, '1'*chipimage.MAXROWS)
+        base.set_plane('inject', col, '1'*chipimage.MAXROWS)
+    gates = [0]
+    def hits(group, delay):
+        members = set(group)
+        desired = base.copy()
+        for col in xrange(desired.ncols):
+            desired.set_plane('hit_or_not', col, ''.join(('0' if (col, row) in members else '1' for row in xrange(chipimage.MAXROWS))))
+        driver.apply_ops(chipimage.compile_diff(chip.image, desired))
+        gates[0] += 1
+        return timed_count(delay, hpcntr) > 0
+
+    noisy = []
+    def search(group, delay):
+        if len(group) == 1:
+            print "Noisy pixel: %i %i" % group[0]
+            noisy.append(group[0])
+            return
+        first, second = group[:len(group)//2], group[len(group)//2:]
+        first_hits, second_hits = hits(first, delay), hits(second, delay)
+        while not first_hits and not second_hits and delay < max_gate:
+            delay *= 2
+            first_hits, second_hits = hits(first, delay), hits(second, delay)
+        if not first_hits and not second_hits:
+            print "Lost the hits from %i pixels starting at %i %i." % (len(group), group[0][0], group[0][1])
+        if first_hits:
+            search(first, delay)
+        if second_hits:
+            search(second, delay)
+
+    everything = [(col, row) for col in cols for row in xrange(chipimage.MAXROWS)]
+    if hits(everything, gate):
+        search(everything, gate)
+    print "Found %i noisy pixels in %i gates." % (len(noisy), gates[0])
+
+    mask = NoiseMask.from_file()
+    mask.pixels = set(pixel for pixel in mask.pixels if pixel[0] not in cols) | set(noisy)
+    mask.save()
+    state = State.from_file()
+    state.enabled = -1
+    state.hitor = -1
+    state.save()
+    return noisy
 
 
 def main_minimize_untuned():
@@ -956,13 +2076,17 @@ def main_tune(args):
     """ Tune the entire chip, saving results to pixels_tune1.csv and pixels_tune2.csv. 
 
     Notes:
-    Takes about 7 hours to run.
+    Takes about 7 hours to run (pix.py --dry-run tune predicts it for the
+    current settings).
     The first tune is based on a scan of the chip, made by running main_scan.
     The results of the first tune are saved in pixels_tune1.csv. This tune applies
     to every pixel, but can be inaccurate.
     The results of the second tune are saved in pixels_tune2.csv. This tune applies
     only to pixels which are not close to target after the first tune, and is guaranteed
     to find the best possible dac setting.
+    With --model, the chip is instead tuned with tune_chip_model and saved
+    to pixels_tune_model.csv, which measures each pixel at three codes once
+    (or reuses dac_model.npy) and only re-measures pixels that need it.
     """
     chip.init_hpgene(chip.hpgene, 255)
     chip.init_hpcntr(chip.hpcntr)
@@ -979,17 +2103,22 @@ def main_tune(args):
     state.save()
 
     enable_hitor_chip(driver)
+    if args.model:
+        tune_chip_model(driver, chip.hpcntr, chip.hpgene)
+        return
     #perbit=.01285
     # determine perbit using random pixels
     all_pixels = [(x,y) for x in xrange(1,17) for y in xrange(64)]
     test_pixels = random.sample(all_pixels, 100)
     dac0 = []
     dac16 = []
+    progress = profiling.Progress(len(test_pixels), 'perbit', time)
     for pix in test_pixels:
         dac0.append(measure_thresh(driver, chip.hpcntr, chip.hpgene, pix[0], pix[1], '00000')[0])
         print dac0[-1]
         dac16.append(measure_thresh(driver, chip.hpcntr, chip.hpgene, pix[0], pix[1], '00001')[0])
         print dac16[-1]
+        progress.step()
     dac0, dac16 = np.array(dac0), np.array(dac16)
     target1 = np.average(dac16)
     print "First target: ", target1
@@ -1008,7 +2137,16 @@ def main_scan(args):
 
     Notes: If pixels_dac_name is provided, it uses the pixel dac settings
     stored in that file to set the dac thresholds before scanning.
+    With --coarse, the scan is done by scan_chip_coarse, and every pixel
+    whose coarse threshold is near one of the --boundary values gets a
+    full scurve.
+    With --warm, each pixel starts from its prior in priors.dat (or
+    pixels_tune_final.csv, tuned at vth 150), see use_priors.
     """
+    scan = scan_chip_coarse if args.coarse else scan_chip
+    options = {'boundaries': args.boundaries} if args.coarse else {}
+    if args.warm:
+        use_priors(libraries=[('pixels_tune_final.csv', 150)])
     chip.init_hpgene(chip.hpgene, 255)
     chip.init_hpcntr(chip.hpcntr)
     set_config(args.vth)
@@ -1021,13 +2159,19 @@ def main_scan(args):
         pixels_dac = PixelLibrary.from_file(args.pixels)
         write_chip_tuned(pixels_dac, driver)
         enable_hitor_chip(driver)
-        scan_chip(driver, chip.hpcntr, chip.hpgene, pixels_dac = pixels_dac)
+        scan(driver, chip.hpcntr, chip.hpgene, pixels_dac = pixels_dac, **options)
     else:
         enable_hitor_chip(driver)
-        scan_chip(driver, chip.hpcntr, chip.hpgene)
+        scan(driver, chip.hpcntr, chip.hpgene, **options)
 
 def main_detuning_scan(min_vth=82, max_vth=150):
-    """ Scan the thresholds of the chip at several vth, and save to pixels_scan_vth.    """
+    """ Scan the thresholds of the chip at several vth, and save to pixels_scan_vth.    
+
+    The vth values are scheduled starting from the vth the chip is already at.
+    Each pixel starts from a prior interpolated across vth from the scans
+    done so far (including earlier pixels_scan_vth files, and the tuning
+    at vth 150), see use_priors.
+    """
     chip.init_hpgene(chip.hpgene, 255)
     chip.init_hpcntr(chip.hpcntr)
     driver1 = chip.DgeneDriver(chip.dgene, config_size=800)
@@ -1037,13 +2181,18 @@ def main_detuning_scan(min_vth=82, max_vth=150):
     if state.tuned != 1:
         print "tuning"
         driver2.init_blocks()
-        write_chip_tuned(pixels_dac, driver)
-    for vth in np.linspace(min_vth, max_vth, 5):
-        vth = int(vth)
+        write_chip_tuned(pixels_dac, driver2)
+    def set_vth(vth):
         driver1.init_blocks()
         set_config(vth, driver1)
+    def scan(point):
         driver2.init_blocks()
-        scan_chip(driver2, chip.hpcntr, chip.hpgene, pixels_name = 'pixels_scan_%i.csv' % vth, pixels_dac = pixels_dac)
+        scan_chip(driver2, chip.hpcntr, chip.hpgene, pixels_name = 'pixels_scan_%i.csv' % point['vth'], pixels_dac = pixels_dac)
+    experiment = schedule.Experiment()
+    experiment.setting('vth', set_vth, schedule.COSTS['vth'] + schedule.COSTS['driver'])
+    points = [{'vth': int(vth)} for vth in np.linspace(min_vth, max_vth, 5)]
+    use_priors(libraries=[('pixels_tune_final.csv', 150)] + [('pixels_scan_%i.csv' % point['vth'], point['vth']) for point in points])
+    experiment.run(points, scan, start={'vth': State.from_file().vth})
 
 def main_chip_thresholds():
     """ Find minimum thresholds for each clock/count setting for the entire chip."""
@@ -1114,22 +2263,24 @@ def main_column_counts():
                       'count':  {'count_hits_not':'1', 'count_clear_not':'1', 'count_enable':'1'},
                       'readout':{'count_hits_not':'1', 'count_clear_not':'1', 'count_enable':'1', 
                                  'global_readout_enable':'1'}}
-    outfile = open('column_counts.csv', 'w')
-    for col in [1,2,3,6,15,16]:
-        for config, option in config_options.iteritems():
-            if config == 'none':
-                driver.disable_count_clock()
-            else:
-                driver.enable_count_clock()
-            outfile.write('Column: %i Config: %s\n' % (col,config))
-            vths, rates = measure_counts(driver, chip.hpcntr, vth=70, config_mode = '11')
-            outfile.write(','.join((str(vth) for vth in vths)) + '\n')
-            outfile.write(','.join((str(rate) for rate in rates)) + '\n')
-    outfile.close()
+    experiment = schedule.Experiment()
+    experiment.setting('clock', count_clock_setter(driver))
+    points = [{'col': col, 'config': config, 'clock': config != 'none'} for col in [1,2,3,6,15,16] for config in config_options]
+    def write(outfiles, point, result):
+        outfile = outfiles[0]
+        vths, rates = result
+        outfile.write('Column: %i Config: %s\n' % (point['col'],point['config']))
+        outfile.write(','.join((str(vth) for vth in vths)) + '\n')
+        outfile.write(','.join((str(rate) for rate in rates)) + '\n')
+    run_experiment(experiment, points, lambda point: measure_counts(driver, chip.hpcntr, vth=70, config_mode = '11'), ['column_counts.csv'], write)
 
 
 def main_column_counts_chip_enabled():
-    """ Measure dark rate for selected columns with chip enabled. """
+    """ Measure dark rate for selected columns with chip enabled. 
+
+    The hitOr of each column is switched with the same driver that
+    measures, so the blocks are only set up once.
+    """
     chip.init_hpgene(chip.hpgene, 255)
     chip.init_hpcntr(chip.hpcntr)
     state = State.from_file()
@@ -1149,23 +2300,22 @@ def main_column_counts_chip_enabled():
                       'count':  {'config_mode':'11','count_hits_not':'1', 'count_clear_not':'1', 'count_enable':'1'},
                       'readout':{'config_mode':'11','count_hits_not':'1', 'count_clear_not':'1', 'count_enable':'1', 
                                  'global_readout_enable':'1'}}
-    outfile = open('column_counts_chip_redo.csv', 'w')
-    for col in [1,2,3,6,15,16]:
+    def set_column(col):
         print col
-        driver_setup.init_blocks()
-        driver_setup.disable_hitor_all_columns()
-        driver_setup.enable_hitor_single_column(col)
-        driver.init_blocks()
-        for config, option in config_options.iteritems():
-            if config == 'none':
-                driver.disable_count_clock()
-            else:
-                driver.enable_count_clock()
-            outfile.write('Column: %i Config: %s\n' % (col,config))
-            vths, rates = measure_counts(driver, chip.hpcntr, vth=70, config_mode = '11')
-            outfile.write(','.join((str(vth) for vth in vths)) + '\n')
-            outfile.write(','.join((str(rate) for rate in rates)) + '\n')
-    outfile.close()
+        driver.disable_hitor_all_columns()
+        driver.enable_hitor_single_column(col)
+    driver.init_blocks()
+    experiment = schedule.Experiment()
+    experiment.setting('col', set_column, schedule.COSTS['column'])
+    experiment.setting('clock', count_clock_setter(driver))
+    points = [{'col': col, 'config': config, 'clock': config != 'none'} for col in [1,2,3,6,15,16] for config in config_options]
+    def write(outfiles, point, result):
+        outfile = outfiles[0]
+        vths, rates = result
+        outfile.write('Column: %i Config: %s\n' % (point['col'],point['config']))
+        outfile.write(','.join((str(vth) for vth in vths)) + '\n')
+        outfile.write(','.join((str(rate) for rate in rates)) + '\n')
+    run_experiment(experiment, points, lambda point: measure_counts(driver, chip.hpcntr, vth=70, config_mode = '11'), ['column_counts_chip_redo.csv'], write)
     enable_hitor_chip()
 
 
@@ -1206,6 +2356,9 @@ def main_pixel_scurve(vth=84):
     """ Measure and record scurves of pixels spaced throughout chip.
     
     Tunes the chip and sets threshold to the tuning threshold.
+    The pixels are measured in the order that switches the count clock
+    least, and written to scurves.csv in the usual order (see
+    run_experiment for what is kept if the run stops early).
     """
     chip.init_hpgene(chip.hpgene, 255)
     chip.init_hpcntr(chip.hpcntr)
@@ -1228,22 +2381,21 @@ def main_pixel_scurve(vth=84):
                       'readout':{'count_hits_not':'1', 'count_clear_not':'1', 'count_enable':'1', 
                                  'global_readout_enable':'1'}}
     
-    outfile = open('scurves.csv', 'w')
-    for col in [1,2,3,6,15,16]:
-        for row in [0,31]:
-            print col, row
-            for config, options in config_options.iteritems():
-                if config == 'none':
-                    driver.disable_count_clock()
-                else:
-                    driver.enable_count_clock()
-                driver.enable_single_pixel(col, row, zero=False, **options)
-                xs, counts = sample_counts(chip.hpcntr, chip.hpgene)
-                vth, noise = fit_scurve(xs, counts)
-                outfile.write('Column: %i Row: %i Config: %s Vth: %.4f Noise: %.4f\n' % (col, row, config, vth, noise))
-                outfile.write(','.join((str(x) for x in xs)) + '\n')
-                outfile.write(','.join((str(count) for count in counts)) + '\n')
-    outfile.close()
+    def measure(point):
+        print point['col'], point['row']
+        driver.enable_single_pixel(point['col'], point['row'], zero=False, **config_options[point['config']])
+        xs, counts = sample_counts(chip.hpcntr, chip.hpgene)
+        return (xs, counts) + tuple(fit_scurve(xs, counts))
+    experiment = schedule.Experiment()
+    experiment.setting('clock', count_clock_setter(driver))
+    points = [{'col': col, 'row': row, 'config': config, 'clock': config != 'none'} for col in [1,2,3,6,15,16] for row in [0,31] for config in config_options]
+    def write(outfiles, point, result):
+        outfile = outfiles[0]
+        xs, counts, vth, noise = result
+        outfile.write('Column: %i Row: %i Config: %s Vth: %.4f Noise: %.4f\n' % (point['col'], point['row'], point['config'], vth, noise))
+        outfile.write(','.join((str(x) for x in xs)) + '\n')
+        outfile.write(','.join((str(count) for count in counts)) + '\n')
+    run_experiment(experiment, points, measure, ['scurves.csv'], write)
 
 
 def main_pixel_setup_single(col, row, vth=150):
@@ -1257,11 +2409,9 @@ def main_pixel_setup_single(col, row, vth=150):
     chip.init_hpcntr(chip.hpcntr)
     driver = chip.DgeneDriver(chip.dgene, config_size=800)
     driver.init_blocks()
-    driver.enable_hitor_all_columns()
-    driver.disable_all_columns()
 
     set_config(vth, driver)
-    driver.enable_single_pixel(col, row, zero=False)
+    apply_image(setup_image(enabled=(col, row)), driver)
 
 
 def main_test_pixel_analog(col, row, chip_noise=False, freq=50):
@@ -1373,35 +2523,35 @@ def main_test_pixel_digital(col, row, chip_noise=False, freq=50, configs=['none'
         driver.enable_hitor_single_pixel(col, row)
         enable_chip(driver)
     
-    outfile_rate = open('pixel_test_darkrate'+suffix, 'w')
-    outfile_scurve = open('pixel_test_scurve'+suffix, 'w')
-    for config, options in config_options.iteritems():
-        if config == 'none':
-            driver.disable_count_clock()
-        else:
-            driver.enable_count_clock(freq)
+    def measure(point):
+        options = config_options[point['config']]
         vths, rates = measure_counts(driver, chip.hpcntr, vth=140, **options)
-        outfile_rate.write('Column: %i Row: %i Config: %s\n' % (col, row, config))        
-        outfile_rate.write(','.join((str(vth) for vth in vths)) + '\n')
-        outfile_rate.write(','.join((str(rate) for rate in rates)) + '\n')
         min_vth = max((vths[i] for i in xrange(len(vths)) if rates[i] >= 1.0 ))
         print min_vth
+        scurves = []
         if address == col:
-            set_config(min_vth, driver, **options)
-            xs, counts = sample_counts(chip.hpcntr, chip.hpgene)
-            vth, noise = fit_scurve(xs, counts)
-            outfile_scurve.write('Column: %i Row: %i Config: %s Vth: %.4f Noise: %.4f Vbpth: %i\n' % (col, row, config, vth, noise, min_vth))
-            outfile_scurve.write(','.join((str(x) for x in xs)) + '\n') 
-            outfile_scurve.write(','.join((str(count) for count in counts)) + '\n')        
-
-            set_config(min_vth+5, driver, **options)
-            xs, counts = sample_counts(chip.hpcntr, chip.hpgene)
-            vth, noise = fit_scurve(xs, counts)
-            outfile_scurve.write('Column: %i Row: %i Config: %s Vth: %.4f Noise: %.4f Vbpth: %i\n' % (col, row, config, vth, noise, min_vth+5))
+            for vbpth in [min_vth, min_vth+5]:
+                set_config(vbpth, driver, **options)
+                xs, counts = sample_counts(chip.hpcntr, chip.hpgene)
+                vth, noise = fit_scurve(xs, counts)
+                scurves.append((xs, counts, vth, noise, vbpth))
+        return vths, rates, scurves
+    experiment = schedule.Experiment()
+    experiment.setting('clock', count_clock_setter(driver, freq))
+    points = [{'config': config, 'clock': config != 'none'} for config in config_options]
+
+    def write(outfiles, point, result):
+        outfile_rate, outfile_scurve = outfiles
+        vths, rates, scurves = result
+        config = point['config']
+        outfile_rate.write('Column: %i Row: %i Config: %s\n' % (col, row, config))        
+        outfile_rate.write(','.join((str(vth) for vth in vths)) + '\n')
+        outfile_rate.write(','.join((str(rate) for rate in rates)) + '\n')
+        for xs, counts, vth, noise, vbpth in scurves:
+            outfile_scurve.write('Column: %i Row: %i Config: %s Vth: %.4f Noise: %.4f Vbpth: %i\n' % (col, row, config, vth, noise, vbpth))
             outfile_scurve.write(','.join((str(x) for x in xs)) + '\n') 
             outfile_scurve.write(','.join((str(count) for count in counts)) + '\n')        
-    outfile_rate.close()
-    outfile_scurve.close()
+    run_experiment(experiment, points, measure, ['pixel_test_darkrate'+suffix, 'pixel_test_scurve'+suffix], write)
 
 def test_config_current(vth=84):
     driver = chip.DgeneDriver(chip.dgene, config_size=800)
@@ -1459,6 +2609,20 @@ def main_noise(args):
     main_test_pixel_digital(args.col, args.row, True, args.freq, configs=['none','count'], config_mode='11')
     return
 
+def main_noisy(args):
+    """ Find the noisy pixels at vth and save them to noise_mask.dat. """
+    chip.init_hpcntr(chip.hpcntr)
+    driver = chip.DgeneDriver(chip.dgene, config_size=800)
+    driver.init_blocks()
+    if args.pixels:
+        write_chip_tuned(PixelLibrary.from_file(args.pixels), driver)
+    find_noisy_pixels(driver, chip.hpcntr, args.vth, args.gate)
+    return
+
+def main_convert(args):
+    convert_library(args.infile, args.outfile)
+    return
+
 def main_analog(args):
     driver = chip.DgeneDriver(chip.dgene, config_size=800)
     driver.init_blocks()
@@ -1498,8 +2662,101 @@ def test_single(col, row):
     
 
 
+def use_sim(model=None, latency=None):
+    """ Run on simulated instruments, with pix.time replaced by their virtual clock. 
+
+    Notes:
+    See sim.install. Returns the sim.SimChip.
+    """
+    global time
+    import sim
+    simulation = sim.install(sim.VirtualClock(), model, latency)
+    time = simulation.clock
+    return simulation
+
+def use_replay(fname, full_speed=False, strict=True):
+    """ Run on instruments which answer from a recording (see recording.py), and return the recording.Replay.
+
+    Notes:
+    The run must start from the same data files (state.dat, pixel
+    libraries) as the recorded one. Transactions are paced to the
+    recorded timeline in real time, or with full_speed on a virtual
+    clock which replaces pix.time, so the run takes no longer than the
+    host code does.
+    """
+    global time
+    clock = time
+    if full_speed:
+        import sim
+        clock = time = sim.VirtualClock()
+    return recording.replay(fname, clock=clock, strict=strict)
+
+# Files copied into the scratch directory of a dry run.
+DRY_RUN_FILES = ('.csv', '.dat', '.npy', '.journal')
+
+def dry_run(func, args, latency=None):
+    """ Run func(args) on simulated instruments and report how long it would take on the bench.
+
+    Notes:
+    The run happens in a scratch copy of the pixel libraries, state.dat
+    and other data files of the working directory, on a virtual clock
+    (see use_sim), so nothing on disk or on the bench is touched. latency
+    is passed to sim.install, e.g. from sim.latencies_from_trace to use
+    timings recorded on the bench. Afterwards the instruments, chip.image
+    and the State are put back as they were. Prints and returns the
+    predicted duration (s).
+    """
+    global time, prior_store
+    saved_time = time
+    saved_chip = dict((name, getattr(chip, name, None)) for name in ('dgene', 'hpgene', 'hpcntr', 'image'))
+    saved_memory = dict(chip.pattern_memory)
+    saved_priors = prior_store
+    chip.image = chip.image.copy()
+    State.from_file().flush()
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='dryrun')
+    for name in os.listdir(cwd):
+        if os.path.isfile(name) and os.path.splitext(name)[1] in DRY_RUN_FILES:
+            shutil.copy(name, workdir)
+    os.chdir(workdir)
+    try:
+        simulation = use_sim(latency=latency)
+        timer = profiling.enable(clock=time, eta=False)
+        func(args)
+    finally:
+        profiling.disable()
+        State.from_file().flush()
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+        State.from_file(reload=True)
+        time = saved_time
+        for name, value in saved_chip.iteritems():
+            setattr(chip, name, value)
+        chip.pattern_memory.clear()
+        chip.pattern_memory.update(saved_memory)
+        prior_store = saved_priors
+    duration = timer.clock.time() - timer.start
+    print
+    print "Dry run: predicted duration %s." % profiling.format_time(duration)
+    print "%-8s %12s %12s %12s" % ('', 'transactions', 'bytes', 'time (s)')
+    for name, inst in sorted(simulation.instruments.iteritems()):
+        print "%-8s %12i %12i %12.1f" % (name, inst.stats['writes'] + inst.stats['reads'], inst.stats['bytes'], inst.stats['time'])
+    timer.print_report()
+    return duration
+
 def main_command_line():
     parser = argparse.ArgumentParser(description="Present a few options from pix.py to be used from the command line for testing.\nNote that pix.py contains commands to do much more than the options here.")
+    parser.add_argument('--sim', dest='sim', action='store_true', help='Run against simulated instruments and a simulated chip (see sim.py), on a virtual clock.')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true', help='Do not touch the bench: run against simulated instruments in a scratch copy of the data files, and report the predicted duration, transactions and phases.')
+    parser.add_argument('--costs', dest='costs', help='For --dry-run and --budget, the instrument timings: a trace saved with --trace on the bench, or a json dictionary of the latency (s) of dgene, hpgene and hpcntr.')
+    parser.add_argument('--budget', dest='budget', type=float, help='Dry run first, and only run on the bench if the predicted duration is under this many hours.')
+    parser.add_argument('--record', dest='record', help='Record every instrument transaction of the run to this file, to be replayed with --replay (see recording.py).')
+    parser.add_argument('--replay', dest='replay', help='Do not touch the bench: answer every instrument transaction from this recording instead.')
+    parser.add_argument('--full-speed', dest='full_speed', action='store_true', help='With --replay, do not wait for the recorded instrument timings (the run uses a virtual clock).')
+    parser.add_argument('--profile', dest='profile', action='store_true', help='Print how long the run spent in each phase (instrument init, driver init, chip configuration, acquisition, fitting, file I/O), and an ETA during scans and tunes.')
+    parser.add_argument('--profile-dump', dest='profile_dump', help='With --profile, also run cProfile and write its statistics to this file.')
+    parser.add_argument('--lock-timeout', dest='lock_timeout', type=float, default=300, help='On the bench, how many seconds to wait for another process to release the chip (see StateLock).')
+    parser.add_argument('--trace', dest='trace', help='Record every instrument transaction of the run, save them to this file as a Chrome trace and print a summary (see tracing.py).')
     subparsers = parser.add_subparsers(title = 'Functions')
 
     setup = subparsers.add_parser('setup', help='Print instructions for the physical setup of the chip.')
@@ -1517,21 +2774,89 @@ def main_command_line():
 
     tune = subparsers.add_parser('tune', help='Tune the large pixels of the chip. (Also records the results to pixels_tune2.csv)')
     tune.set_defaults(func=main_tune)
+    tune.add_argument('--model', dest='model', action='store_true', help='Tune every pixel at once from a per-pixel model of threshold vs dac (saved to dac_model.npy and reused).')
 
     scan = subparsers.add_parser('scan', help='Scan the chip and save to pixels_scan.csv')                        
     scan.set_defaults(func=main_scan)
     scan.add_argument('--vth', dest='vth', type=int, default=150, help='The vth setting to scan the chip at.')
     scan.add_argument('--pixels', dest='pixels', help='If provided, the chip is tuned to the values stored in this file before scanning.')
+    scan.add_argument('--coarse', dest='coarse', action='store_true', help='Estimate every pixel quickly, and only measure full scurves for the ambiguous or outlying ones.')
+    scan.add_argument('--warm', dest='warm', action='store_true', help='Start each threshold search from the thresholds measured before (priors.dat and pixels_tune_final.csv).')
+    scan.add_argument('--boundary', dest='boundaries', type=float, action='append', default=[], help='With --coarse, a threshold (e.g. an edge of the window a tune accepts) near which pixels get a full scurve. Can be repeated.')
 
     source = subparsers.add_parser('source', help='Run integral scan of source through the hitor. Note: this needs to be done after tuning.')
     source.set_defaults(func=source_scan)
     source.add_argument('--vth', dest='vth', type=int, default=80, help='The vth setting to start the source scan.')
     source.add_argument('--delay', dest='delay', type=int, default=1, help='How many seconds to wait while counting hits.')
     
+    noisy = subparsers.add_parser('noisy', help='Find the noisy pixels at vth and save them to noise_mask.dat, which keeps them disabled from then on.')
+    noisy.set_defaults(func=main_noisy)
+    noisy.add_argument('--vth', dest='vth', type=int, default=80, help='The vth setting to look for noise at.')
+    noisy.add_argument('--gate', dest='gate', type=float, default=1.0, help='How many seconds to count hits from each group of pixels.')
+    noisy.add_argument('--pixels', dest='pixels', help='If provided, the chip is tuned to the values stored in this file first.')
+
+    convert = subparsers.add_parser('convert', help='Convert a pixel library between csv and binary (.npy) formats.')
+    convert.set_defaults(func=main_convert)
+    convert.add_argument('infile', help='The library to read, e.g. pixels_tune_final.csv')
+    convert.add_argument('outfile', help='The library to write. Names ending in .npy are saved in binary format.')
+    
     args = parser.parse_args()
-    args.func(args)
+    if args.record and args.replay:
+        parser.error('--record and --replay cannot be used together.')
+    if args.dry_run or args.budget is not None:
+        latency = None
+        if args.costs:
+            latency = json.load(open(args.costs))
+            if 'traceEvents' in latency:
+                import sim
+                latency = sim.latencies_from_trace(args.costs)
+        duration = dry_run(args.func, args, latency)
+        if args.dry_run:
+            return
+        if duration > args.budget * 3600:
+            print "The predicted duration is over the budget of %.1f hours, not running." % args.budget
+            sys.exit(1)
+    if args.sim:
+        use_sim()
+    if args.replay:
+        use_replay(args.replay, args.full_speed)
+    if args.record:
+        recording.record(args.record, clock=time)
+    if args.profile:
+        profiling.enable(clock=time, dump=args.profile_dump)
+    if args.trace:
+        tracing.enable(clock=time)
+    # On the bench, keep other processes off the chip (see StateLock).
+    lock = StateLock(timeout=args.lock_timeout) if not (args.sim or args.replay) else None
+    if lock is not None:
+        try:
+            lock.acquire()
+        except RuntimeError as e:
+            print e
+            sys.exit(1)
+    try:
+        args.func(args)
+    finally:
+        if lock is not None:
+            lock.release()
+        if args.trace:
+            tracer = tracing.disable()
+            tracer.save(args.trace)
+            tracer.print_summary()
+        if args.profile:
+            profiling.disable().print_report()
+        if args.record or args.replay:
+            session = recording.stop()
+        if args.replay:
+            print "Replayed %i events (%i not used, %i mismatches), %.1f s of recorded time." % (session.served, session.remaining(), session.errors, session.recorded_time)
+    if args.sim:
+        print "Simulated run took %.1f s." % time.time()
 
 if __name__ == "__main__":
+    # profiling and tracing find the functions they wrap by name, as
+    # pix.get_count etc., so make that this module rather than letting
+    # them import a second copy of the file.
+    sys.modules['pix'] = sys.modules[__name__]
     main_command_line()
 
 
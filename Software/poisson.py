@@ -0,0 +1,138 @@
+"""
+Poisson module: counting statistics for noise (dark) hits. The counter
+gives a number of hits in a gate of known length, and the hits arrive as
+a Poisson process, so the rate and its confidence interval follow from
+the total counts and the total gate time. RateEstimate decides how long
+the next gate should be to reach a given precision.
+"""
+
+import math
+
+# Above this many counts the interval uses the Wilson-Hilferty approximation.
+EXACT_COUNTS = 100
+
+
+def normal_quantile(p):
+    """ Return z with P(Z > z) = p for a standard normal Z. """
+    low, high = -40.0, 40.0
+    for i in xrange(200):
+        mid = (low + high) / 2
+        if .5 * math.erfc(mid / math.sqrt(2)) > p:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+
+def poisson_cdf(k, mu):
+    """ P(X <= k) for X Poisson with mean mu. """
+    if mu <= 0:
+        return 1.0
+    total = 0.0
+    for i in xrange(int(k) + 1):
+        total += math.exp(-mu + i * math.log(mu) - math.lgamma(i + 1))
+    return min(total, 1.0)
+
+
+def _solve_mean(func, target, high):
+    # Bisect for mu where func(mu) = target, func decreasing in mu.
+    low = 0.0
+    while func(high) > target:
+        high *= 2
+    for i in xrange(100):
+        mid = (low + high) / 2
+        if func(mid) > target:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+
+def mean_interval(count, confidence=0.95):
+    """ The central confidence interval (Garwood) on the mean of a Poisson count.
+
+    Notes:
+    Exact up to EXACT_COUNTS counts, then the Wilson-Hilferty approximation
+    of the chi squared quantiles, which is good to much better than 1% there.
+    """
+    alpha = 1 - confidence
+    if count > EXACT_COUNTS:
+        z = normal_quantile(alpha / 2)
+        low = count * (1 - 1.0 / (9 * count) - z / (3 * math.sqrt(count)))**3
+        high = (count + 1) * (1 - 1.0 / (9 * (count + 1)) + z / (3 * math.sqrt(count + 1)))**3
+        return low, high
+    if count == 0:
+        low = 0.0
+    else:
+        low = _solve_mean(lambda mu: poisson_cdf(count - 1, mu), 1 - alpha / 2, count + 1.0)
+    high = _solve_mean(lambda mu: poisson_cdf(count, mu), alpha / 2, count + 1.0)
+    return low, high
+
+
+def rate_interval(count, exposure, confidence=0.95):
+    """ The confidence interval on a rate given count hits in exposure seconds. """
+    low, high = mean_interval(count, confidence)
+    return low / exposure, high / exposure
+
+
+def counts_for_precision(precision, confidence=0.95):
+    """ The number of counts needed for the interval half-width to be precision times the rate. """
+    count = max(1, int((normal_quantile((1 - confidence) / 2) / precision)**2))
+    while True:
+        low, high = mean_interval(count, confidence)
+        if (high - low) / 2 <= precision * count:
+            return count
+        count += 1
+
+
+def quiet_probability(rate, exposure):
+    """ The probability of no hits in exposure seconds at rate. """
+    return math.exp(-rate * exposure)
+
+
+class RateEstimate:
+    """ A rate measured over several gates, which knows when it is measured well enough.
+
+    Notes:
+    The estimate is done when the confidence interval half-width is at most
+    precision times the rate, or when the upper end of the interval is below
+    rate_floor (the rate is indistinguishable from zero for our purposes).
+    next_gate sizes the next gate so that it is expected to finish the
+    estimate, from the rate seen so far.
+    """
+    def __init__(self, precision=0.2, confidence=0.95, rate_floor=0.5):
+        self.precision = precision
+        self.confidence = confidence
+        self.rate_floor = rate_floor
+        self.count = 0
+        self.exposure = 0.0
+        self._needed = counts_for_precision(precision, confidence)
+
+    def add(self, count, exposure):
+        self.count += count
+        self.exposure += exposure
+
+    @property
+    def rate(self):
+        return self.count / self.exposure if self.exposure > 0 else 0.0
+
+    def interval(self):
+        if self.exposure <= 0:
+            return 0.0, float('inf')
+        return rate_interval(self.count, self.exposure, self.confidence)
+
+    def quiet(self):
+        """ True if the rate is known to be below rate_floor. """
+        return self.interval()[1] < self.rate_floor
+
+    def done(self):
+        return self.quiet() or self.count >= self._needed
+
+    def next_gate(self, min_gate=.25, max_gate=8.0):
+        """ The gate length (s) expected to finish the estimate, between min_gate and max_gate. """
+        if self.count == 0:
+            # Time for zero counts to put the upper limit below rate_floor.
+            needed = mean_interval(0, self.confidence)[1] / self.rate_floor - self.exposure
+        else:
+            needed = (self._needed - self.count) / self.rate
+        return min(max(needed, min_gate), max_gate)
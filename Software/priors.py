@@ -0,0 +1,118 @@
+"""
+Priors module: a store of previously measured pixel thresholds, used to
+start new threshold searches close to the answer. Entries are keyed by
+(chip, col, row, vth, dac, config), where dac is the tdac value of the
+pixel and config the clock/count configuration name ('none' by default).
+A lookup at a vth which was not measured is interpolated from the
+measured vths either side of it for the same pixel, dac and config.
+Outside of the measured vths it is extrapolated from the two nearest,
+with the noise widened to cover the extrapolation, and with only one
+measured vth nothing is returned.
+"""
+
+import os
+
+from journal import replace_file
+
+
+class PriorStore:
+    """ Measured (thresh, noise) of pixels under known settings.
+
+    Notes:
+    The store is kept in a text file (priors.dat by default) with one
+    line per measurement:
+        chip col row vth dac config thresh noise
+    Lines are only appended, and a later line for the same key replaces
+    an earlier one when the file is read. compact rewrites the file
+    without the replaced lines.
+    """
+    def __init__(self, fname=None, chip='default'):
+        self.fname = fname
+        self.chip = chip
+        self._entries = {}
+        self._lines = 0
+
+    @classmethod
+    def from_file(cls, fname='priors.dat', chip='default'):
+        store = cls(fname, chip)
+        if os.path.isfile(fname):
+            infile = open(fname, 'r')
+            for line in infile:
+                values = line.split()
+                if len(values) != 8:
+                    continue
+                key = (values[0], int(values[1]), int(values[2]), int(values[4]), values[5])
+                store._entries.setdefault(key, {})[int(values[3])] = (float(values[6]), float(values[7]))
+                store._lines += 1
+            infile.close()
+        return store
+
+    def __len__(self):
+        return sum((len(measured) for measured in self._entries.itervalues()))
+
+    def _write_line(self, outfile, key, vth):
+        chip, col, row, dac, config = key
+        thresh, noise = self._entries[key][vth]
+        outfile.write('%s %i %i %i %i %s %r %r\n' % (chip, col, row, vth, dac, config, thresh, noise))
+
+    def compact(self):
+        """ Rewrite the file with one line per measurement, if any lines have been replaced. """
+        if self.fname is None or self._lines <= len(self):
+            return
+        tmpname = self.fname + '.tmp'
+        outfile = open(tmpname, 'w')
+        for key in sorted(self._entries):
+            for vth in sorted(self._entries[key]):
+                self._write_line(outfile, key, vth)
+        outfile.close()
+        replace_file(tmpname, self.fname)
+        self._lines = len(self)
+
+    def add(self, col, row, vth, dac, thresh, noise, config='none', save=True):
+        """ Add a measurement, appending it to the file if save is True. """
+        key = (self.chip, col, row, int(dac), config)
+        self._entries.setdefault(key, {})[int(vth)] = (float(thresh), float(noise))
+        if save and self.fname is not None:
+            outfile = open(self.fname, 'a')
+            self._write_line(outfile, key, int(vth))
+            outfile.close()
+            self._lines += 1
+
+    def add_library(self, data, vth, config='none', save=False):
+        """ Add every measured pixel of a PixelLibrary array (PixelLibrary.to_array()) taken at vth. """
+        ncols, nrows = data.shape
+        for col in xrange(ncols):
+            for row in xrange(nrows):
+                record = data[col, row]
+                if record['measured']:
+                    self.add(col, row, vth, record['dacs'], record['thresh'], record['noise'], config, save)
+
+    def lookup(self, col, row, vth, dac, config='none'):
+        """ Return the expected (thresh, noise) of a pixel, or None if nothing is known.
+
+        Notes:
+        An extrapolated noise is at least the distance the threshold was
+        extrapolated, since a search started from it with a width of one
+        noise has to reach the real threshold quickly. A single measured
+        vth says nothing about how the threshold moves with vth (e.g. the
+        tune at 150 for a scan at 82), so it only counts at that vth.
+        """
+        measured = self._entries.get((self.chip, col, row, int(dac), config))
+        if not measured:
+            return None
+        if vth in measured:
+            return measured[vth]
+        if len(measured) == 1:
+            return None
+        below = [v for v in measured if v < vth]
+        above = [v for v in measured if v > vth]
+        if below and above:
+            v1, v2 = max(below), min(above)
+        else:
+            v1, v2 = sorted(measured, key=lambda v: abs(v - vth))[:2]
+        (t1, n1), (t2, n2) = measured[v1], measured[v2]
+        frac = float(vth - v1) / (v2 - v1)
+        thresh, noise = t1 + frac * (t2 - t1), n1 + frac * (n2 - n1)
+        if not (below and above):
+            noise = max(noise, abs(thresh - t1))
+        return thresh, noise
@@ -0,0 +1,154 @@
+"""
+Profiling module: a breakdown of where the time of a run goes by phase
+(instrument init, driver init, chip configuration, acquisition, fitting,
+file I/O), an optional cProfile dump, and a live ETA for long loops.
+
+The phases are found by wrapping the functions listed in PHASES (see
+tracing.patch), so nothing is measured unless enable is called. Time
+spent in a phase function called from inside another one counts only
+for the inner phase, and anything outside all of them is 'other'. Only
+the thread which enabled profiling is timed (e.g. not the background
+writes of the State).
+"""
+
+import cProfile
+import threading
+import time
+
+import tracing
+
+# The pix functions are found as module pix, which pix.py registers
+# itself as when it is run as a script.
+PHASES = [('instrument init', ['chip.init_hpgene', 'chip.init_hpcntr']),
+          ('driver init', ['chip.DgeneDriver.init_blocks', 'chip.DgeneDriver.reset_to_defaults']),
+          ('chip configuration', ['chip.DgeneDriver.write_blocks']),
+          ('acquisition', ['pix.get_count', 'pix.timed_count', 'pix.time_until_hit']),
+          ('fitting', ['pix.fit_scurve', 'pix.DacModel.fit']),
+          ('file I/O', ['pix.PixelLibrary.from_file', 'pix.PixelLibrary.save',
+                        'pix.PixelLibrary.from_binary', 'pix.PixelLibrary.save_binary',
+                        'journal.PixelJournal.record', 'journal.PixelJournal.compact',
+                        'journal.PixelJournal.replay', 'pix.State.flush']),
+          ]
+
+# The phases of FPGAgen.py, relative to its module (which is __main__ when run).
+FPGAGEN_PHASES = [('command encoding', ['commandRead', 'op_command']),
+                  ('serial write', ['FPGA_write']),
+                  ('readback', ['readData', 'collect']),
+                  ]
+
+# True while a profile is running, so Progress prints its ETA.
+live = False
+
+# The PhaseTimer in use, None if profiling is disabled.
+timer = None
+
+
+class PhaseTimer:
+    """ Exclusive time and number of calls of each phase, in the thread which created it. """
+    def __init__(self, clock=time):
+        self.clock = clock
+        self.start = clock.time()
+        self.totals = {}
+        self.calls = {}
+        self.thread = threading.current_thread()
+        self.stack = []
+
+    def enter(self, phase):
+        self.stack.append([phase, self.clock.time(), 0.0])
+
+    def exit(self):
+        stack = self.stack
+        phase, start, children = stack.pop()
+        elapsed = self.clock.time() - start
+        self.totals[phase] = self.totals.get(phase, 0.0) + elapsed - children
+        self.calls[phase] = self.calls.get(phase, 0) + 1
+        if stack:
+            stack[-1][2] += elapsed
+
+    def print_report(self):
+        total = self.clock.time() - self.start
+        print "%-20s %10s %12s %8s" % ('phase', 'calls', 'time (s)', '%')
+        for phase, seconds in sorted(self.totals.iteritems(), key=lambda item: -item[1]):
+            print "%-20s %10i %12.3f %8.1f" % (phase, self.calls[phase], seconds, 100 * seconds / total if total else 0)
+        other = total - sum(self.totals.itervalues())
+        print "%-20s %10s %12.3f %8.1f" % ('other', '', other, 100 * other / total if total else 0)
+        print "%-20s %10s %12.3f" % ('total', '', total)
+
+
+def _timed(func, phase):
+    def wrapper(*args, **kwargs):
+        if threading.current_thread() is not timer.thread:
+            return func(*args, **kwargs)
+        timer.enter(phase)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timer.exit()
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+_patched = []
+_profile = []
+
+def enable(clock=time, phases=PHASES, dump=None, eta=True):
+    """ Start timing the phases, and cProfile if dump (a file name) is given. With eta, Progress prints ETAs. """
+    global timer, live
+    disable()
+    timer = PhaseTimer(clock)
+    live = eta
+    for phase, targets in phases:
+        for target in targets:
+            tracing.patch(target, lambda func: _timed(func, phase), _patched)
+    if dump is not None:
+        profile = cProfile.Profile()
+        _profile.append((profile, dump))
+        profile.enable()
+    return timer
+
+
+def disable():
+    """ Stop profiling, write the cProfile dump if there is one, and return the last PhaseTimer. """
+    global timer, live
+    while _profile:
+        profile, dump = _profile.pop()
+        profile.disable()
+        profile.dump_stats(dump)
+        print "Wrote the cProfile statistics to %s (read them with python -m pstats %s)." % (dump, dump)
+    tracing.unpatch(_patched)
+    last, timer, live = timer, None, False
+    return last
+
+
+class Progress:
+    """ Counts the steps of a long loop and, while profiling, prints an ETA.
+
+    Notes:
+    The ETA is printed at most every interval seconds of clock, from the
+    average time per step so far.
+    """
+    def __init__(self, total, label, clock=time, interval=10.0):
+        self.total = total
+        self.label = label
+        self.clock = clock
+        self.interval = interval
+        self.done = 0
+        self.start = self.last = clock.time()
+
+    def step(self, n=1):
+        self.done += n
+        if not live:
+            return
+        now = self.clock.time()
+        if now - self.last < self.interval and self.done < self.total:
+            return
+        self.last = now
+        elapsed = now - self.start
+        remaining = elapsed / self.done * (self.total - self.done)
+        print "%s: %i/%i, %s elapsed, ETA %s" % (self.label, self.done, self.total, format_time(elapsed), format_time(remaining))
+
+
+def format_time(seconds):
+    seconds = int(seconds)
+    return '%i:%02i:%02i' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
@@ -0,0 +1,404 @@
+"""
+Recording module: records every transaction with the instruments (the
+DG2020, the HP pulse generator and counter, and the ATLYS serial port)
+to a file, and replays it later in place of the instruments. A replayed
+run sends the same commands and gets the recorded responses back, so a
+scan from the bench can be re-executed without hardware, to reproduce an
+anomaly or to measure the overhead of the host code on a realistic
+stream of transactions.
+
+File format (all numbers little endian):
+    header   'T3REC01\\n', uint32 n, n bytes of json metadata
+    events   float64 time, uint8 channel, uint8 kind, uint32 nrequest,
+             uint32 nresponse, request bytes, response bytes
+    index    uint64 offset of each event
+    footer   uint64 offset of the index, uint64 number of events, 'T3RIDX01'
+time is in seconds from the start of the recording, at the end of the
+transaction. kind is one of KINDS, plus COMPRESSED if the request and
+response are zlib compressed (done for long dgene patterns). The index
+and footer are written by close; a recording which was not closed (e.g.
+the run crashed) is still read, by scanning the events.
+"""
+
+import json
+import os
+import random
+import struct
+import sys
+import threading
+import time
+import zlib
+
+import tracing
+
+MAGIC = 'T3REC01\n'
+INDEX_MAGIC = 'T3RIDX01'
+EVENT = struct.Struct('<dBBII')
+FOOTER = struct.Struct('<QQ8s')
+
+CHANNELS = ['dgene', 'hpgene', 'hpcntr', 'serial']
+KINDS = ['write', 'read', 'finished']
+COMPRESSED = 0x80
+
+# Payloads longer than this are compressed, if that makes them smaller.
+COMPRESS_OVER = 256
+
+# The instruments in chip which are recorded and replayed.
+INSTRUMENTS = ['dgene', 'hpgene', 'hpcntr']
+
+# The Recorder or Replay in use, None if there is none.
+session = None
+
+
+class ReplayError(Exception):
+    """ The program did not do what the recording says it did. """
+    pass
+
+
+class Event:
+    def __init__(self, time, channel, kind, request, response):
+        self.time = time
+        self.channel = channel
+        self.kind = kind
+        self.request = request
+        self.response = response
+
+    def __repr__(self):
+        return 'Event(%.6f, %r, %r, %r, %r)' % (self.time, self.channel, self.kind, self.request[:40], self.response[:40])
+
+
+class Recorder:
+    """ Writes events to a recording file.
+
+    Notes:
+    metadata (a dictionary) is stored in the header; the seed of the
+    random module is added to it, and random is seeded with it, so that a
+    replay draws the same random pixels. Events from several threads are
+    written in the order they finish.
+    """
+    def __init__(self, fname, clock=time, metadata=None):
+        self.fname = fname
+        self.clock = clock
+        self.metadata = dict(metadata or {})
+        self.metadata.setdefault('seed', random.randint(0, 2**31 - 1))
+        self.metadata.setdefault('argv', sys.argv)
+        self.metadata.setdefault('date', time.strftime('%Y-%m-%d %H:%M:%S'))
+        random.seed(self.metadata['seed'])
+        self.outfile = open(fname, 'wb')
+        header = json.dumps(self.metadata)
+        self.outfile.write(MAGIC + struct.pack('<I', len(header)) + header)
+        self.offsets = []
+        self.lock = threading.Lock()
+        self.start = clock.time()
+
+    def record(self, channel, kind, request='', response=''):
+        now = self.clock.time() - self.start
+        flags = KINDS.index(kind)
+        if len(request) + len(response) > COMPRESS_OVER:
+            packed = zlib.compress(request), zlib.compress(response)
+            if len(packed[0]) + len(packed[1]) < len(request) + len(response):
+                request, response = packed
+                flags |= COMPRESSED
+        with self.lock:
+            self.offsets.append(self.outfile.tell())
+            self.outfile.write(EVENT.pack(now, CHANNELS.index(channel), flags, len(request), len(response)))
+            self.outfile.write(request)
+            self.outfile.write(response)
+
+    def wrap(self, inst, channel):
+        return RecordingTransport(inst, channel, self)
+
+    def close(self):
+        with self.lock:
+            if self.outfile.closed:
+                return
+            index = self.outfile.tell()
+            self.outfile.write(struct.pack('<%iQ' % len(self.offsets), *self.offsets))
+            self.outfile.write(FOOTER.pack(index, len(self.offsets), INDEX_MAGIC))
+            self.outfile.close()
+
+
+class RecordingTransport:
+    """ A GPIB instrument or serial port whose transactions are recorded.
+
+    Notes:
+    write records the command and what the write returned (the number of
+    bytes written, for a serial port), read the size asked for (if any)
+    and the data, and finished the answer. Anything else (open, close,
+    isOpen, ...) goes straight to the instrument.
+    """
+    def __init__(self, inst, channel, recorder):
+        self.inst = inst
+        self.channel = channel
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.inst, name)
+
+    def write(self, data):
+        result = self.inst.write(data)
+        self.recorder.record(self.channel, 'write', data, '' if result is None else str(result))
+        return result
+
+    def read(self, *args):
+        result = self.inst.read(*args)
+        self.recorder.record(self.channel, 'read', ' '.join((str(arg) for arg in args)), result)
+        return result
+
+    def finished(self):
+        result = self.inst.finished()
+        self.recorder.record(self.channel, 'finished', '', '1' if result else '0')
+        return result
+
+
+class Recording:
+    """ A recording file opened for reading: recording[n] is the nth Event.
+
+    Notes:
+    Events are read from the file as they are needed, through the index.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.infile = open(fname, 'rb')
+        if self.infile.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a recording' % fname)
+        size, = struct.unpack('<I', self.infile.read(4))
+        self.metadata = json.loads(self.infile.read(size))
+        self.offsets = self._read_index()
+        if self.offsets is None:
+            self.offsets = self._scan(len(MAGIC) + 4 + size)
+
+    def _read_index(self):
+        self.infile.seek(0, os.SEEK_END)
+        end = self.infile.tell()
+        if end < FOOTER.size:
+            return None
+        self.infile.seek(end - FOOTER.size)
+        index, count, magic = FOOTER.unpack(self.infile.read(FOOTER.size))
+        if magic != INDEX_MAGIC or index + 8 * count + FOOTER.size != end:
+            return None
+        self.infile.seek(index)
+        return list(struct.unpack('<%iQ' % count, self.infile.read(8 * count)))
+
+    def _scan(self, offset):
+        # No index: walk the events, stopping at the first incomplete one.
+        self.infile.seek(0, os.SEEK_END)
+        end = self.infile.tell()
+        offsets = []
+        while offset + EVENT.size <= end:
+            self.infile.seek(offset)
+            t, channel, kind, nrequest, nresponse = EVENT.unpack(self.infile.read(EVENT.size))
+            if offset + EVENT.size + nrequest + nresponse > end:
+                break
+            offsets.append(offset)
+            offset += EVENT.size + nrequest + nresponse
+        return offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def channel(self, n):
+        """ The channel of the nth event, without reading its data. """
+        self.infile.seek(self.offsets[n])
+        return CHANNELS[EVENT.unpack(self.infile.read(EVENT.size))[1]]
+
+    def __getitem__(self, n):
+        self.infile.seek(self.offsets[n])
+        t, channel, kind, nrequest, nresponse = EVENT.unpack(self.infile.read(EVENT.size))
+        request = self.infile.read(nrequest)
+        response = self.infile.read(nresponse)
+        if kind & COMPRESSED:
+            request, response = zlib.decompress(request), zlib.decompress(response)
+        return Event(t, CHANNELS[channel], KINDS[kind & ~COMPRESSED], request, response)
+
+    def events(self, channel=None):
+        for n in xrange(len(self)):
+            event = self[n]
+            if channel is None or event.channel == channel:
+                yield event
+
+    def duration(self):
+        return self[len(self) - 1].time if len(self) else 0.0
+
+    def print_summary(self):
+        counts = {}
+        for event in self.events():
+            count = counts.setdefault((event.channel, event.kind), [0, 0])
+            count[0] += 1
+            count[1] += len(event.request) + len(event.response)
+        print "%s: %i events over %.1f s, recorded %s" % (self.fname, len(self), self.duration(), self.metadata.get('date', '?'))
+        print "%-8s %-10s %10s %12s" % ('channel', 'kind', 'count', 'bytes')
+        for (channel, kind), (count, nbytes) in sorted(counts.iteritems()):
+            print "%-8s %-10s %10i %12i" % (channel, kind, count, nbytes)
+
+    def close(self):
+        self.infile.close()
+
+
+class Replay:
+    """ Serves the events of a recording back to the program, one channel at a time.
+
+    Notes:
+    Each channel is replayed in its recorded order: a write must send the
+    recorded data, and a read gets the recorded data back. If the program
+    does something else, ReplayError is raised (or, without strict, the
+    mismatch is counted in errors and the event served anyway).
+
+    Unless full_speed, each transaction completes no earlier than it did
+    in the recording, by sleeping on clock. With a VirtualClock the
+    sleeps only move the clock, so the replay runs at full speed while
+    keeping the recorded timeline.
+    """
+    def __init__(self, fname, clock=time, full_speed=False, strict=True):
+        self.recording = Recording(fname)
+        self.clock = clock
+        self.full_speed = full_speed
+        self.strict = strict
+        self.errors = 0
+        self.served = 0
+        self.queues = dict((channel, []) for channel in CHANNELS)
+        for n in xrange(len(self.recording) - 1, -1, -1):
+            self.queues[self.recording.channel(n)].append(n)
+        self.recorded_time = self.recording.duration()
+        self.lock = threading.Lock()
+        random.seed(self.recording.metadata.get('seed'))
+        self.start = clock.time()
+
+    def next(self, channel, kind, request):
+        with self.lock:
+            queue = self.queues[channel]
+            if not queue:
+                raise ReplayError('%s %s %r after the end of the recording' % (channel, kind, request[:60]))
+            n = queue.pop()
+            event = self.recording[n]
+            self.served += 1
+        if event.kind != kind or (kind == 'write' and event.request != request):
+            self.errors += 1
+            message = 'event %i: the program did %s %s %r, the recording has %s %r' % (n, channel, kind, request[:60], event.kind, event.request[:60])
+            if self.strict:
+                raise ReplayError(message)
+            print "Replay mismatch at " + message
+        if not self.full_speed:
+            # When the run is behind the recording, carry on at once
+            # (time.sleep raises IOError on a negative delay).
+            delay = event.time - (self.clock.time() - self.start)
+            if delay > 0:
+                self.clock.sleep(delay)
+        return event
+
+    def wrap(self, inst, channel):
+        return ReplayTransport(self, channel)
+
+    def remaining(self):
+        return sum((len(queue) for queue in self.queues.itervalues()))
+
+    def close(self):
+        self.recording.close()
+
+
+class ReplayTransport:
+    """ Stands in for an instrument or serial port, answering from a Replay. """
+    def __init__(self, replay, channel):
+        self.replay = replay
+        self.channel = channel
+
+    def write(self, data):
+        response = self.replay.next(self.channel, 'write', data).response
+        return int(response) if response else None
+
+    def read(self, *args):
+        return self.replay.next(self.channel, 'read', ' '.join((str(arg) for arg in args))).response
+
+    def finished(self):
+        return self.replay.next(self.channel, 'finished', '').response == '1'
+
+    # The serial port is always open.
+    def isOpen(self):
+        return True
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+
+_patched = []
+
+def record(fname, clock=time, metadata=None, instruments=INSTRUMENTS):
+    """ Start recording the instruments in chip to fname, and return the Recorder.
+
+    Notes:
+    As in tracing.enable, a chip.ShadowInstrument keeps its place and the
+    instrument inside it is recorded, so only what reaches the bench is
+    in the file. Wrap a serial port with recorder.wrap(port, 'serial').
+    """
+    global session
+    stop()
+    session = Recorder(fname, clock, metadata)
+    chip = sys.modules.get('chip')
+    if chip is not None:
+        for label in instruments:
+            owner, attr = chip, label
+            inst = getattr(chip, label, None)
+            if isinstance(inst, chip.ShadowInstrument):
+                owner, attr, inst = inst, 'inst', inst.inst
+            if inst is not None:
+                _patched.append((owner, attr, inst))
+                setattr(owner, attr, RecordingTransport(inst, label, session))
+    return session
+
+
+def replay(fname, clock=time, full_speed=False, strict=True, instruments=INSTRUMENTS):
+    """ Replace the instruments in chip with ones answering from the recording fname, and return the Replay.
+
+    Notes:
+    hpgene and hpcntr are wrapped in a new chip.ShadowInstrument, as on
+    the bench, so that the same writes are skipped. Use
+    replay.wrap(None, 'serial') for the serial port.
+    """
+    global session
+    stop()
+    session = Replay(fname, clock, full_speed, strict)
+    import chip
+    for label in instruments:
+        inst = ReplayTransport(session, label)
+        if label == 'hpgene':
+            inst = chip.ShadowInstrument(inst, chip.HPGENE_SETTINGS)
+        elif label == 'hpcntr':
+            inst = chip.ShadowInstrument(inst, chip.HPCNTR_SETTINGS)
+        _patched.append((chip, label, getattr(chip, label, None)))
+        setattr(chip, label, inst)
+    return session
+
+
+def stop():
+    """ Stop recording or replaying, put the instruments back, and return the last session. """
+    global session
+    tracing.unpatch(_patched)
+    last, session = session, None
+    if last is not None:
+        last.close()
+    return last
+
+
+def main_command_line():
+    import argparse
+    parser = argparse.ArgumentParser(description="Print the contents of an instrument recording.")
+    parser.add_argument('fname', help='The recording, as saved by pix.py or FPGAgen.py with --record.')
+    parser.add_argument('--events', dest='events', nargs=2, type=int, metavar=('FIRST', 'COUNT'), help='Print COUNT events from event FIRST.')
+    parser.add_argument('--channel', dest='channel', choices=CHANNELS, help='Only print the events of this channel.')
+    args = parser.parse_args()
+    recording = Recording(args.fname)
+    print json.dumps(recording.metadata)
+    if args.events:
+        first, count = args.events
+        for n in xrange(first, min(first + count, len(recording))):
+            event = recording[n]
+            if args.channel is None or event.channel == args.channel:
+                print "%8i %12.6f %-8s %-8s %r %r" % (n, event.time, event.channel, event.kind, event.request[:60], event.response[:60])
+    else:
+        recording.print_summary()
+
+if __name__ == "__main__":
+    main_command_line()
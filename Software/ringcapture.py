@@ -0,0 +1,176 @@
+"""
+Ringcapture module: streams readback from the FPGA into a preallocated,
+memory-mapped ring file, so a long source or noise run is bounded by the
+size of the file instead of the memory. The data is cut into segments
+(one per readback of FPGAgen.readData, or every segment_size bytes of a
+continuous stream), and completed segments are available as numpy views
+of the file, without copying, while the acquisition goes on. Once the
+ring wraps around, the oldest segments are overwritten.
+
+File layout (all numbers little endian):
+    header   'T3RING01', uint64 data size, uint64 number of slots,
+             uint64 reserved position, uint64 number of segments
+    table    one (uint64 start, uint64 length) per slot
+    data     data size bytes, starting at the first 4096 byte boundary
+Positions count every byte ever written (so start % data size is where a
+segment is in the data). Segment n is in slot n % slots. A segment never
+wraps around the end of the data, so each one is contiguous. Another
+process can open the file with RingCapture.open and read the completed
+segments while it is being written.
+"""
+
+import mmap
+import struct
+
+import numpy as np
+
+MAGIC = 'T3RING01'
+HEADER = struct.Struct('<8sQQQQ')
+SLOT = struct.Struct('<QQ')
+TABLE = 64
+PAGE = 4096
+
+
+class RingCapture:
+    """ A ring file of readback segments.
+
+    Notes:
+    Create one with RingCapture(fname, size, slots), which preallocates
+    the file, or open an existing one with RingCapture.open(fname). A
+    view from segment stays valid until the ring writes over it (check
+    with available), and must not be used after close.
+    """
+    def __init__(self, fname, size=1 << 28, slots=1 << 16, _readonly=False):
+        self.fname = fname
+        self.readonly = _readonly
+        if _readonly:
+            self.file = open(fname, 'rb')
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, self.size, self.slots, position, count = HEADER.unpack_from(self.map, 0)
+            if magic != MAGIC:
+                raise ValueError('%s is not a ring capture' % fname)
+        else:
+            self.size, self.slots = size, slots
+            self.file = open(fname, 'w+b')
+            self.file.truncate(self._data_offset() + size)
+            self.map = mmap.mmap(self.file.fileno(), 0)
+            self._position, self._count = 0, 0
+            self._write_header()
+        self.data_offset = self._data_offset()
+
+    @classmethod
+    def open(cls, fname):
+        """ Open an existing ring capture for reading. """
+        return cls(fname, _readonly=True)
+
+    def _data_offset(self):
+        return (TABLE + SLOT.size * self.slots + PAGE - 1) // PAGE * PAGE
+
+    def _write_header(self):
+        HEADER.pack_into(self.map, 0, MAGIC, self.size, self.slots, self._position, self._count)
+
+    def _header(self):
+        # (reserved position, number of segments), as the writer left them.
+        return HEADER.unpack_from(self.map, 0)[3:]
+
+    # Writing
+
+    def _reserve(self, nbytes):
+        # Return the start of nbytes of contiguous space, and mark them as written to.
+        if nbytes > self.size:
+            raise ValueError('A segment of %i bytes does not fit in a ring of %i bytes' % (nbytes, self.size))
+        start = self._position
+        if start % self.size + nbytes > self.size:
+            start += self.size - start % self.size
+        self._position = start + nbytes
+        self._write_header()
+        return start
+
+    def _put(self, position, data):
+        offset = self.data_offset + position % self.size
+        self.map[offset:offset + len(data)] = data
+
+    def _commit(self, start, length):
+        SLOT.pack_into(self.map, TABLE + SLOT.size * (self._count % self.slots), start, length)
+        self._count += 1
+        self._position = start + length
+        self._write_header()
+
+    def write_segment(self, data):
+        """ Add data as a segment, and return its number. """
+        start = self._reserve(len(data))
+        self._put(start, data)
+        self._commit(start, len(data))
+        return self._count - 1
+
+    def stream(self, port, nbytes=None, segment_size=None, chunk=4096):
+        """ Read nbytes from port into the ring, and return the number read.
+
+        Notes:
+        With nbytes None, reading goes on until a read of the port returns
+        nothing (its timeout). A segment is completed every segment_size
+        bytes (default nbytes, i.e. one segment) and at the end, so the
+        segments can be analysed while the stream goes on.
+        """
+        if segment_size is None:
+            segment_size = nbytes if nbytes is not None else 1 << 20
+        total = 0
+        while nbytes is None or total < nbytes:
+            length = segment_size if nbytes is None else min(segment_size, nbytes - total)
+            start = self._reserve(length)
+            filled = 0
+            while filled < length:
+                data = port.read(min(chunk, length - filled))
+                if not data:
+                    break
+                self._put(start + filled, data)
+                filled += len(data)
+            if filled:
+                self._commit(start, filled)
+            else:
+                self._position = start
+                self._write_header()
+            total += filled
+            if filled < length:
+                break
+        return total
+
+    def write(self, text):
+        # Text notes (the test numbers of FPGAgen) are not kept: segments are numbered in order.
+        pass
+
+    # Reading
+
+    def __len__(self):
+        return self._header()[1]
+
+    def available(self):
+        """ The numbers of the segments which have not been overwritten. """
+        position, count = self._header()
+        first = max(0, count - self.slots)
+        while first < count and self._slot(first)[0] + self.size < position:
+            first += 1
+        return xrange(first, count)
+
+    def _slot(self, n):
+        return SLOT.unpack_from(self.map, TABLE + SLOT.size * (n % self.slots))
+
+    def segment(self, n):
+        """ A numpy view (uint8) of segment n. Raises IndexError if it was overwritten or does not exist yet. """
+        if n not in self.available():
+            raise IndexError('Segment %i is not in the ring' % n)
+        start, length = self._slot(n)
+        return np.frombuffer(self.map, np.uint8, length, self.data_offset + start % self.size)
+
+    def hits(self, n):
+        """ Segment n as booleans (True for the 0xFF bytes of a hit). """
+        return self.segment(n) == 255
+
+    def close(self):
+        if self.map is None:
+            return
+        if not self.readonly:
+            self.map.flush()
+        self.map.close()
+        self.file.close()
+        self.map = None
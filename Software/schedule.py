@@ -0,0 +1,171 @@
+"""
+Schedule module: runs the points of an experiment matrix in the order
+which needs the least reconfiguration. Each point is a dictionary of
+settings (e.g. {'col': 3, 'config': 'clock', 'clock': True}). Changing a
+setting between two points has a cost (roughly in seconds), and the
+points are ordered to minimize the total, then measured. The results are
+returned in the order the points were given, so output files keep their
+layout no matter what order the measurements were made in. They can also
+be handed to a callback as each point is measured, to be saved as the
+run goes.
+"""
+
+# Approximate time (s) to change each kind of setting between two points.
+COSTS = {'driver': 1.0,  # DgeneDriver.init_blocks
+         'dacs':   8.0,  # write_chip_tuned
+         'column': 0.5,  # enable/disable a column (hit, inject or hitOr)
+         'clock':  0.2,  # enable_count_clock/disable_count_clock
+         'vth':    0.3,  # set_config
+         'config': 0.3,  # control bits in the global register
+         'pixel':  0.1,  # enable_single_pixel
+         }
+
+# Above this many points, the serpentine order is used without refinement.
+MAX_REFINE = 200
+
+
+def transition_cost(current, point, costs):
+    """ The cost of going from settings current to point. Settings not in current always change. """
+    total = 0
+    for name, value in point.iteritems():
+        if name not in current or current[name] != value:
+            total += costs.get(name, 0)
+    return total
+
+
+def path_cost(points, order, costs, start=None):
+    """ The total cost of measuring points in order, starting from the settings start. """
+    total = 0
+    current = dict(start) if start else {}
+    for i in order:
+        total += transition_cost(current, points[i], costs)
+        current.update(points[i])
+    return total
+
+
+def serpentine(points, indices, names):
+    """ Order indices by the settings names, reversing every other block at each level.
+
+    Notes:
+    This is the reflected (Gray code) order of the matrix, so between
+    consecutive points only the last setting which had to change does,
+    and the most expensive settings (first in names) change least.
+    """
+    if not names or len(indices) < 2:
+        return list(indices)
+    groups = {}
+    for i in indices:
+        groups.setdefault(points[i].get(names[0]), []).append(i)
+    order = []
+    for n, value in enumerate(sorted(groups)):
+        block = serpentine(points, groups[value], names[1:])
+        if n % 2:
+            block.reverse()
+        order += block
+    return order
+
+
+def refine(points, order, costs, start=None):
+    """ Improve order by reversing segments (2-opt) while that lowers the cost. """
+    n = len(order)
+    if start:
+        first = [transition_cost(start, points[i], costs) for i in xrange(len(points))]
+    else:
+        first = [sum((costs.get(name, 0) for name in point)) for point in points]
+    pair = dict(((i, j), transition_cost(points[i], points[j], costs)) for i in order for j in order)
+    def cost(a, b):
+        # Cost of moving from point a (None at the start) to point b (None past the end).
+        if b is None:
+            return 0
+        if a is None:
+            return first[b]
+        return pair[a, b]
+    improved = True
+    while improved:
+        improved = False
+        for i in xrange(n - 1):
+            for j in xrange(i + 1, n):
+                # Reversing order[i:j+1] replaces the edges into order[i] and
+                # out of order[j]; the costs are symmetric between points, so
+                # the edges inside the segment are unchanged.
+                prev = order[i-1] if i > 0 else None
+                next = order[j+1] if j + 1 < n else None
+                before = cost(prev, order[i]) + cost(order[j], next)
+                after = cost(prev, order[j]) + cost(order[i], next)
+                if after < before:
+                    order[i:j+1] = order[i:j+1][::-1]
+                    improved = True
+    return order
+
+
+def order_points(points, costs=COSTS, start=None):
+    """ Return the indices of points in the order which is cheapest to measure.
+
+    Notes:
+    Starts from the serpentine order (most expensive settings outermost),
+    or its reverse if that suits start better, and for up to MAX_REFINE
+    points improves on it with 2-opt.
+    """
+    names = set()
+    for point in points:
+        names.update(point.keys())
+    names = sorted(names, key=lambda name: (-costs.get(name, 0), name))
+    order = serpentine(points, range(len(points)), names)
+    if path_cost(points, order[::-1], costs, start) < path_cost(points, order, costs, start):
+        order.reverse()
+    if len(order) <= MAX_REFINE:
+        order = refine(points, order, costs, start)
+    return order
+
+
+class Experiment:
+    """ A set of settings, with how to change each of them and what it costs.
+
+    Notes:
+    Settings are applied in the order they were added, and only when the
+    value differs from the one last applied. A setting with no setter is
+    only a label (it is passed to measure with the rest of the point) but
+    its cost still counts when ordering the points.
+    """
+    def __init__(self, costs=None):
+        self.costs = {}
+        if costs is not None:
+            self.costs.update(costs)
+        self.setters = []
+
+    def setting(self, name, setter=None, cost=None):
+        """ Add a setting. cost defaults to COSTS[name], or 0 for unknown names. """
+        self.setters.append((name, setter))
+        if cost is not None:
+            self.costs[name] = cost
+        elif name not in self.costs:
+            self.costs[name] = COSTS.get(name, 0)
+
+    def order(self, points, start=None):
+        return order_points(points, self.costs, start)
+
+    def run(self, points, measure, start=None, done=None):
+        """ Call measure(point) for every point, in the cheapest order.
+
+        Notes:
+        start is a dictionary of the settings already in place (anything
+        missing is applied for the first point). If done is given, it is
+        called as done(point, result) as soon as each point is measured,
+        so results can be saved before the run ends. Returns the results
+        in the same order as points.
+        """
+        current = dict(start) if start else {}
+        order = self.order(points, current)
+        print "Running %i points, estimated reconfiguration time %.1f s (%.1f s in the given order)." % (len(points), path_cost(points, order, self.costs, current), path_cost(points, range(len(points)), self.costs, current))
+        results = [None] * len(points)
+        for i in order:
+            point = points[i]
+            for name, setter in self.setters:
+                if name in point and (name not in current or current[name] != point[name]):
+                    if setter is not None:
+                        setter(point[name])
+                    current[name] = point[name]
+            results[i] = measure(point)
+            if done is not None:
+                done(point, results[i])
+        return results
@@ -0,0 +1,201 @@
+"""
+Serialreader module: a thread which drains the serial port into a ring
+buffer while the host goes on sending, and cuts what arrives into the
+readbacks of the commands waiting for one. The FPGA answers TRANSMIT with
+the bytes of the last command, in order and with no header, so a
+readback is framed by its length: the caller registers the command
+(expect) before sending TRANSMIT, gets a Future, and the reader completes
+the Futures in the order they were registered. Several commands can be
+outstanding at once, so the next command could be sent while the
+readback of the last one is still coming in at 9600 baud. The firmware
+does not allow that yet: fsm_control.v has no receive buffer and does
+not listen while it writes or transmits, so FPGAgen waits for each
+readback (--window 0) and only saves reopening the port per command.
+"""
+
+import collections
+import threading
+
+
+class ReadTimeout(Exception):
+    """ A readback did not arrive in time. """
+    pass
+
+
+class Future:
+    """ The result of a readback, which a thread waits for with result. """
+    def __init__(self, command_id=None):
+        self.command_id = command_id
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """ Call callback(future) when the future is done (now, if it already is). """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def result(self, timeout=None):
+        """ The readback, waiting at most timeout seconds (None waits forever). Raises ReadTimeout, or what the reader raised. """
+        if not self._done.wait(timeout):
+            raise ReadTimeout('Readback of command %s did not arrive in %s s' % (self.command_id, timeout))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class RingBuffer:
+    """ A fixed size byte buffer: put adds at the end, get takes from the front.
+
+    Notes:
+    If put would overflow it, the oldest bytes are dropped and counted in
+    dropped.
+    """
+    def __init__(self, size=1 << 20):
+        self.buffer = bytearray(size)
+        self.size = size
+        self.start = 0
+        self.count = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self.count
+
+    def put(self, data):
+        data = bytearray(data)
+        if len(data) > self.size:
+            self.dropped += len(data) - self.size
+            data = data[-self.size:]
+        overflow = self.count + len(data) - self.size
+        if overflow > 0:
+            self.dropped += overflow
+            self.start = (self.start + overflow) % self.size
+            self.count -= overflow
+        end = (self.start + self.count) % self.size
+        first = min(len(data), self.size - end)
+        self.buffer[end:end + first] = data[:first]
+        self.buffer[:len(data) - first] = data[first:]
+        self.count += len(data)
+
+    def get(self, n):
+        """ Remove and return the first n bytes (a str). """
+        n = min(n, self.count)
+        first = min(n, self.size - self.start)
+        data = str(self.buffer[self.start:self.start + first]) + str(self.buffer[:n - first])
+        self.start = (self.start + n) % self.size
+        self.count -= n
+        return data
+
+
+class SerialReader:
+    """ Reads the port from a background thread and hands out readbacks.
+
+    Notes:
+    The port must stay open while the reader runs (FPGAgen.commonSetup
+    closes and reopens it, so use FPGAgen.submit instead). Bytes which
+    arrive while no readback is expected are kept for the next one, as a
+    blocking read would have done. If reading the port fails, every
+    waiting Future gets the exception and the reader stops. stop waits
+    for the read in progress, i.e. up to the timeout of the port.
+    """
+    def __init__(self, port, size=1 << 20):
+        self.port = port
+        self.ring = RingBuffer(size)
+        self.frames = collections.deque()
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.error = None
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='serial reader')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def expect(self, length, command_id=None):
+        """ Register a readback of length bytes, and return its Future. Call it before sending TRANSMIT. """
+        with self.lock:
+            if command_id is None:
+                command_id = self.next_id
+            self.next_id += 1
+            future = Future(command_id)
+            if self.error is not None:
+                future.set_exception(self.error)
+                return future
+            self.frames.append((length, future))
+            completed = self._frame()
+        self._complete(completed)
+        return future
+
+    def pending(self):
+        return len(self.frames)
+
+    def _waiting(self):
+        # Bytes waiting in the port, for pyserial 2 (inWaiting) and 3 (in_waiting).
+        if hasattr(self.port, 'in_waiting'):
+            return self.port.in_waiting
+        if hasattr(self.port, 'inWaiting'):
+            return self.port.inWaiting()
+        return 0
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                data = self.port.read(1)
+                if data:
+                    waiting = self._waiting()
+                    if waiting:
+                        data += self.port.read(waiting)
+            except Exception as e:
+                self._fail(e)
+                return
+            if data:
+                with self.lock:
+                    self.ring.put(data)
+                    completed = self._frame()
+                self._complete(completed)
+
+    def _frame(self):
+        # Cut the readbacks which are complete out of the ring (with the lock held).
+        completed = []
+        while self.frames and len(self.ring) >= self.frames[0][0]:
+            length, future = self.frames.popleft()
+            completed.append((future, self.ring.get(length)))
+        return completed
+
+    def _complete(self, completed):
+        # Outside the lock, so callbacks can expect more readbacks.
+        for future, data in completed:
+            future.set_result(data)
+
+    def _fail(self, exception):
+        with self.lock:
+            self.error = exception
+            frames, self.frames = self.frames, collections.deque()
+        for length, future in frames:
+            future.set_exception(exception)
+
+    def stop(self):
+        self._stop.set()
+        self.thread.join()
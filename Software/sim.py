@@ -0,0 +1,427 @@
+"""
+Sim module: simulated instruments, so that the measurement code in pix.py
+can run without the bench. SimDgene stands in for the DG2020, SimHpgene
+for the HP pulse generator and SimHpcntr for the HP counter. Each
+transaction costs a configurable latency on a clock, which is either the
+real one or a VirtualClock (so a scan which takes an hour on the bench
+takes seconds, while still reporting how long it would have taken).
+The chip is programmed by the patterns written to SimDgene: on each
+trigger they are played through the global and column shift registers
+and the loads they strobe, as the chip would see them, so the chip.image
+bookkeeping of the host is not used and a pattern generation bug shows
+up in the counts. PixelModel turns the latches and vth into counts, with
+binomial S-curves for injections and Poisson dark counts.
+"""
+
+import json
+import math
+import time
+
+import numpy as np
+
+import chip
+import chipimage
+
+# Bits of vth in the dac part of the global register, as written by
+# pix.set_config (chip.get_dac_pattern, reversed).
+DAC_BITS = 144
+VTH_FIELD = 14
+
+# The control part of the global register (chip.get_control_pattern_pixel),
+# shifted in last and reversed.
+CONTROL_BITS = 32
+CONFIG_MODE = slice(8, 10)
+LDBUS = slice(10, 18)
+LDEN = 18
+COLUMN_ADDRESS = slice(26, 32)
+
+# The data generator channels which program the chip (pod bit numbers).
+SRIN = chip.InputSignalsPodsDict['SRIN_ALL'][2]
+SRCK = chip.InputSignalsPodsDict['SRCK_G'][2]
+GCFGCK = chip.InputSignalsPodsDict['GCfgCK'][2]
+DACLD = chip.InputSignalsPodsDict['Dacld'][2]
+STBLD = chip.InputSignalsPodsDict['Stbld'][2]
+
+
+class Clock:
+    """ The real clock. """
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class VirtualClock:
+    """ A clock which only moves when something sleeps on it.
+
+    Notes:
+    time and sleep have the signatures of the time module functions, so
+    the clock can stand in for it (e.g. pix.time = VirtualClock()).
+    """
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.now += seconds
+
+
+def decode_vth(pattern):
+    """ Return the vth programmed by a global register pattern, or None. """
+    if pattern is None or len(pattern) < DAC_BITS:
+        return None
+    dacs = pattern[:DAC_BITS][::-1]
+    bits = dacs[8*VTH_FIELD:8*VTH_FIELD + 8]
+    return sum((int(bit) << i for i, bit in enumerate(bits)))
+
+
+class PixelModel:
+    """ The threshold and noise of every pixel, and the counts they give.
+
+    Notes:
+    The threshold (V of injection) of a pixel is
+        thresh + perbit * (tdac - 16) + gain * (vth - 150)
+    and it fires on an injection of amplitude a with probability
+    Phi((a - threshold) / noise). Its dark count rate is
+        dark_rate * P(Z > threshold / dark_noise)
+    so it turns on steeply as vth comes down; a fraction noisy of the
+    pixels have dark_noise twice as large. Pixel values are drawn once,
+    from seed.
+    gain and dark_noise are set so that, with untuned (tdac 16) pixels,
+    the whole chip is quiet at vth 150, where it is tuned and scanned,
+    and the dark rate sets in below it (about 0.15 Hz at vth 130, 5 Hz
+    at 120, 1 kHz at 100). bench.py and --dry-run rely on this; a model
+    which is noisy at vth 150 makes find_minimum_vth and the dark count
+    gates of measure_counts behave differently.
+    """
+    def __init__(self, ncols=chipimage.NCOLS, seed=0, thresh=.45, thresh_spread=.04, perbit=.0128, noise=.015, gain=.0046, dark_rate=1e5, dark_noise=.03, noisy=.01):
+        self.random = np.random.RandomState(seed)
+        shape = (ncols, chipimage.MAXROWS)
+        self.thresh = self.random.normal(thresh, thresh_spread, shape)
+        self.perbit = self.random.normal(perbit, perbit / 10, shape)
+        self.noise = np.abs(self.random.normal(noise, noise / 8, shape))
+        self.dark_noise = np.where(self.random.uniform(size=shape) < noisy, 2 * dark_noise, dark_noise)
+        self.gain = gain
+        self.dark_rate = dark_rate
+
+    def threshold(self, tdacs, vth):
+        return self.thresh + self.perbit * (tdacs - 16) + self.gain * (vth - 150)
+
+    def fire_probability(self, amp, tdacs, vth, mask):
+        """ The probability that at least one pixel in mask fires on an injection of amp. """
+        if not mask.any():
+            return 0.0
+        z = (amp - self.threshold(tdacs, vth)[mask]) / self.noise[mask] / math.sqrt(2)
+        probs = np.array([.5 * math.erfc(-x) for x in z])
+        return 1 - np.prod(1 - probs)
+
+    def rate(self, tdacs, vth, mask):
+        """ The total dark count rate (Hz) of the pixels in mask. """
+        if not mask.any():
+            return 0.0
+        z = self.threshold(tdacs, vth)[mask] / self.dark_noise[mask] / math.sqrt(2)
+        return self.dark_rate * sum((.5 * math.erfc(x) for x in z))
+
+
+def rising_edges(pattern):
+    """ The sample numbers where a '0'/'1' pattern goes from 0 to 1 (it starts from 0). """
+    bits = np.frombuffer(pattern, np.uint8) == ord('1')
+    return np.flatnonzero(bits & ~np.concatenate(([False], bits[:-1])))
+
+
+def compile_patterns(patterns):
+    """ Turn the patterns of one trigger into the operations they do on the chip.
+
+    Notes:
+    patterns is a dictionary of pod bit to '0'/'1' pattern. Returns a list
+    of ('global', bits), ('column', bits) (the bits of SRIN_ALL shifted in
+    on the rising edges of GCfgCK or SRCK_G, in order), ('stbld',) and
+    ('dacld',) (a rising edge of the load), in the order they happen.
+    """
+    length = max(len(pattern) for pattern in patterns.itervalues()) if patterns else 0
+    def channel(bit):
+        return patterns.get(bit, '0' * length)
+    srin = np.frombuffer(channel(SRIN), np.uint8)
+    gcfg, srck = rising_edges(channel(GCFGCK)), rising_edges(channel(SRCK))
+    loads = sorted([(n, 'stbld') for n in rising_edges(channel(STBLD))] + [(n, 'dacld') for n in rising_edges(channel(DACLD))])
+    ops = []
+    start = 0
+    for n, load in loads + [(length, None)]:
+        for name, edges in (('global', gcfg), ('column', srck)):
+            shifted = edges[np.searchsorted(edges, start):np.searchsorted(edges, n)]
+            if len(shifted):
+                ops.append((name, srin[shifted].tostring()))
+        if load is not None:
+            ops.append((load,))
+        start = n
+    return ops
+
+
+class SimChip:
+    """ The chip as seen through the hitOr: which pixels count, and at what vth.
+
+    Notes:
+    The chip holds the 176 bit global register and the 64 bit column
+    register, which the patterns of SimDgene shift into (see run), and
+    the latches and dacs loaded from them. Until they are loaded, the
+    latches are off (hit_or_not 1, tdacs 16) and vth is default_vth.
+    A Stbld load with the load enable bit set in the control part of the
+    global register loads the column register into the latches selected
+    by its ldbus, on its column or (config mode '11') on every column; a
+    Dacld load sets vth from the dac part.
+    """
+    def __init__(self, model=None, clock=None, default_vth=150, ncols=chipimage.NCOLS):
+        self.model = model if model is not None else PixelModel(ncols)
+        self.clock = clock if clock is not None else Clock()
+        self.vth = default_vth
+        self.counter = None
+        self.ncols = ncols
+        self.register = '0' * chipimage.NGLOBAL
+        self.column_register = '0' * chipimage.MAXROWS
+        shape = (ncols, chipimage.MAXROWS)
+        self.planes = dict((latch, np.zeros(shape, bool)) for latch in chipimage.LATCHES)
+        self.planes['hit_or_not'][:] = True
+        self.planes['tdac4'][:] = True
+        self._latches = None
+        self._programs = {}
+
+    def run(self, patterns):
+        """ Play the patterns of one trigger of the data generator into the chip. """
+        key = tuple(sorted(patterns.iteritems()))
+        if key not in self._programs:
+            if len(self._programs) > 1000:
+                self._programs.clear()
+            self._programs[key] = compile_patterns(patterns)
+        for op in self._programs[key]:
+            if op[0] == 'global':
+                self.register = (self.register + op[1])[-chipimage.NGLOBAL:]
+            elif op[0] == 'column':
+                self.column_register = (op[1][::-1] + self.column_register)[:chipimage.MAXROWS]
+            elif op[0] == 'dacld':
+                self.vth = decode_vth(self.register)
+            else:
+                self.strobe()
+
+    def strobe(self):
+        control = self.register[-CONTROL_BITS:][::-1]
+        if control[LDEN] != '1':
+            return
+        pattern = np.array([bit == '1' for bit in self.column_register])
+        if control[CONFIG_MODE] == '11':
+            cols = slice(None)
+        else:
+            cols = int(control[COLUMN_ADDRESS][::-1], 2) # least significant bit first, as chip.binary_string writes it
+            if cols >= self.ncols:
+                return
+        for latch in chipimage.ldbus_latches(control[LDBUS]):
+            self.planes[latch][cols] = pattern
+        self._latches = None
+
+    def latches(self):
+        """ Return the (hitor mask, inject mask, tdacs) arrays of the chip. """
+        if self._latches is None:
+            hitor = self.planes['hit'] & ~self.planes['hit_or_not']
+            inject = hitor & self.planes['inject']
+            tdacs = sum((self.planes['tdac%i' % i] << i for i in xrange(5)))
+            self._latches = (hitor, inject, tdacs)
+        return self._latches
+
+    def inject(self, amp, ninjects):
+        """ The number of hitOr pulses from ninjects injections of amp. """
+        hitor, inject, tdacs = self.latches()
+        p = self.model.fire_probability(amp, tdacs, self.vth, inject)
+        return self.model.random.binomial(ninjects, p)
+
+    def dark_counts(self, seconds):
+        hitor, inject, tdacs = self.latches()
+        rate = self.model.rate(tdacs, self.vth, hitor)
+        return self.model.random.poisson(rate * seconds) if seconds > 0 else 0
+
+
+class SimInstrument:
+    """ An instrument which takes latency seconds (plus byte_time per byte) per transaction.
+
+    Notes:
+    stats counts the writes, reads, bytes written and the time spent.
+    finished is a *OPC? query, as on the GpibInst.
+    """
+    latency = 0.0
+    byte_time = 0.0
+
+    def __init__(self, sim, latency=None, byte_time=None):
+        self.sim = sim
+        if latency is not None:
+            self.latency = latency
+        if byte_time is not None:
+            self.byte_time = byte_time
+        self.stats = {'writes': 0, 'reads': 0, 'bytes': 0, 'time': 0.0}
+        self._response = ''
+
+    def _transaction(self, nbytes=0):
+        cost = self.latency + self.byte_time * nbytes
+        self.stats['time'] += cost
+        self.sim.clock.sleep(cost)
+
+    def write(self, command):
+        self.stats['writes'] += 1
+        self.stats['bytes'] += len(command)
+        self._transaction(len(command))
+        self.handle(command.strip())
+
+    def read(self):
+        self.stats['reads'] += 1
+        self._transaction()
+        response, self._response = self._response, ''
+        return response
+
+    def finished(self):
+        self.write('*OPC?')
+        return self.read().startswith('1')
+
+    def handle(self, command):
+        if command == '*OPC?':
+            self._response = '1'
+
+
+class SimDgene(SimInstrument):
+    """ The DG2020: keeps the pattern of each channel, and plays them into the chip on *TRG. """
+    latency = .01
+    byte_time = 1e-6
+
+    def __init__(self, sim, latency=None, byte_time=None):
+        SimInstrument.__init__(self, sim, latency, byte_time)
+        self.patterns = {}
+
+    def handle(self, command):
+        key, value = chip._split_command(command)
+        if key == 'DATA:PATT:BIT':
+            # '<bit>,<start>,<length>,#<digits><length><pattern>'
+            bit, start, length, block = str(value).split(',', 3)
+            ndigits = int(block[1])
+            pattern = block[2 + ndigits:2 + ndigits + int(length)]
+            old = self.patterns.get(int(bit), '')
+            self.patterns[int(bit)] = old[:int(start)] + pattern + old[int(start) + len(pattern):]
+        elif key == '*TRG':
+            self.sim.run(self.patterns)
+        else:
+            SimInstrument.handle(self, command)
+
+
+class SimHpgene(SimInstrument):
+    """ The pulse generator: *TRG injects BM:NCYC pulses of VOLT into the chip. """
+    latency = .005
+
+    def __init__(self, sim, latency=None, byte_time=None):
+        SimInstrument.__init__(self, sim, latency, byte_time)
+        self.amp = 0.2
+        self.ninjects = 255
+
+    def handle(self, command):
+        key, value = chip._split_command(command)
+        if key == 'VOLT':
+            self.amp = value
+        elif key == 'BM:NCYC':
+            self.ninjects = int(value)
+        elif key == '*TRG':
+            counter = self.sim.counter
+            if counter is not None and counter.gate is not None:
+                counter.add(self.sim.inject(self.amp, self.ninjects))
+        else:
+            SimInstrument.handle(self, command)
+
+
+class SimHpcntr(SimInstrument):
+    """ The counter, totalizing hitOr pulses between TOT:GATE ON and OFF.
+
+    Notes:
+    Dark counts are added for the time the gate was open, up to each
+    FETCH or the gate closing.
+    """
+    latency = .005
+
+    def __init__(self, sim, latency=None, byte_time=None):
+        SimInstrument.__init__(self, sim, latency, byte_time)
+        sim.counter = self
+        self.total = 0
+        self.gate = None
+
+    def add(self, count):
+        self._update()
+        self.total += count
+
+    def _update(self):
+        if self.gate is None:
+            return
+        now = self.sim.clock.time()
+        self.total += self.sim.dark_counts(now - self.gate)
+        self.gate = now
+
+    def handle(self, command):
+        key, value = chip._split_command(command)
+        if key == 'TOT:GATE' and value == 'ON':
+            self.total = 0
+            self.gate = self.sim.clock.time()
+        elif key == 'TOT:GATE' and value == 'OFF':
+            self._update()
+            self.gate = None
+        elif key == 'FETCH:ARRAY?':
+            self._update()
+            self._response = '%i' % self.total
+        else:
+            SimInstrument.handle(self, command)
+
+
+def install(clock=None, model=None, latency=None, shadow=True):
+    """ Replace chip.dgene, chip.hpgene and chip.hpcntr with simulated instruments.
+
+    Notes:
+    latency is a dictionary of the latency of each instrument ('dgene',
+    'hpgene', 'hpcntr'), or of (latency, byte_time) pairs as returned by
+    latencies_from_trace, defaulting to the class values. With shadow,
+    hpgene and hpcntr are wrapped in chip.ShadowInstrument, as on the
+    bench. Returns the SimChip; its clock should also replace pix.time
+    if it is a VirtualClock.
+    """
+    sim = SimChip(model, clock)
+    latency = latency or {}
+    def costs(name):
+        value = latency.get(name)
+        return value if isinstance(value, (tuple, list)) else (value, None)
+    dgene = SimDgene(sim, *costs('dgene'))
+    hpgene = SimHpgene(sim, *costs('hpgene'))
+    hpcntr = SimHpcntr(sim, *costs('hpcntr'))
+    sim.instruments = {'dgene': dgene, 'hpgene': hpgene, 'hpcntr': hpcntr}
+    if shadow:
+        hpgene = chip.ShadowInstrument(hpgene, chip.HPGENE_SETTINGS)
+        hpcntr = chip.ShadowInstrument(hpcntr, chip.HPCNTR_SETTINGS)
+    chip.dgene, chip.hpgene, chip.hpcntr = dgene, hpgene, hpcntr
+    return sim
+
+
+def latencies_from_trace(fname):
+    """ Fit (latency, byte_time) of each instrument to the GPIB transactions in a Chrome trace.
+
+    Notes:
+    The trace is one saved by tracing (pix.py --trace) on the bench. The
+    duration of each transaction is fit as latency + byte_time * bytes.
+    Instruments with no transactions in the trace are left out.
+    """
+    events = json.load(open(fname))['traceEvents']
+    result = {}
+    for label in ('dgene', 'hpgene', 'hpcntr'):
+        points = [(event['args'].get('bytes', 0), event['dur'] * 1e-6) for event in events
+                  if event.get('cat') == 'gpib' and event['name'].split(' ')[0] == label]
+        if not points:
+            continue
+        nbytes, durations = np.array(points, dtype=float).T
+        if len(points) > 1 and nbytes.std() > 0:
+            byte_time, latency = np.polyfit(nbytes, durations, 1)
+            result[label] = (max(latency, 0.0), max(byte_time, 0.0))
+        else:
+            result[label] = (durations.mean(), 0.0)
+    return result
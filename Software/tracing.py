@@ -0,0 +1,296 @@
+"""
+Tracing module: records where the time of a run goes. Every instrument
+transaction (GPIB write, read and *OPC? wait, serial write and read) is
+recorded with its duration, byte count, the operation it was part of
+(enable_single_pixel, program_config, sample_counts, ...) and the pixel
+being worked on. Events go to a ring buffer, and can be exported as a
+Chrome trace (chrome://tracing or https://ui.perfetto.dev) or printed as
+a summary table.
+
+Nothing is traced until enable is called: it wraps the instruments in
+chip and the operations listed in OPERATIONS, and disable puts the
+originals back, so a run without tracing pays nothing for it.
+"""
+
+import collections
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+
+# Functions which are recorded as operations, as module.function or
+# module.Class.method. The instrument transactions inside them are
+# attributed to the innermost one.
+OPERATIONS = ['chip.DgeneDriver.init_blocks',
+              'chip.DgeneDriver.write_blocks',
+              'chip.DgeneDriver.program_config',
+              'chip.DgeneDriver.write_latches',
+              'chip.DgeneDriver.step_single_pixel',
+              'chip.DgeneDriver.enable_single_pixel',
+              'chip.DgeneDriver.write_latch_batch',
+              'chip.DgeneDriver.apply_ops',
+              'chip.DgeneDriver.enable_count_clock',
+              'chip.DgeneDriver.disable_count_clock',
+              'chip.init_hpgene',
+              'chip.init_hpcntr',
+              'pix.set_config',
+              'pix.write_chip_tuned',
+              'pix.enable_chip',
+              'pix.enable_hitor_chip',
+              'pix.measure_thresh',
+              'pix.measure_thresh_fast',
+              'pix.measure_thresh_coarse',
+              'pix.sample_counts',
+              'pix.get_count',
+              'pix.timed_count',
+              'pix.time_until_hit',
+              'pix.fit_scurve',
+              ]
+
+# The instruments in chip which are wrapped by enable.
+INSTRUMENTS = ['dgene', 'hpgene', 'hpcntr']
+
+# The tracer in use, None if tracing is disabled.
+tracer = None
+
+
+class Tracer:
+    """ A ring buffer of the last size events.
+
+    Notes:
+    Each event is a tuple (name, category, start, duration, nbytes,
+    operation, col, row, thread), with times in seconds from clock (time
+    by default, or e.g. a sim.VirtualClock). Operations are recorded when
+    they end, with category 'op'.
+    """
+    def __init__(self, size=200000, clock=time):
+        self.events = collections.deque(maxlen=size)
+        self.clock = clock
+        self.start = clock.time()
+        self._local = threading.local()
+
+    def stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def context(self):
+        """ The innermost operation and pixel (col, row) being worked on. """
+        stack = self.stack()
+        operation = stack[-1][0] if stack else None
+        for name, col, row in reversed(stack):
+            if col is not None or row is not None:
+                return operation, col, row
+        return operation, None, None
+
+    def record(self, name, category, start, nbytes=0):
+        """ Record an event which started at start and ends now. """
+        duration = self.clock.time() - start
+        operation, col, row = self.context()
+        self.events.append((name, category, start, duration, nbytes, operation, col, row, threading.current_thread().ident))
+
+    def chrome_trace(self):
+        """ The events in the Chrome trace event format. """
+        events = []
+        for name, category, start, duration, nbytes, operation, col, row, thread in self.events:
+            args = {'bytes': nbytes}
+            if operation is not None:
+                args['operation'] = operation
+            if col is not None:
+                args['col'] = col
+            if row is not None:
+                args['row'] = row
+            events.append({'name': name, 'cat': category, 'ph': 'X', 'pid': 0, 'tid': thread,
+                           'ts': (start - self.start) * 1e6, 'dur': duration * 1e6, 'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, fname):
+        outfile = open(fname, 'w')
+        json.dump(self.chrome_trace(), outfile)
+        outfile.close()
+
+    def summary(self):
+        """ Return rows (category, name, count, total time, bytes), largest total first. """
+        totals = {}
+        for name, category, start, duration, nbytes, operation, col, row, thread in self.events:
+            total = totals.setdefault((category, name), [0, 0.0, 0])
+            total[0] += 1
+            total[1] += duration
+            total[2] += nbytes
+        rows = [(category, name, count, total, nbytes) for (category, name), (count, total, nbytes) in totals.iteritems()]
+        return sorted(rows, key=lambda row: -row[3])
+
+    def print_summary(self, limit=30):
+        if len(self.events) == self.events.maxlen:
+            print "The trace buffer is full, only the last %i events are counted." % len(self.events)
+        print '%-8s %-36s %10s %12s %10s %12s' % ('category', 'name', 'count', 'total (s)', 'mean (ms)', 'bytes')
+        for category, name, count, total, nbytes in self.summary()[:limit]:
+            print '%-8s %-36s %10i %12.3f %10.3f %12i' % (category, name[:36], count, total, 1e3 * total / count, nbytes)
+
+
+class TracedInstrument:
+    """ A GPIB instrument (or stand in) whose transactions are recorded.
+
+    Notes:
+    Writes are named by the instrument label and the command header,
+    e.g. 'hpgene VOLT', so the summary groups them by command.
+    """
+    def __init__(self, inst, label):
+        self.inst = inst
+        self.label = label
+
+    def __getattr__(self, name):
+        return getattr(self.inst, name)
+
+    def write(self, command):
+        start = tracer.clock.time()
+        result = self.inst.write(command)
+        header = command.split(None, 1)[0] if command.strip() else ''
+        tracer.record('%s %s' % (self.label, header.split(',')[0]), 'gpib', start, len(command))
+        return result
+
+    def read(self, *args):
+        start = tracer.clock.time()
+        result = self.inst.read(*args)
+        tracer.record('%s read' % self.label, 'gpib', start, len(result))
+        return result
+
+    def finished(self):
+        start = tracer.clock.time()
+        result = self.inst.finished()
+        tracer.record('%s finished' % self.label, 'wait', start)
+        return result
+
+
+class TracedPort:
+    """ A serial port (as used by FPGAgen) whose writes and reads are recorded. """
+    def __init__(self, port, label='serial'):
+        self.port = port
+        self.label = label
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    def write(self, data):
+        start = tracer.clock.time()
+        result = self.port.write(data)
+        tracer.record('%s write' % self.label, 'serial', start, len(data))
+        return result
+
+    def read(self, size=1):
+        start = tracer.clock.time()
+        result = self.port.read(size)
+        tracer.record('%s read' % self.label, 'serial', start, len(result))
+        return result
+
+
+def running_script(module_name):
+    """ The __main__ module if it is the script module_name.py (e.g. python pix.py), else None. """
+    main = sys.modules.get('__main__')
+    filename = getattr(main, '__file__', None)
+    if filename and os.path.splitext(os.path.basename(filename))[0] == module_name:
+        return main
+    return None
+
+
+def resolve(target):
+    """ Return (owner, attribute) for 'module.function' or 'module.Class.method'.
+
+    Notes:
+    A module which is the script being run is taken from __main__
+    instead of importing a second copy of it, which would be patched
+    without ever being called.
+    """
+    parts = target.split('.')
+    for i in xrange(len(parts) - 1, 0, -1):
+        module_name = '.'.join(parts[:i])
+        if module_name in sys.modules or i == 1:
+            owner = sys.modules.get(module_name) or running_script(module_name) or __import__(module_name)
+            for part in parts[i:-1]:
+                owner = getattr(owner, part)
+            return owner, parts[-1]
+
+
+def patch(target, make_wrapper, patched):
+    """ Replace the function target with make_wrapper(function), and add the original to patched.
+
+    Notes:
+    classmethods and staticmethods are wrapped inside. Returns False,
+    without changing anything, if target cannot be found.
+    """
+    try:
+        owner, attr = resolve(target)
+        original = owner.__dict__[attr]
+    except (ImportError, AttributeError, KeyError, TypeError):
+        return False
+    if isinstance(original, (classmethod, staticmethod)):
+        wrapped = type(original)(make_wrapper(original.__func__))
+    else:
+        wrapped = make_wrapper(original)
+    patched.append((owner, attr, original))
+    setattr(owner, attr, wrapped)
+    return True
+
+
+def unpatch(patched):
+    """ Put back everything in patched, latest first. """
+    while patched:
+        owner, attr, original = patched.pop()
+        setattr(owner, attr, original)
+
+
+def _traced(func, name):
+    argnames = inspect.getargspec(func)[0]
+    positions = [argnames.index(arg) if arg in argnames else None for arg in ('col', 'row')]
+    def wrapper(*args, **kwargs):
+        pixel = [kwargs.get(arg, args[position] if position is not None and position < len(args) else None) for arg, position in zip(('col', 'row'), positions)]
+        stack = tracer.stack()
+        stack.append((name, pixel[0], pixel[1]))
+        start = tracer.clock.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            tracer.record(name, 'op', start)
+            stack.pop()
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+_patched = []
+
+def enable(size=200000, clock=time, operations=OPERATIONS, instruments=INSTRUMENTS):
+    """ Start tracing into a new Tracer, and return it.
+
+    Notes:
+    operations that cannot be found (e.g. a module which is not
+    imported by this program) are skipped. Only the instruments already
+    in chip are wrapped, so set them up (e.g. sim.install) first.
+    """
+    global tracer
+    disable()
+    tracer = Tracer(size, clock)
+    for target in operations:
+        patch(target, lambda func: _traced(func, func.__name__), _patched)
+    chip = sys.modules.get('chip')
+    if chip is not None:
+        for label in instruments:
+            owner, attr = chip, label
+            inst = getattr(chip, label, None)
+            if isinstance(inst, chip.ShadowInstrument):
+                # Trace what reaches the instrument, not the skipped writes.
+                owner, attr, inst = inst, 'inst', inst.inst
+            if inst is not None:
+                _patched.append((owner, attr, inst))
+                setattr(owner, attr, TracedInstrument(inst, label))
+    return tracer
+
+
+def disable():
+    """ Stop tracing and put back everything enable wrapped. Returns the last tracer, if any. """
+    global tracer
+    unpatch(_patched)
+    last, tracer = tracer, None
+    return last
@@ -0,0 +1,240 @@
+`timescale 1ns / 1ps
+//////////////////////////////////////////////////////////////////////////////////
+// Company:  Universitiy of Washington
+// Engineer:
+//
+// Design Name:    T3MAPS DAQ
+// Module Name:    frame_rx
+// Project Name:
+// Target Devices: ATLYS Spartan 6
+// Tool versions: ISE 14.7
+// Description:
+//	Receiver for the framed variant of the serial protocol (FPGAgen.py --framed).
+//	A command is sent as chunks, each one a frame
+//		SYNC (8'hFD), SEQ, LEN, LEN bytes of data, CRC
+//	where CRC is the CRC-8 (polynomial x^8+x^2+x+1, initial value 0) of SEQ, LEN
+//	and the data. The data of a frame is only written to fifo1 once its CRC
+//	checks out, and every frame is answered with two bytes:
+//		ACK (8'hA5), SEQ       the frame was accepted (or was a repeat of the last one)
+//		NAK (8'h5A), expected  the frame was corrupted, out of order or cut short
+//	so the host only sends the failed chunks again. Frames are numbered from 0 for
+//	each command, and a frame with LEN 0 ends the command (frame_end), after which
+//	fsm_control writes it out as it does after RX_OFF.
+//	A gap in the received stream (rx_idle) in the middle of a frame means a byte
+//	was lost: the frame is answered with a NAK and the receiver looks for SYNC again.
+//	After any NAK it first waits for such a gap (SKIP), since a frame rejected for
+//	a corrupted length may still be arriving, and its bytes must not be taken for a
+//	SYNC or for RX_OFF between frames. The host leaves a gap before sending again.
+//
+// Dependencies: async.v (async_receiver for rx_idle, async_transmitter for tx)
+//
+// Revision:
+// Revision 0.01 - File Created
+// Additional Comments:
+//
+//////////////////////////////////////////////////////////////////////////////////
+module frame_rx(
+	input clk,
+	input rst,
+	input enable,       //listen for frames (fsm_control in IDLE or FRAME)
+	input in_frame,     //fsm_control is in FRAME. When it is not, frames are numbered from 0 again.
+	input [7:0] rx_byte,
+	input rx_ready,
+	input rx_idle,
+	input wr_ack,       //from fifo1
+	input tx_busy,
+	output reg [7:0] wr_data,
+	output reg wr_en,   //write wr_data to fifo1
+	output reg [7:0] tx_byte,
+	output reg tx_en,
+	output tx_active,   //frame_rx is using the transmitter
+	output hunting,     //waiting for SYNC
+	output reg frame_end, //true for one clock cycle when the end frame is accepted and acknowledged
+	output reg [7:0] errors //number of frames answered with NAK (wraps around)
+    );
+
+parameter SYNC = 8'b11111101;
+parameter ACK = 8'b10100101;
+parameter NAK = 8'b01011010;
+parameter MAXLEN = 64; //largest chunk, the size of the frame buffer
+
+//States. HUNT to CRC receive a frame, COMMIT writes it to fifo1, REPLY sends ACK or NAK,
+//SKIP waits for the end of a rejected frame.
+parameter HUNT = 4'd0;
+parameter SEQ = 4'd1;
+parameter LEN = 4'd2;
+parameter DATA = 4'd3;
+parameter CRC = 4'd4;
+parameter COMMIT = 4'd5;
+parameter COMMIT_ACK = 4'd6;
+parameter COMMIT_LOW = 4'd7;
+parameter REPLY_CODE = 4'd8;
+parameter REPLY_CODE_WAIT = 4'd9;
+parameter REPLY_SEQ = 4'd10;
+parameter REPLY_SEQ_WAIT = 4'd11;
+parameter REPLY_DONE = 4'd12;
+parameter SKIP = 4'd13;
+reg [3:0] state;
+initial state = HUNT;
+
+reg [7:0] buffer [0:MAXLEN-1]; //data of the frame being received
+reg [7:0] seq;      //number of the frame being received
+reg [7:0] len;      //its length
+reg [7:0] count;    //bytes received, then bytes written to fifo1
+reg [7:0] crc;      //running CRC
+reg [7:0] expected; //number of the next frame to accept
+reg [7:0] reply;    //ACK or NAK
+reg [7:0] reply_seq;
+reg end_pending;    //the frame being acknowledged ends the command
+
+initial wr_en = 1'b0;
+initial tx_en = 1'b0;
+initial frame_end = 1'b0;
+initial errors = 8'd0;
+initial expected = 8'd0;
+
+assign hunting = (state == HUNT);
+assign tx_active = (state >= REPLY_CODE & state <= REPLY_DONE);
+
+//CRC-8, polynomial 8'h07, of one more byte
+function [7:0] crc8;
+	input [7:0] crc_in;
+	input [7:0] data;
+	integer i;
+	reg [7:0] c;
+	begin
+		c = crc_in ^ data;
+		for (i = 0; i < 8; i = i + 1)
+			c = c[7] ? ({c[6:0], 1'b0} ^ 8'h07) : {c[6:0], 1'b0};
+		crc8 = c;
+	end
+endfunction
+
+always @ (posedge clk) begin
+	frame_end <= 1'b0;
+	tx_en <= 1'b0;
+	if (rst) begin
+		state <= HUNT;
+		wr_en <= 1'b0;
+		expected <= 8'd0;
+		errors <= 8'd0;
+		end_pending <= 1'b0;
+	end else begin
+		if (state == HUNT & ~in_frame) begin
+			expected <= 8'd0; //a new command starts from frame 0
+		end
+		case(state)
+			HUNT: if (enable & rx_ready & rx_byte == SYNC) begin
+					state <= SEQ;
+				end
+			SEQ: if (rx_ready) begin
+					seq <= rx_byte;
+					crc <= crc8(8'd0, rx_byte);
+					state <= LEN;
+				end else if (rx_idle) begin
+					state <= HUNT; //only SYNC got through, nothing to answer
+				end
+			LEN: if (rx_ready) begin
+					len <= rx_byte;
+					crc <= crc8(crc, rx_byte);
+					count <= 8'd0;
+					if (rx_byte == 8'd0) begin
+						state <= CRC;
+					end else if (rx_byte > MAXLEN) begin
+						reply <= NAK; //corrupted length, the rest is skipped in SKIP
+						reply_seq <= expected;
+						errors <= errors + 1'b1;
+						state <= REPLY_CODE;
+					end else begin
+						state <= DATA;
+					end
+				end else if (rx_idle) begin
+					reply <= NAK;
+					reply_seq <= expected;
+					errors <= errors + 1'b1;
+					state <= REPLY_CODE;
+				end
+			DATA: if (rx_ready) begin
+					buffer[count] <= rx_byte;
+					crc <= crc8(crc, rx_byte);
+					count <= count + 1'b1;
+					if (count == len - 1'b1) begin
+						state <= CRC;
+					end
+				end else if (rx_idle) begin
+					reply <= NAK;
+					reply_seq <= expected;
+					errors <= errors + 1'b1;
+					state <= REPLY_CODE;
+				end
+			CRC: if (rx_ready) begin
+					count <= 8'd0;
+					if (rx_byte == crc & seq == expected) begin //new frame: write it out, then ACK
+						reply <= ACK;
+						reply_seq <= seq;
+						end_pending <= (len == 8'd0);
+						state <= (len == 8'd0) ? REPLY_CODE : COMMIT;
+					end else if (rx_byte == crc & seq == expected - 1'b1) begin //repeat (our ACK was lost): ACK again
+						reply <= ACK;
+						reply_seq <= seq;
+						state <= REPLY_CODE;
+					end else begin
+						reply <= NAK;
+						reply_seq <= expected;
+						errors <= errors + 1'b1;
+						state <= REPLY_CODE;
+					end
+				end else if (rx_idle) begin
+					reply <= NAK;
+					reply_seq <= expected;
+					errors <= errors + 1'b1;
+					state <= REPLY_CODE;
+				end
+			//write the frame to fifo1, one byte at a time, with the same wr_en/wr_ack
+			//handshake fsm_control uses in DATA
+			COMMIT: if (count == len) begin
+					expected <= expected + 1'b1;
+					state <= REPLY_CODE;
+				end else begin
+					wr_data <= buffer[count];
+					wr_en <= 1'b1;
+					state <= COMMIT_ACK;
+				end
+			COMMIT_ACK: if (wr_ack) begin
+					wr_en <= 1'b0;
+					state <= COMMIT_LOW;
+				end
+			COMMIT_LOW: if (~wr_ack) begin
+					count <= count + 1'b1;
+					state <= COMMIT;
+				end
+			//send reply and reply_seq
+			REPLY_CODE: if (~tx_busy) begin
+					tx_byte <= reply;
+					tx_en <= 1'b1;
+					state <= REPLY_CODE_WAIT;
+				end
+			REPLY_CODE_WAIT: state <= REPLY_SEQ; //let tx_busy go up
+			REPLY_SEQ: if (~tx_busy) begin
+					tx_byte <= reply_seq;
+					tx_en <= 1'b1;
+					state <= REPLY_SEQ_WAIT;
+				end
+			REPLY_SEQ_WAIT: state <= REPLY_DONE;
+			REPLY_DONE: if (~tx_busy) begin
+					if (end_pending) begin
+						frame_end <= 1'b1;
+						end_pending <= 1'b0;
+						expected <= 8'd0;
+					end
+					state <= (reply == NAK) ? SKIP : HUNT;
+				end
+			SKIP: if (rx_idle) begin
+					state <= HUNT;
+				end
+			default: state <= HUNT;
+		endcase
+	end
+end
+
+endmodule
@@ -0,0 +1,247 @@
+`timescale 1ns / 1ps
+
+////////////////////////////////////////////////////////////////////////////////
+// Company:  Universitiy of Washington
+// Engineer:
+//
+// Design Name:   frame_rx
+// Module Name:   frame_test
+// Project Name:  T3MAPS DAQ
+// Target Device:
+// Tool versions: ISE 14.7
+// Description:
+//	Testbench for frame_rx, the receiver of the framed serial protocol. Bytes are
+//	fed in directly (rx_byte/rx_ready, as from async_receiver), fifo1 and the
+//	transmitter are simple models, so it runs without the coregen cores. It sends
+//	a command as frames with corrupted, repeated, cut short and oversized frames
+//	in between, and checks that every frame gets the right ACK or NAK, that only
+//	the good frames reach fifo1, in order, and that the end frame ends the command.
+//	The rest of an oversized frame holds SYNC and RX_OFF, which must be skipped.
+//	rx_idle goes up when the host stops sending and down with the next byte, as
+//	from async_receiver. Prints PASS or the failures.
+//
+// Dependencies: frame_rx.v
+//
+// Revision:
+// Revision 0.01 - File Created
+// Additional Comments:
+//
+////////////////////////////////////////////////////////////////////////////////
+
+module frame_test;
+
+	parameter SYNC = 8'hFD;
+	parameter ACK = 8'hA5;
+	parameter NAK = 8'h5A;
+
+	// Inputs
+	reg clk = 0;
+	reg rst = 1;
+	reg enable = 1;
+	reg in_frame = 0;
+	reg [7:0] rx_byte = 0;
+	reg rx_ready = 0;
+	reg rx_idle = 0;
+	reg wr_ack = 0;
+	reg tx_busy = 0;
+
+	// Outputs
+	wire [7:0] wr_data;
+	wire wr_en;
+	wire [7:0] tx_byte;
+	wire tx_en;
+	wire tx_active;
+	wire hunting;
+	wire frame_end;
+	wire [7:0] errors;
+
+	// Instantiate the Unit Under Test (UUT)
+	frame_rx uut (
+		.clk(clk),
+		.rst(rst),
+		.enable(enable),
+		.in_frame(in_frame),
+		.rx_byte(rx_byte),
+		.rx_ready(rx_ready),
+		.rx_idle(rx_idle),
+		.wr_ack(wr_ack),
+		.tx_busy(tx_busy),
+		.wr_data(wr_data),
+		.wr_en(wr_en),
+		.tx_byte(tx_byte),
+		.tx_en(tx_en),
+		.tx_active(tx_active),
+		.hunting(hunting),
+		.frame_end(frame_end),
+		.errors(errors)
+	);
+
+	always #5 clk = ~clk; //100Mhz clock
+
+	//fifo1: stores a byte and acknowledges it, until wr_en goes down
+	reg [7:0] fifo [0:255];
+	integer nfifo = 0;
+	always @(posedge clk) begin
+		if (wr_en & ~wr_ack) begin
+			fifo[nfifo] <= wr_data;
+			nfifo <= nfifo + 1;
+			wr_ack <= 1'b1;
+		end else if (~wr_en) begin
+			wr_ack <= 1'b0;
+		end
+	end
+
+	//transmitter: each byte keeps it busy for 20 clock cycles
+	reg [7:0] replies [0:255];
+	integer nreplies = 0;
+	integer busy_count = 0;
+	always @(posedge clk) begin
+		if (tx_en & ~tx_busy) begin
+			replies[nreplies] <= tx_byte;
+			nreplies <= nreplies + 1;
+			tx_busy <= 1'b1;
+			busy_count <= 20;
+		end else if (busy_count > 0) begin
+			busy_count <= busy_count - 1;
+			if (busy_count == 1) tx_busy <= 1'b0;
+		end
+	end
+
+	integer nend = 0;
+	always @(posedge clk) if (frame_end) nend <= nend + 1;
+
+	//RX_OFF while hunting, which fsm_control takes as the host giving up (frame_abort)
+	integer naborts = 0;
+	always @(posedge clk) if (rx_ready & rx_byte == 8'hFE & hunting) naborts <= naborts + 1;
+
+	integer failures = 0;
+	integer checked = 0;
+	integer i;
+	reg [7:0] crc;
+
+	//CRC-8, polynomial 8'h07, as in frame_rx
+	function [7:0] crc8;
+		input [7:0] crc_in;
+		input [7:0] data;
+		integer k;
+		reg [7:0] c;
+		begin
+			c = crc_in ^ data;
+			for (k = 0; k < 8; k = k + 1)
+				c = c[7] ? ({c[6:0], 1'b0} ^ 8'h07) : {c[6:0], 1'b0};
+			crc8 = c;
+		end
+	endfunction
+
+	task send_byte(input [7:0] b);
+		begin
+			@(negedge clk);
+			rx_idle = 0;
+			rx_byte = b;
+			rx_ready = 1;
+			@(negedge clk);
+			rx_ready = 0;
+			repeat (8) @(negedge clk);
+		end
+	endtask
+
+	//Send frame seq with len bytes first, first+1, ... Corrupt changes the CRC,
+	//and only nsent of the data bytes are sent, followed by a gap.
+	task send_frame(input [7:0] seq, input [7:0] len, input [7:0] first, input corrupt, input [7:0] nsent);
+		begin
+			send_byte(SYNC);
+			send_byte(seq);
+			crc = crc8(8'd0, seq);
+			send_byte(len);
+			crc = crc8(crc, len);
+			for (i = 0; i < len; i = i + 1) begin
+				crc = crc8(crc, first + i);
+				if (i < nsent) send_byte(first + i);
+			end
+			if (nsent < len) begin
+				rx_idle = 1;
+			end else if (len <= 64) begin
+				send_byte(corrupt ? ~crc : crc);
+			end
+		end
+	endtask
+
+	task expect_reply(input [7:0] code, input [7:0] seq, input integer fifo_count);
+		begin
+			rx_idle = 1; //the host waits for the reply
+			i = 0;
+			while (nreplies < checked + 2 && i < 10000) begin
+				@(negedge clk);
+				i = i + 1;
+			end
+			repeat (30) @(negedge clk);
+			if (nreplies != checked + 2 || replies[checked] != code || replies[checked + 1] != seq) begin
+				$display("FAIL: expected reply %h %h, got %0d bytes: %h %h", code, seq, nreplies - checked, replies[checked], replies[checked + 1]);
+				failures = failures + 1;
+			end
+			checked = nreplies;
+			if (nfifo != fifo_count) begin
+				$display("FAIL: %0d bytes in fifo1, expected %0d", nfifo, fifo_count);
+				failures = failures + 1;
+			end
+		end
+	endtask
+
+	initial begin
+		repeat (4) @(negedge clk);
+		rst = 0;
+		repeat (4) @(negedge clk);
+		in_frame = 1; //as fsm_control does on the first SYNC
+
+		send_frame(0, 4, 1, 0, 4);   //good
+		expect_reply(ACK, 0, 4);
+		send_frame(1, 4, 5, 1, 4);   //bad CRC
+		expect_reply(NAK, 1, 4);
+		send_frame(1, 4, 5, 0, 4);   //sent again
+		expect_reply(ACK, 1, 8);
+		send_frame(1, 4, 5, 0, 4);   //repeat, as if the ACK was lost
+		expect_reply(ACK, 1, 8);
+		send_frame(2, 4, 9, 0, 3);   //a byte lost
+		expect_reply(NAK, 2, 8);
+		send_frame(3, 4, 9, 0, 4);   //out of order
+		expect_reply(NAK, 2, 8);
+		send_frame(2, 4, 9, 0, 4);   //sent again
+		expect_reply(ACK, 2, 12);
+		send_frame(3, 200, 0, 0, 0); //corrupted length
+		expect_reply(NAK, 3, 12);
+		send_byte(SYNC);             //corrupted length, with the rest of the frame still coming
+		send_byte(3);                //after the NAK: RX_OFF, SYNC, 3, 0 and RX_OFF (as its CRC)
+		send_byte(200);              //must not be taken for the end of the command or a frame
+		for (i = 0; i < 8; i = i + 1) send_byte(8'h00);
+		send_byte(8'hFE);
+		send_byte(SYNC);
+		send_byte(3);
+		send_byte(0);
+		send_byte(8'hFE);
+		expect_reply(NAK, 3, 12);
+		send_frame(3, 0, 0, 0, 0);   //end of the command
+		expect_reply(ACK, 3, 12);
+
+		if (nend != 1) begin
+			$display("FAIL: frame_end was seen %0d times", nend);
+			failures = failures + 1;
+		end
+		for (i = 0; i < 12; i = i + 1) begin
+			if (fifo[i] != i + 1) begin
+				$display("FAIL: fifo1 byte %0d is %0d", i, fifo[i]);
+				failures = failures + 1;
+			end
+		end
+		if (errors != 5) begin
+			$display("FAIL: %0d errors counted, expected 5", errors);
+			failures = failures + 1;
+		end
+		if (naborts != 0) begin
+			$display("FAIL: RX_OFF was received %0d times while hunting", naborts);
+			failures = failures + 1;
+		end
+		if (failures == 0) $display("PASS");
+		$finish;
+	end
+
+endmodule
@@ -30,12 +30,16 @@
 	 input wr_ack,
 	 input rd_ack,
 	 input SW0,
+	 input frame_end,     //frame_rx accepted the end frame of a command
+	 input frame_hunting, //frame_rx is between frames
 	 output [7:0] LED,
     output wr_en1,
     output wr_en2,
     output rd_en1,
     output rd_en2,
-	 output tx_en
+	 output tx_en,
+	 output frame_listen, //frame_rx may receive frames (IDLE or FRAME)
+	 output frame_mode    //in FRAME
     );
 	 
 //registers below used in FSM and other sequential logic 
@@ -54,14 +58,18 @@ assign rd_en2 = reg_rd_en2;
 assign tx_en = reg_en_tx;
 assign LED[7:0] = reg_LED;
 
-//4 States for FSM. Using one hot encoding, although implenation converts this to gray encoding. 
-parameter SIZE = 4; 
-parameter IDLE  = 4'b0001; 
-parameter DATA = 4'b0010;
-parameter WRITE = 4'b0100;
-parameter TRANSMIT = 4'b1000;
+//5 States for FSM. Using one hot encoding, although implenation converts this to gray encoding. 
+parameter SIZE = 5; 
+parameter IDLE  = 5'b00001; 
+parameter DATA = 5'b00010;
+parameter WRITE = 5'b00100;
+parameter TRANSMIT = 5'b01000;
+parameter FRAME = 5'b10000; //framed protocol: frame_rx fills fifo1
 reg [SIZE-1:0] state; //state register
 initial state = IDLE;
+assign frame_listen = (state == IDLE) || (state == FRAME);
+assign frame_mode = (state == FRAME);
+wire frame_abort = (rx_byte == 8'b11111110) & rx_ready & frame_hunting; //RX_OFF between frames
 initial reg_wr_en1 <= 1'b0;
 initial reg_wr_en2 <= 1'b0;
 initial reg_rd_en1 <= 1'b0;
@@ -90,6 +98,8 @@ begin: FSM
 					state <= WRITE;
 				end else if (rx_byte == 8'b01111110 && rx_ready) begin //enter the transmit state.
 					state <= TRANSMIT;
+				end else if (rx_byte == 8'b11111101 && rx_ready) begin //SYNC of a frame, enter the frame state.
+					state <= FRAME;
 				end else begin
 					state <= IDLE; //remain in idle state if rxData is not one of the above values.
 					reg_wr_en1 <= 1'b0; //Next five lines reset all fifo/uart control registers to
@@ -128,6 +138,26 @@ begin: FSM
 						reg_LED[1] <= 1'b1; //enable LED1 to indicate state. 
 						state <= DATA; //remain in data state.
 				end
+			//frame_rx receives the command, checks it and writes it to fifo1.
+			//When it accepts the end frame, go on as DATA does on RX_OFF. RX_OFF between
+			//frames means the host gave up: go on the same way, so what was accepted of
+			//the command leaves fifo1 before the host sends it again.
+			FRAME: if ((frame_end | frame_abort) & SW0) begin
+						state <= IDLE;
+					end else if ((frame_end | frame_abort) & !SW0) begin
+						state <= WRITE;
+						reg_wr_en1 <= 1'b0; //Next five lines reset all fifo/uart control registers to
+						reg_wr_en2 <= 1'b0; //0 since each state enables what it needs. 
+						reg_rd_en1 <= 1'b0;
+						reg_rd_en2 <= 1'b0;
+						reg_en_tx <= 1'b0;	
+						reg_LED[0] <= 1'b1; //Set the idle LED true
+						reg_LED[4] <= 1'b0;
+						reg_LED[2:1] <= 3'b00; //Clear the other LEDs
+					end else begin
+						reg_LED[1] <= 1'b1; //same LED as DATA
+						state <= FRAME;
+					end
 			//review this maybe
 			WRITE:if (fifoEmpty1 & SW0) begin //If fifo1 is empty, then either a write error occured or we are done
 					reg_LED[3] <= 1'b1;    //signal write state finishing.
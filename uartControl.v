@@ -36,9 +36,24 @@ module uartControl(
 
 wire [7:0] tx_byte; //Used to prevent sythesis from assuming a 1 bit wire
 wire [7:0] rx_byte; //Used to prevent sythesis from assuming a 1 bit wire
+wire [7:0] fifo_tx_byte; //byte from fifo2 to send
+wire [7:0] frame_tx_byte; //ACK/NAK of the framed protocol
+wire [7:0] frame_wr_data; //byte of a checked frame, to fifo1
+wire [7:0] fifo_din; //byte written to fifo1
+wire [7:0] frame_errors; //frames answered with NAK
+wire tx_en, wr_en1; //shared by fsm_control and frame_rx
+wire fsm_tx_en, fsm_wr_en1, frame_tx_en, frame_wr_en, frame_tx_active;
+wire frame_listen, frame_mode, frame_hunting, frame_end;
 wire rst; //True reset for modules
 assign rst = Reset || ~lock;	
 
+//The transmitter and fifo1 are shared between fsm_control and frame_rx.
+//frame_rx only uses them while fsm_control is in IDLE or FRAME, when fsm_control does not.
+assign tx_byte = frame_tx_active ? frame_tx_byte : fifo_tx_byte;
+assign tx_en = fsm_tx_en | frame_tx_en;
+assign fifo_din = frame_wr_en ? frame_wr_data : rx_byte;
+assign wr_en1 = fsm_wr_en1 | frame_wr_en;
+
 async_transmitter tx_mod(
 	.clk			(clk_100),
 	.TxD_start	(tx_en),
@@ -70,11 +85,11 @@ fifos memory(
 	.rd_en1				(rd_en1), //enable read to fifo1.
 	.rd_en2				(rd_en2), //enable read tot fifo2.
 	.datain				(data),   //single bit data from input pin. Stored to fifo2. 
-	.rxData				(rx_byte[7:0]), //8 bit data from uart. Stored to fifo1.
+	.rxData				(fifo_din[7:0]), //8 bit data from uart (or from frame_rx). Stored to fifo1.
 	.wr_ack				(wr_ack),
 	.rd_ack				(rd_ack),
 	.problem				(PROBLEM),//signal true if either fifo1 or fifo2 is full, or if both are empty.
-	.txData				(tx_byte[7:0]), //8 bit data from fifo2 to uart.
+	.txData				(fifo_tx_byte[7:0]), //8 bit data from fifo2 to uart.
 	.cmd					(cmd[7:0]),	 //8 bit data from fifo1 to cmd pins. 
 	.empty1			   (fifoEmpty1), //signal from fifo1 if it is empty. 	
 	.empty2				(fifoEmpty2),
@@ -92,16 +107,42 @@ fsm_control fsm1(
 	.rx_ready	(rx_ready),
 	.wr_ack		(wr_ack),
 	.rd_ack		(rd_ack),
-	.wr_en1		(wr_en1),
+	.wr_en1		(fsm_wr_en1),
 	.wr_en2		(wr_en2),
 	.rd_en1		(rd_en1),
 	.rd_en2		(rd_en2),
 	.SW0			(SW0),
-	.tx_en		(tx_en),
+	.tx_en		(fsm_tx_en),
 	.tx_busy		(tx_busy),
 	.fifoEmpty1 (fifoEmpty1),
 	.fifoEmpty2 (fifoEmpty2),
-	.PROBLEM		(PROBLEM)
+	.PROBLEM		(PROBLEM),
+	.frame_end	(frame_end),
+	.frame_hunting (frame_hunting),
+	.frame_listen (frame_listen),
+	.frame_mode	(frame_mode)
+	);
+
+//Receiver of the framed protocol (FPGAgen.py --framed): checks the CRC of each
+//chunk, writes the good ones to fifo1 and answers ACK or NAK.
+frame_rx frames(
+	.clk			(clk_100),
+	.rst			(rst),
+	.enable		(frame_listen),
+	.in_frame	(frame_mode),
+	.rx_byte		(rx_byte[7:0]),
+	.rx_ready	(rx_ready),
+	.rx_idle		(rx_extra[0]),
+	.wr_ack		(wr_ack),
+	.tx_busy		(tx_busy),
+	.wr_data		(frame_wr_data[7:0]),
+	.wr_en		(frame_wr_en),
+	.tx_byte		(frame_tx_byte[7:0]),
+	.tx_en		(frame_tx_en),
+	.tx_active	(frame_tx_active),
+	.hunting		(frame_hunting),
+	.frame_end	(frame_end),
+	.errors		(frame_errors[7:0])
 	);
 
 endmodule